@@ -1,68 +1,63 @@
 import sys
-import boto3
+import argparse
 import pandas as pd
-
-def get_path_size(bucket, path):
-    s3 = boto3.resource('s3')
-    my_bucket = s3.Bucket(bucket)
-    total_size = 0
-
-    for obj in my_bucket.objects.filter(Prefix=path):
-        total_size = total_size + obj.size
-
-    return total_size
-
-def main():
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import modules.stores as stores
+import modules.footprint as footprint
+
+def setup_args():
+    parser = argparse.ArgumentParser(description="Measure the storage footprint of chunking strategies")
+    parser.add_argument('--store_url', type=str, default=None,
+                        help='Folder holding one sub-folder per strategy (any store URL, see measure_performance.py). '
+                             'Defaults to the rechunked archive on S3')
+    parser.add_argument('--max_workers', type=int, default=8, help='Strategies analyzed concurrently')
+    parser.add_argument('--list_workers', type=int, default=16, help='Prefixes (arrays, and chunk index prefixes within large arrays) listed concurrently per strategy')
+    return parser.parse_args()
+
+def parse_strategy(strategy_url):
+    # Process folder name, e.g. .../time0048_lat0010_lon0100/inst.zarr/
+    strategy_str = strategy_url.rstrip('/').split('/')[-2]
+    strategy = '_'.join(strategy_str.split('_')[-3:])
+    time_chunk = strategy.split('_')[0].split('time')[-1]
+    lat_chunk = strategy.split('_')[1].split('lat')[-1]
+    lon_chunk = strategy.split('_')[2].split('lon')[-1]
+    return time_chunk, lon_chunk, lat_chunk
+
+def main(args):
     bucket = 'eis-dh-fire'
     dataset = 'geos-fp-global'
     archive = 'inst'
     variable = 'BCEXTTAU'
 
-    folder = f'dieumynguyen_rechunked/{dataset}_{archive}/'
-    client = boto3.client('s3')
-    result = client.list_objects(Bucket=bucket, Prefix=folder, Delimiter='/')
-
-    # Get strategy names
-    all_strategies = []
-    for prefix in result.get('CommonPrefixes'):
-        folder_path = prefix.get('Prefix')
-        all_strategies.append(folder_path)
-
+    store_url = args.store_url or f's3://{bucket}/dieumynguyen_rechunked/{dataset}_{archive}/'
+    all_strategies = stores.list_strategies(store_url, archive)
     print(f'Number of chunking strategies: {len(all_strategies)}')
 
-    archive_sizes = {
-        'time_chunks':    [],
-        'lon_chunks':     [],
-        'lat_chunks':     [],
-        'archive_size':   []
-    }
-
-    for strat_i, strat in enumerate(all_strategies, start=0):
-        try:
-            # Process file name
-            strategy_str = strat.split('/')[-2] 
-            category = '_'.join(strategy_str.split('_')[:-3])
-            strategy = '_'.join(strategy_str.split('_')[-3:])
-            time_chunk = strategy.split('_')[0].split('time')[-1]
-            lat_chunk = strategy.split('_')[1].split('lat')[-1]
-            lon_chunk = strategy.split('_')[2].split('lon')[-1]
-
-            sys.stdout.write(f'\rGetting size of strategy {strat_i} / {len(all_strategies)-1} -- {strategy}')
+    # Strategies are listed concurrently, and so are the prefixes within each strategy
+    rows = []
+    with ThreadPoolExecutor(max_workers=args.max_workers) as executor:
+        futures = {executor.submit(footprint.analyze_footprint, strategy_url, variable, args.list_workers): strategy_url
+                   for strategy_url in all_strategies}
+        for strat_i, future in enumerate(as_completed(futures)):
+            strategy_url = futures[future]
+            sys.stdout.write(f'\rGetting size of strategy {strat_i} / {len(all_strategies)-1}')
             sys.stdout.flush()
+            try:
+                strategy_footprint = future.result()
+            except Exception as e:
+                print(f'\nFailed to measure {strategy_url}: {e!r}')
+                continue
+            time_chunk, lon_chunk, lat_chunk = parse_strategy(strategy_url)
+            rows.append({'time_chunks': time_chunk, 'lon_chunks': lon_chunk, 'lat_chunks': lat_chunk,
+                         **strategy_footprint})
+    print()
 
-            # Get folder size in bytes
-            total_size = get_path_size(bucket, strat)
-
-            archive_sizes['time_chunks'].append(time_chunk)
-            archive_sizes['lon_chunks'].append(lon_chunk)
-            archive_sizes['lat_chunks'].append(lat_chunk)
-            archive_sizes['archive_size'].append(total_size)
-        except:
-            continue
-        
     # Create and save csv
-    archive_sizes_df = pd.DataFrame(archive_sizes)
+    archive_sizes_df = pd.DataFrame(rows).sort_values(by=['time_chunks', 'lon_chunks', 'lat_chunks'])
+    archive_sizes_df = archive_sizes_df.reset_index(drop=True)
     archive_sizes_df.to_csv(f'../data/{dataset}_{archive}/performance_data/archive_sizes.csv')
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    args = setup_args()
+    main(args)
@@ -1,21 +1,55 @@
 import os
-import s3fs 
 import time
-import boto3
+import psutil
+import argparse
 import numpy as np
 import pandas as pd
 import xarray as xr
 from pathlib import Path
 from memory_profiler import memory_usage
 
+import modules.stores as stores
+import modules.cost_model as cost_model
+import modules.chunk_cache as chunk_cache
+import modules.fetch as fetch
+import modules.netsim as netsim
+import modules.io_stats as io_stats
+import modules.compression as compression
+import modules.sharding as sharding
+import modules.pyramid as pyramid
+import modules.streaming as streaming
+import modules.handles as handles
+import modules.metadata_cache as metadata_cache
+import modules.sampling as sampling
+import modules.results_store as results_store
+import modules.queries as queries
+
 import multiprocessing as mp
-from typing import List, Any, Tuple, Dict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 print(f'CPU count: {mp.cpu_count()}')
-N_WORKERS = mp.cpu_count()
 
-def execute(select_data, task, date, lat, lon, method, avg_aggregate):
-    # Query metadata for selected data
+METRIC_COLUMNS = ['time_chunks', 'lon_chunks', 'lat_chunks', 'cpu_times', 'wall_times',
+                  'peak_memories', 'num_chunks', 'pred_num_chunks', 'chunk_sizes', 
+                  'pred_compressed_bytes', 'pred_decompressed_bytes', 'array_shape',
+                  'cache_size', 'warm_cpu_times', 'warm_wall_times', 'warm_peak_memories',
+                  'cache_hits', 'cache_misses', 'cache_evictions', 'concurrency', 'network_profile',
+                  'get_requests', 'head_requests', 'list_requests', 'bytes_received',
+                  'latency_p50', 'latency_p95', 'latency_p99', 'read_amplification',
+                  'codec', 'fetch_time', 'decode_time', 'chunks_per_shard',
+                  'pyramid_plan', 'stream_block_size', 'stream_cpu_times', 'stream_wall_times',
+                  'stream_peak_memories', 'open_time', 'index_time', 'handle_cached',
+                  'metadata_time', 'coords_time', 'open_requests',
+                  'warmup_trials', 'num_samples', 'wall_time_samples', 'cpu_time_samples',
+                  'peak_memory_samples', 'wall_time_median', 'wall_time_p95', 'wall_time_std',
+                  'wall_time_ci_low', 'wall_time_ci_high']
+CHUNK_COLUMNS = ['time_chunks', 'lon_chunks', 'lat_chunks']
+
+def select(select_data, task, date, lat, lon, method, avg_aggregate, coord_indexes=None):
+    # Query metadata for selected data, without loading it
+    # coord_indexes: prebuilt {dim: handles.CoordIndex}, to select by position instead of sel()
+    if coord_indexes is not None:
+        return select_indexed(select_data, task, date, lat, lon, method, avg_aggregate, coord_indexes)
     if task == 'time':
         data_series = select_data.sel(lat=lat, lon=lon, method=method)
         if avg_aggregate: 
@@ -30,6 +64,38 @@ def execute(select_data, task, date, lat, lon, method, avg_aggregate):
             data_series = data_series.mean(dim=['time'])
     elif task == 'map_one_timestep':
         data_series = select_data.sel(time=date).isel(time=0)
+    return data_series
+
+def select_indexed(select_data, task, date, lat, lon, method, avg_aggregate, coord_indexes):
+    # Same selection as select(), looked up in the prebuilt coordinate indexes
+    if task == 'time':
+        data_series = select_data.isel(lat=coord_indexes['lat'].isel_key(lat, method),
+                                       lon=coord_indexes['lon'].isel_key(lon, method))
+        if avg_aggregate:
+            data_series = data_series.mean(dim=['lat', 'lon'])
+    elif task == 'map':
+        data_series = select_data.isel(time=coord_indexes['time'].isel_key(date))
+        if avg_aggregate:
+            data_series = data_series.mean(dim=['time'])
+    elif task == 'map_one_timestep':
+        data_series = select_data.isel(time=coord_indexes['time'].isel_key(date)).isel(time=0)
+    return data_series
+
+def execute(select_data, task, date, lat, lon, method, avg_aggregate, coord_indexes=None,
+            aggregate_pyramid=None, stream_block_bytes=None):
+    if aggregate_pyramid is not None and avg_aggregate:
+        # Answered from the precomputed aggregates (see modules/pyramid.py), same result
+        return aggregate_pyramid.query(select_data, task, date, lat, lon, method, coord_indexes)
+    if stream_block_bytes is not None and avg_aggregate:
+        # Reduced block by block (see modules/streaming.py), the selection is never in memory at once
+        data_series = select(select_data, task, date, lat, lon, method, False, coord_indexes)
+        dims = ['lat', 'lon'] if task == 'time' else ['time']
+        # Start of the selection in the stored array, to line blocks up with its chunks without dask
+        origin = [start for start, _ in cost_model.selection_ranges(select_data, task, date, lat, lon, method,
+                                                                    coord_indexes)]
+        return streaming.reduce(data_series, dims, ['mean'], stream_block_bytes, origin)['mean']
+
+    data_series = select(select_data, task, date, lat, lon, method, avg_aggregate, coord_indexes)
 
     # Put selected data into memory   
     data_series.compute()
@@ -37,39 +103,168 @@ def execute(select_data, task, date, lat, lon, method, avg_aggregate):
     # Objects in Python are passed/returned by reference rather than value, so data size should not affect time/memory to return
     return data_series 
 
-def measure_cpu_time(info):
-    # Return sum of the system and user CPU time
-    start = time.process_time()
-    execute(**info)
-    cpu_time = time.process_time() - start
-    return cpu_time
-
-def measure_wall_time(info):
-    # Measure wall clock time 
-    start = time.time()
-    execute(**info)
-    wall_time = time.time() - start
-    return wall_time
-
-def measure_peak_memory(execute_function, info):
-    # Mem over time, over chunks of 0.1 sec by default
-    # Units: Mebibyte
-    proc = (execute_function, [], info)
-    mem_usage = memory_usage(proc)
-    return max(mem_usage)
-
-def measure_num_chunks(info):
+def timed_execute(info):
+    # Return sum of the system and user CPU time and wall clock time of the same execution
+    wall_start = time.time()
+    cpu_start = time.process_time()
     data_series = execute(**info)
-    n_dims = len(data_series.chunks)
-    num_chunk = np.product([len(data_series.chunks[dim_i]) for dim_i in range(n_dims)])
-    return num_chunk
+    cpu_time = time.process_time() - cpu_start
+    wall_time = time.time() - wall_start
+    return cpu_time, wall_time, data_series.shape
+
+def measure_execution(info):
+    # One instrumented execution per trial: memory is sampled in a separate process
+    # over chunks of 0.1 sec by default while execute() runs once in this one
+    # max_iterations=1: by default, memory_usage() runs a target that returns within fewer than
+    # 5 samples again at a tenth of the interval, so a fast execute() would be timed warm
+    # Units: sec, sec, Mebibyte
+    proc = (timed_execute, [info], {})
+    mem_usage, (cpu_time, wall_time, array_shape) = memory_usage(proc, retval=True, max_iterations=1)
+    return cpu_time, wall_time, max(mem_usage), array_shape
+
+def measure_chunks(info):
+    # Number of chunks and chunk size in memory from the dask chunk metadata, nothing is computed
+    # Units: -, byte
+    data_series = select(**info)
+    num_chunk = int(np.prod([len(dim_chunks) for dim_chunks in data_series.chunks]))
+    chunk_size = data_series.nbytes / num_chunk
+    return num_chunk, chunk_size
 
-def measure_chunk_size(num_chunk, info):
-    # Return chunk size in memory
+def selection_nbytes(info):
+    # Uncompressed bytes the query needs: the selection before any aggregation
     # Units: byte
-    data_series = execute(**info)
-    chunk_size = data_series.nbytes / num_chunk
-    return chunk_size 
+    return select(**{**info, 'avg_aggregate': False}).nbytes
+
+def touched_keys(array_meta, variable, info):
+    # Selection ranges and the (sampled) keys of the chunks the query touches
+    ranges = cost_model.selection_ranges(info['select_data'], info['task'], info['date'], 
+                                         info['lat'], info['lon'], info['method'], info.get('coord_indexes'))
+    separator = array_meta.get('dimension_separator') or '.'
+    keys = cost_model.touched_chunk_keys(variable, ranges, array_meta['chunks'], separator)
+    return ranges, keys
+
+def predict_chunk_access(mapper, array_meta, variable, info, sharded_store=None):
+    # Chunks touched, compressed bytes fetched and decompressed bytes predicted from the 
+    # chunk grid and the query selection; only metadata and chunk object sizes are requested
+    # (from the shard indexes for sharded stores)
+    ranges, keys = touched_keys(array_meta, variable, info)
+    if sharded_store is not None:
+        chunk_sizes = sharded_store.chunk_sizes(keys)
+    else:
+        chunk_sizes = cost_model.chunk_object_sizes(mapper, keys)
+    itemsize = np.dtype(array_meta['dtype']).itemsize
+    return cost_model.predict_access(ranges, array_meta['chunks'], itemsize, chunk_sizes=chunk_sizes)
+
+def measure_decode(store, array_meta, variable, info, num_chunks):
+    # Fetch, then decode, the chunks the query touches, one after the other, to split the cost 
+    # of a read between the store and the codec; a sample of chunks is scaled up to num_chunks
+    # Units: sec, sec
+    _, keys = touched_keys(array_meta, variable, info)
+    if len(keys) == 0:
+        return 0.0, 0.0
+    decoders = compression.get_decoders(array_meta['compressor'], array_meta.get('filters'))
+    scale = num_chunks / len(keys)
+
+    fetch_start = time.perf_counter()
+    values = store.getitems(keys)
+    fetch_time = time.perf_counter() - fetch_start
+
+    decode_start = time.perf_counter()
+    for value in values.values():
+        compression.decode(decoders, value)
+    decode_time = time.perf_counter() - decode_start
+    return fetch_time * scale, decode_time * scale
+
+def parse_strategy(data_path):
+    # Process file name, e.g. .../time0048_lat0010_lon0100/inst.zarr/
+    strategy_str = data_path.split('/')[-3] 
+    strategy = '_'.join(strategy_str.split('_'))
+
+    time_chunk = strategy.split('_')[0].split('time')[-1]
+    lat_chunk = strategy.split('_')[1].split('lat')[-1]
+    lon_chunk = strategy.split('_')[2].split('lon')[-1]
+    return time_chunk, lon_chunk, lat_chunk
+
+def open_variable(store, variable, use_dask=True):
+    # With dask: one dask chunk per zarr chunk, each read by its own task
+    # Without: lazily indexed arrays, read with one zarr call per selection,
+    # which requests all the chunk keys of the selection in one getitems()
+    if use_dask:
+        data = xr.open_zarr(store, consolidated=True).unify_chunks() 
+    else:
+        data = xr.open_zarr(store, consolidated=True, chunks=None)
+
+    # Select a variable
+    select_data = data[variable]
+
+    # Sort time dimension, unless it already is (one pass instead of a sort)
+    times = select_data['time'].values
+    if not np.all(times[1:] >= times[:-1]):
+        select_data['time'] = np.sort(times)
+    return select_data
+
+def open_strategy(data_path, variable, cache_size=None, concurrency=None, network_profile=None,
+                  metadata_cache_dir=None):
+    # Store stack, opened variable and its coordinate indexes of a strategy, i.e. everything a
+    # query needs before it reads data; measure_strategy() gets it from handles.HANDLES
+    # Opening is timed in phases: consolidated metadata, coordinate arrays, then the rest of
+    # xr.open_zarr() and the coordinate indexes
+    # With metadata_cache_dir, metadata and coordinates come from that local folder, shared
+    # by all workers, once a worker has fetched them (see modules/metadata_cache.py)
+    # With a chunk cache (cache_size in MiB), reads go through it
+    # With a concurrency level, chunks are fetched by the fetch layer with that many requests in flight
+    # With a network profile (see modules/netsim.py), requests to the store get its latency and bandwidth
+    # Sharded stores (see modules/sharding.py) are read with byte-range requests, which the sharded
+    # layer itself sends with `concurrency` requests in flight
+    mapper = stores.get_mapper(data_path)
+    store = mapper
+    if network_profile is not None:
+        store = netsim.SimulatedStore(mapper, **netsim.NETWORK_PROFILES[network_profile])
+    # Requests that reach the store (cache misses only) are counted and timed
+    io_store = io_stats.InstrumentedStore(store)
+    meta_store = metadata_cache.MetadataCache(io_store, data_path, metadata_cache_dir)
+    store = meta_store
+
+    # Units of metadata_time, coords_time: sec
+    metadata_start = time.perf_counter()
+    zmetadata = meta_store['.zmetadata']
+    coords_start = time.perf_counter()
+    meta_store.getitems(metadata_cache.coordinate_keys(zmetadata))
+    coords_end = time.perf_counter()
+
+    chunks_per_shard = sharding.read_layout(meta_store, variable)
+    sharded_store = None
+    if chunks_per_shard is not None:
+        sharded_store = sharding.ShardedStore(store, concurrency)
+        store = sharded_store
+    elif concurrency is not None:
+        store = fetch.ConcurrentFetcher(store, concurrency)
+    # Store the query's chunks are fetched from, below the fetch and cache layers
+    chunk_store = store
+    cache = None
+    if cache_size is not None:
+        cache = chunk_cache.ChunkCache(store, cache_size * 2**20)
+        store = cache
+
+    select_data = open_variable(store, variable)
+    # Hand every chunk of the selection to the fetch layer at once
+    exec_data = open_variable(store, variable, use_dask=False) if concurrency is not None else select_data
+
+    # Units of index_time: sec
+    index_start = time.perf_counter()
+    coord_indexes = handles.build_indexes(select_data)
+    index_time = time.perf_counter() - index_start
+    open_requests = io_store.stats()[0]
+
+    return {
+        'mapper': mapper, 'io_store': io_store, 'sharded_store': sharded_store, 'chunk_store': chunk_store,
+        'cache': cache, 'store': store, 'chunks_per_shard': chunks_per_shard,
+        'array_meta': cost_model.read_array_meta(meta_store, variable),
+        'select_data': select_data, 'exec_data': exec_data,
+        'coord_indexes': coord_indexes, 'index_time': index_time,
+        'metadata_time': coords_start - metadata_start, 'coords_time': coords_end - coords_start,
+        'open_requests': open_requests,
+    }
 
 def measure_strategy(
     data_path, 
@@ -81,237 +276,446 @@ def measure_strategy(
     lon=None, 
     method=None,
     num_trials=3, 
-    avg_aggregate=False
+    avg_aggregate=False,
+    cache_size=None,
+    concurrency=None,
+    network_profile=None,
+    use_pyramid=False,
+    stream_block_size=None,
+    metadata_cache_dir=None,
+    warmup=0,
+    max_trials=None,
+    target_rel_ci=None
 ):
-    # Process file name
-    strategy_str = data_path.split('/')[-3] 
-    strategy = '_'.join(strategy_str.split('_'))
-
-    time_chunk = strategy.split('_')[0].split('time')[-1]
-    lat_chunk = strategy.split('_')[1].split('lat')[-1]
-    lon_chunk = strategy.split('_')[2].split('lon')[-1]
-
-    # Open data and perform selection
-    s3 = s3fs.S3FileSystem(anon=False)
-    data_path = s3.get_mapper(data_path)
-    data = xr.open_zarr(data_path, consolidated=True).unify_chunks() 
-
-    # Select a variable
-    select_data = data[variable]
-
-    # Sort time dimension
-    select_data['time'] = np.sort(select_data['time'].values)
+    time_chunk, lon_chunk, lat_chunk = parse_strategy(data_path)
+
+    # Open data (or reuse the handle of an earlier query on the same store in this process)
+    # and perform selection; opening and indexing are timed once, apart from the trials,
+    # which only time the data read
+    # With a chunk cache, each trial is measured cold (cache emptied) and then warm
+    # (cache primed by the cold execution of the same query)
+    handle_key = (data_path, variable, cache_size, concurrency, network_profile, metadata_cache_dir)
+    handle, handle_cached = handles.HANDLES.get(
+        handle_key, lambda: open_strategy(data_path, variable, cache_size, concurrency, network_profile,
+                                          metadata_cache_dir))
+    mapper = handle['mapper']
+    io_store = handle['io_store']
+    sharded_store = handle['sharded_store']
+    chunk_store = handle['chunk_store']
+    cache = handle['cache']
+    store = handle['store']
+    chunks_per_shard = handle['chunks_per_shard']
+    array_meta = handle['array_meta']
 
     # Create info list for execute()
     info = {
-        "select_data": select_data, 
+        "select_data": handle['select_data'], 
         "task": task, 
         "date": date, 
         "lat": lat, 
         "lon": lon, 
         "method": method, 
         "avg_aggregate": avg_aggregate,
+        "coord_indexes": handle['coord_indexes'],
     }
     
-    # Measure performance 
+    # Chunk layout of the selection is the same in every trial
+    num_chunk, chunk_size = measure_chunks(info)
+    prediction = predict_chunk_access(mapper, array_meta, variable, info, sharded_store)
+    codec = compression.describe_codec(array_meta['compressor'], array_meta.get('filters'))
+    needed_bytes = selection_nbytes(info)
+    info['select_data'] = handle['exec_data']
+
+    # With use_pyramid, aggregate queries are answered from the aggregate pyramid of the store
+    # (built by rechunk/build_pyramid.py), from its coarsest exact levels plus raw data at the edges
+    exec_info = info
+    pyramid_plan = None
+    if use_pyramid and avg_aggregate:
+        if 'pyramid' not in handle:
+            handle['pyramid'] = pyramid.Pyramid(store, variable)
+        aggregate_pyramid = handle['pyramid']
+        _, pieces, _ = aggregate_pyramid.plan_query(**{k: v for k, v in info.items() if k != 'avg_aggregate'})
+        pyramid_plan = pyramid.describe_plan(pieces)
+        exec_info = {**info, 'aggregate_pyramid': aggregate_pyramid}
+
+    # With a stream block size (MiB), aggregate queries are also measured reduced block by block
+    stream_info = None
+    if stream_block_size is not None and avg_aggregate:
+        stream_info = {**info, 'stream_block_bytes': int(stream_block_size * 2**20)}
+
+    # Warmup executions (e.g. connection pools, dask's first graph) are run and discarded
+    for n in range(warmup):
+        measure_execution(exec_info)
+
+    # Measure performance: num_trials trials, then, with a target relative confidence interval
+    # of the median wall time, more trials until it is reached or max_trials are run
     cpu_time_list = []
     wall_time_list = []
     peak_memory_list = []
-    num_chunk_list = []
-    chunk_size_list = []
-    for n in range(num_trials):
-        cpu_time_trial = measure_cpu_time(info)
-        wall_time_trial = measure_wall_time(info)
-        peak_memory_trial = measure_peak_memory(execute, info)
-        num_chunk_trial = measure_num_chunks(info)
-        chunk_size_trial = measure_chunk_size(num_chunk_trial, info)
+    warm_list = []
+    stream_list = []
+    io_list = []
+    latencies = []
+    while sampling.needs_more(wall_time_list, num_trials, max_trials, target_rel_ci):
+        if cache is not None:
+            cache.invalidate()
+        if sharded_store is not None:
+            # Shard indexes are read again by each cold execution
+            sharded_store.invalidate()
+        io_store.reset_stats()
+        cpu_time_trial, wall_time_trial, peak_memory_trial, array_shape = measure_execution(exec_info)
 
         cpu_time_list.append(cpu_time_trial)
         wall_time_list.append(wall_time_trial)
         peak_memory_list.append(peak_memory_trial)
-        num_chunk_list.append(num_chunk_trial)
-        chunk_size_list.append(chunk_size_trial)
-
-    # Record avg of each metric
+        io_list.append(io_store.stats())
+        latencies.extend(io_store.latencies)
+
+        if cache is not None:
+            # Peak memory of the warm execution includes the cache itself
+            cache.reset_stats()
+            warm_cpu_time, warm_wall_time, warm_peak_memory, _ = measure_execution(exec_info)
+            warm_list.append([warm_cpu_time, warm_wall_time, warm_peak_memory, 
+                              cache.hits, cache.misses, cache.evictions])
+
+        if stream_info is not None:
+            # Cold as well
+            if cache is not None:
+                cache.invalidate()
+            if sharded_store is not None:
+                sharded_store.invalidate()
+            stream_cpu_time, stream_wall_time, stream_peak_memory, _ = measure_execution(stream_info)
+            stream_list.append([stream_cpu_time, stream_wall_time, stream_peak_memory])
+
+    # Record avg of each metric, and the raw samples with their summary statistics
+    wall_summary = sampling.summarize(wall_time_list)
+    sample_metrics = [warmup, len(wall_time_list), sampling.encode_samples(wall_time_list),
+                      sampling.encode_samples(cpu_time_list), sampling.encode_samples(peak_memory_list),
+                      wall_summary['median'], wall_summary['p95'], wall_summary['std'],
+                      wall_summary['ci_low'], wall_summary['ci_high']]
     cpu_time = np.mean(cpu_time_list)
     wall_time = np.mean(wall_time_list)
     peak_memory = np.mean(peak_memory_list)
-    num_chunk = np.mean(num_chunk_list)
-    chunk_size = np.mean(chunk_size_list)
-
-    # Get number of data points in array
-    data_series = execute(**info)
-    array_shape = data_series.shape
+    if cache is not None:
+        warm_metrics = list(np.mean(warm_list, axis=0))
+    else:
+        warm_metrics = [np.nan] * 6
+    if stream_info is not None:
+        stream_metrics = [stream_block_size] + list(np.mean(stream_list, axis=0))
+    else:
+        stream_metrics = [np.nan] * 4
+
+    # Store traffic of the (cold) executions; latency percentiles over the requests of all trials
+    get_requests, head_requests, list_requests, bytes_received = np.mean(io_list, axis=0)
+    read_amplification = bytes_received / needed_bytes if needed_bytes > 0 else np.nan
+    io_metrics = [get_requests, head_requests, list_requests, bytes_received] + \
+                 io_stats.latency_percentiles(latencies) + [read_amplification]
+
+    # Fetch and decode time of the chunks the query touches, measured apart (below the cache)
+    if sharded_store is not None:
+        sharded_store.invalidate()
+    fetch_time, decode_time = measure_decode(chunk_store, array_meta, variable, info, prediction['num_chunks'])
+    layout = 'x'.join(str(n) for n in chunks_per_shard) if chunks_per_shard is not None else None
 
     metrics_list = [time_chunk, lon_chunk, lat_chunk, 
                     cpu_time, wall_time, peak_memory, num_chunk, 
-                    chunk_size, array_shape]
+                    prediction['num_chunks'], chunk_size, 
+                    prediction['compressed_bytes'], prediction['decompressed_bytes'], 
+                    array_shape, cache_size] + warm_metrics + [concurrency, network_profile] + io_metrics + \
+                   [codec, fetch_time, decode_time, layout, pyramid_plan] + stream_metrics + \
+                   [handle['open_time'], handle['index_time'], handle_cached,
+                    handle['metadata_time'], handle['coords_time'], handle['open_requests']] + sample_metrics
     
     print(f'Time chunk: {time_chunk} - Longitude chunk: {lon_chunk} - Latitude chunk: {lat_chunk} -- ' \
           f'cpu time: {cpu_time:0.2f} sec, wall time: {wall_time:0.2f} sec, ' \
-          f'peak mem: {peak_memory:0.2f} MiB, num chunks: {num_chunk}, ' \
-          f'chunk size: {chunk_size:0.2f} B,  array shape: {array_shape}' )
-
-    return metrics_list
-
-def create_batches(all_strategies: List[str], n_workers: int = 1) -> Tuple[List[str]]:
-    n_strategies = len(all_strategies)
-    batch_size = n_strategies // n_workers
-    remainder = n_strategies % n_workers
-    batched_strategies = []
-    for batch_i in range(n_workers):
-        idx_i = batch_i*batch_size
-        idx_j = (batch_i + 1) * batch_size
-        strategy_i = all_strategies[idx_i : idx_j]
-        batched_strategies.append(strategy_i)
-    
-    if remainder:
-        strategy_remainder = all_strategies[idx_j:]
-        assert remainder == len(strategy_remainder)
-
-        for i, strat_r in enumerate(strategy_remainder):
-            worker_index = i % n_workers
-            batched_strategies[worker_index].append(strat_r)
-
-    return batched_strategies
-
-def worker_fxn(i, strategies, dataset, variable, metrics, 
-               task, date, lat, lon, method, num_trials, 
-               avg_aggregate):
-    for data_path in strategies:  
-        metrics_list = measure_strategy(data_path, dataset, variable, 
-                                        task=task, date=date, lat=lat, 
-                                        lon=lon, method=method, 
-                                        num_trials=num_trials, 
-                                        avg_aggregate=avg_aggregate)        
-        metrics['time_chunks'] = metrics['time_chunks'] + [metrics_list[0]]
-        metrics['lon_chunks'] = metrics['lon_chunks'] + [metrics_list[1]]
-        metrics['lat_chunks'] = metrics['lat_chunks'] + [metrics_list[2]]
-        metrics['cpu_times'] = metrics['cpu_times'] + [metrics_list[3]]
-        metrics['wall_times'] = metrics['wall_times'] + [metrics_list[4]]
-        metrics['peak_memories'] = metrics['peak_memories'] + [metrics_list[5]]
-        metrics['num_chunks'] = metrics['num_chunks'] + [metrics_list[6]]
-        metrics['chunk_sizes'] = metrics['chunk_sizes'] + [metrics_list[7]]
-        metrics['array_shape'] = metrics['array_shape'] + [metrics_list[8]]
-
-def run(all_strategies, savename, dataset, variable, 
-        task='time', date=None, lat=None, lon=None, 
-        method=None, num_trials=1, avg_aggregate=False):
-    manager = mp.Manager()
-    metrics = manager.dict()
-    metrics['time_chunks'] = []
-    metrics['lon_chunks'] = []
-    metrics['lat_chunks'] = []
-    metrics['cpu_times'] = []
-    metrics['wall_times'] = []
-    metrics['peak_memories'] = []
-    metrics['num_chunks'] = []
-    metrics['chunk_sizes'] = []
-    metrics['array_shape'] = []
-
-    # Create batches of filenames
-    batched_strategies = create_batches(all_strategies, n_workers=N_WORKERS)
-
-    # Run workers, update metrics dict
-    processes = []
-    for worker_i, strategies in enumerate(batched_strategies):
-        proc = mp.Process(target=worker_fxn, args=(worker_i, strategies,
-                                   dataset, variable, metrics, task, date, 
-                                   lat, lon, method, num_trials, avg_aggregate))
-        proc.start()
-        processes.append(proc)
-
-    [p.join() for p in processes]
-    print('Finished measuring all strategies.')
-
-    print('Saving data.')
-
-    metrics_df = pd.DataFrame(dict(metrics))
-    metrics_df.to_csv(f'data/{dataset}/performance_data/{savename}_metrics_ntrials{num_trials}.csv')
+          f'peak mem: {peak_memory:0.2f} MiB, num chunks: {num_chunk} (predicted {prediction["num_chunks"]}), ' \
+          f'chunk size: {chunk_size:0.2f} B, predicted fetch: {prediction["compressed_bytes"]:0.0f} B, ' \
+          f'array shape: {array_shape}, concurrency: {concurrency}' )
+    print(f'  requests: {get_requests:0.0f} GET, {head_requests:0.0f} HEAD, {list_requests:0.0f} LIST -- '
+          f'received: {bytes_received:0.0f} B, read amplification: {read_amplification:0.2f}, '
+          f'latency p50/p95/p99: {io_metrics[4]:0.4f}/{io_metrics[5]:0.4f}/{io_metrics[6]:0.4f} sec')
+    print(f'  {len(wall_time_list)} trials ({warmup} warmup) -- wall time median: {wall_summary["median"]:0.3f} sec, '
+          f'p95: {wall_summary["p95"]:0.3f} sec, std: {wall_summary["std"]:0.3f} sec, '
+          f'{sampling.CONFIDENCE:0.0%} CI: [{wall_summary["ci_low"]:0.3f}, {wall_summary["ci_high"]:0.3f}] sec')
+    print(f'  open time: {handle["open_time"]:0.3f} sec (metadata: {handle["metadata_time"]:0.3f} sec, '
+          f'coordinates: {handle["coords_time"]:0.3f} sec, index: {handle["index_time"]:0.4f} sec, '
+          f'{handle["open_requests"]} GET, {"reused" if handle_cached else "opened"})')
+    print(f'  codec: {codec} -- fetch time: {fetch_time:0.3f} sec, decode time: {decode_time:0.3f} sec, '
+          f'chunks per shard: {layout}')
+    if pyramid_plan is not None:
+        print(f'  pyramid plan (cells read per level): {pyramid_plan}')
+    if stream_info is not None:
+        print(f'  streaming ({stream_block_size} MiB blocks): wall time: {stream_metrics[2]:0.2f} sec, '
+              f'peak mem: {stream_metrics[3]:0.2f} MiB')
+    if cache is not None:
+        warm_wall_time, cache_hits, cache_misses = warm_metrics[1], warm_metrics[3], warm_metrics[4]
+        print(f'  warm ({cache_size} MiB cache): wall time: {warm_wall_time:0.2f} sec, '
+              f'cache hits: {cache_hits:0.0f}, misses: {cache_misses:0.0f}')
+
+    # Sizes of the full dimensions, for the results store to record 'all' chunks as numbers
+    dim_sizes = {f'{dim}_chunks': int(size) for dim, size in handle['select_data'].sizes.items()}
+    return metrics_list, dim_sizes
+
+def get_max_workers(max_workers=None, mem_per_worker=None):
+    # Memory, not CPU, limits how many strategies can be measured at once:
+    # cap the pool so that each worker gets mem_per_worker GiB of the available memory
+    n_workers = max_workers or mp.cpu_count()
+    if mem_per_worker is not None:
+        available_gib = psutil.virtual_memory().available / 2**30
+        n_workers = min(n_workers, max(1, int(available_gib // mem_per_worker)))
+    return n_workers
+
+def load_completed(savepath, key_columns=CHUNK_COLUMNS):
+    # Strategies (and sweep settings) already measured by an earlier (possibly crashed) run of the same sweep
+    if not os.path.exists(savepath):
+        return set()
+    metrics_df = pd.read_csv(savepath, index_col=0, dtype={c: str for c in key_columns})
+    return set(metrics_df[key_columns].itertuples(index=False, name=None))
+
+def append_metrics(savepath, metrics_list, row_index):
+    # Stream one strategy's row to disk as soon as it is measured
+    metrics_df = pd.DataFrame([metrics_list], columns=METRIC_COLUMNS, index=[row_index])
+    metrics_df.to_csv(savepath, mode='a', header=not os.path.exists(savepath))
+
+def make_query(savename, task='time', date=None, lat=None, lon=None, method=None, avg_aggregate=False):
+    # One query of a sweep; savename names its CSV and its task in the results store
+    return {'savename': savename, 'task': task, 'date': date, 'lat': lat, 'lon': lon,
+            'method': method, 'avg_aggregate': avg_aggregate}
+
+def measure_queries(data_path, query_list, dataset, variable, **kwargs):
+    # Measure several queries on one strategy, one after another in this worker: the first opens
+    # the store, the others reuse its handle (handles.HANDLES), so the open cost is paid once
+    # per strategy; (metrics_list, dim_sizes) of each query (see measure_strategy()), None for a
+    # query that failed, so that the others are still recorded
+    results = []
+    for query in query_list:
+        query_kwargs = {key: value for key, value in query.items() if key != 'savename'}
+        try:
+            results.append(measure_strategy(data_path, dataset, variable, **query_kwargs, **kwargs))
+        except Exception as e:
+            print(f'Failed to measure {query["savename"]} on {data_path}: {e!r}')
+            results.append(None)
+    return results
+
+def run(all_strategies, query_list, dataset, variable, num_trials=1,
+        max_workers=None, mem_per_worker=None, cache_size=None, concurrency=None,
+        network_profile=None, codec=None, shard=None, use_pyramid=False, stream_block_size=None,
+        metadata_cache_dir=None, warmup=0, max_trials=None, target_rel_ci=None):
+    # query_list: list of make_query(), all measured on every strategy by the same worker (see
+    # measure_queries()), each into its own CSV
+    # concurrency: list of fetch concurrency levels, each strategy is measured at every level;
+    # None reads through dask's default path
+    # Every strategy's row is also appended to the results store of the dataset (see
+    # modules/results_store.py) under the query's savename and the sweep settings
+    sweep_params = {'codec': codec, 'shard': shard, 'network_profile': network_profile, 'cache_size': cache_size,
+                    'use_pyramid': use_pyramid, 'stream_block_size': stream_block_size}
+    results_path = results_store.get_results_path(dataset)
+    run_id = results_store.new_run_id()
+    suffix = ''
+    if codec is not None:
+        suffix = f'{suffix}_{codec}'
+    if shard is not None:
+        suffix = f"{suffix}_shard{shard.replace(',', 'x')}"
+    if network_profile is not None:
+        suffix = f'{suffix}_{network_profile}'
+    if cache_size is not None:
+        suffix = f'{suffix}_cache{cache_size:g}MiB'
+    if use_pyramid:
+        suffix = f'{suffix}_pyramid'
+    if stream_block_size is not None:
+        suffix = f'{suffix}_stream{stream_block_size:g}MiB'
+    key_columns = CHUNK_COLUMNS
+    if concurrency is not None:
+        suffix = f'{suffix}_concurrency'
+        key_columns = CHUNK_COLUMNS + ['concurrency']
+    savepaths = [f"data/{dataset}/performance_data/{query['savename']}{suffix}_metrics_ntrials{num_trials}.csv"
+                 for query in query_list]
+
+    # Resume the sweep: skip the queries that already have a row for a strategy in their savepath
+    completed = [load_completed(savepath, key_columns) for savepath in savepaths]
+    pending = {}
+    for level in concurrency or [None]:
+        for data_path in all_strategies:
+            key = parse_strategy(data_path) + ((str(level),) if concurrency is not None else ())
+            query_ids = [query_i for query_i in range(len(query_list)) if key not in completed[query_i]]
+            if query_ids:
+                pending[(data_path, level)] = query_ids
+    for savepath, completed_i in zip(savepaths, completed):
+        if completed_i:
+            print(f'Skipping {len(completed_i)} measurements already saved in {savepath}')
+
+    n_workers = get_max_workers(max_workers, mem_per_worker)
+    print(f'Num workers: {n_workers}')
+
+    # One strategy (with all its pending queries) per task, so an idle worker picks up the next
+    # strategy as soon as it finishes instead of waiting on a static batch
+    row_indexes = [len(completed_i) for completed_i in completed]
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {}
+        for (data_path, level), query_ids in pending.items():
+            future = executor.submit(measure_queries, data_path, [query_list[query_i] for query_i in query_ids],
+                                     dataset, variable, num_trials=num_trials, cache_size=cache_size,
+                                     concurrency=level, network_profile=network_profile,
+                                     use_pyramid=use_pyramid, stream_block_size=stream_block_size,
+                                     metadata_cache_dir=metadata_cache_dir, warmup=warmup,
+                                     max_trials=max_trials, target_rel_ci=target_rel_ci)
+            futures[future] = (data_path, level, query_ids)
+
+        for future in as_completed(futures):
+            data_path, level, query_ids = futures[future]
+            try:
+                results = future.result()
+            except Exception as e:
+                print(f'Failed to measure {data_path}: {e!r}')
+                continue
+            for query_i, result in zip(query_ids, results):
+                if result is None:
+                    continue
+                metrics_list, dim_sizes = result
+                append_metrics(savepaths[query_i], metrics_list, row_indexes[query_i])
+                row_indexes[query_i] += 1
+                # The CSV row is saved; a row the results store rejects is reported, not fatal
+                try:
+                    results_store.append_measurement(results_path, run_id, query_list[query_i]['savename'],
+                                                     {**sweep_params, 'concurrency': level},
+                                                     dict(zip(METRIC_COLUMNS, metrics_list)), dim_sizes)
+                except Exception as e:
+                    print(f'Failed to add {data_path} ({query_list[query_i]["savename"]}) '
+                          f'to {results_path}: {e!r}')
 
-def main():
+    print('Finished measuring all strategies.')
+    print(f"Saved data in {', '.join(savepaths)} and {results_path} (run {run_id})")
+
+def setup_args():
+    parser = argparse.ArgumentParser(description="Measure read performance of chunking strategies")
+    parser.add_argument('--store_url', type=str, default=None,
+                        help='Folder holding one sub-folder per strategy, e.g. s3://bucket/prefix, '
+                             's3+http://localhost:9000/bucket/prefix, file:///data/rechunked or memory://rechunked. '
+                             'Defaults to the rechunked archive on S3')
+    parser.add_argument('--max_workers', type=int, default=None,
+                        help='Max number of strategies measured concurrently. Defaults to the CPU count')
+    parser.add_argument('--mem_per_worker', type=float, default=None,
+                        help='Memory (GiB) to reserve per worker; caps the number of workers by available memory')
+    parser.add_argument('--cache_size', type=float, default=None,
+                        help='Size (MiB) of an LRU chunk cache in front of each store; '
+                             'measures every strategy cold (cache emptied) and warm (cache primed)')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=None,
+                        help='Fetch the chunks of each query with this many requests in flight; '
+                             'several levels, e.g. "--concurrency 1 8 64", measure every strategy at each level')
+    parser.add_argument('--codec', type=str, default=None,
+                        help='Codec of the sweep to measure, as passed to rechunk_single.py --codec; '
+                             'reads the strategies under <dataset>_<codec>')
+    parser.add_argument('--shard', type=str, default=None,
+                        help='Shard layout of the sweep to measure, as passed to rechunk_single.py --shard; '
+                             'reads the strategies under <dataset>_shard<time>x<x>x<y>')
+    parser.add_argument('--pyramid', action='store_true',
+                        help='Answer aggregate queries from the aggregate pyramid of each store '
+                             '(rechunk/build_pyramid.py) instead of the raw data')
+    parser.add_argument('--stream_block_size', type=float, default=None,
+                        help='Also measure aggregate queries reduced block by block, loading blocks of whole chunks '
+                             'of up to this size (MiB) at a time')
+    parser.add_argument('--network_profile', type=str, default=None, choices=list(netsim.NETWORK_PROFILES),
+                        help='Simulate the latency, bandwidth, connection limit and throttling of this '
+                             'network profile (modules/netsim.py), e.g. for local stores')
+    parser.add_argument('--num_trials', type=int, default=1,
+                        help='Trials per strategy (at least, with --target_rel_ci)')
+    parser.add_argument('--warmup', type=int, default=0,
+                        help='Executions run and discarded before the trials of each strategy')
+    parser.add_argument('--target_rel_ci', type=float, default=None,
+                        help='Run trials until the 95%% confidence interval of the median wall time is within '
+                             'this fraction of it (e.g. 0.05), or --max_trials are run. The interval is only '
+                             f'checked from {sampling.MIN_CI_TRIALS} trials on')
+    parser.add_argument('--max_trials', type=int, default=20,
+                        help='Max trials per strategy with --target_rel_ci')
+    parser.add_argument('--metadata_cache', type=str, default=None,
+                        help='Local folder caching the consolidated metadata and coordinate arrays of each store, '
+                             'shared by all workers and validated against the store (modules/metadata_cache.py)')
+    return parser.parse_args()
+
+def main(args):
     #------ Set up paths ------#
     bucket = 'eis-dh-fire'
     dataset = 'geos-fp-global_inst'
-    folder = f'dieumynguyen_rechunked/{dataset}/'
+    sweep = dataset
+    if args.codec is not None:
+        # Written by rechunk_single.py --codec
+        sweep = f'{sweep}_{args.codec}'
+    if args.shard is not None:
+        # Written by rechunk_single.py --shard
+        sweep = f"{sweep}_shard{args.shard.replace(',', 'x')}"
+    folder = f'dieumynguyen_rechunked/{sweep}/'
+    store_url = args.store_url or f's3://{bucket}/{folder}'
     
     #------ Choose a variable ------#
     archive = 'inst'
     variable = 'BCEXTTAU' 
 
-    #------ Find all data folders in bucket ------#
-    client = boto3.client('s3')
-    result = client.list_objects(Bucket=bucket, Prefix=folder, Delimiter='/')
-
-    all_strategies = []
-    for prefix in result.get('CommonPrefixes'):
-        folder_path = prefix.get('Prefix')
-        folder_path = os.path.join(bucket, folder_path, f'{archive}.zarr/')
-        all_strategies.append(folder_path)
+    #------ Find all data folders in store ------#
+    all_strategies = stores.list_strategies(store_url, archive)
 
     print(f'Num of strategies: {len(all_strategies)}')
 
     #------ Choose a task ------#
     # 0: time series, 1: time series over region, 2: map over time, 3: map over 1 timestep
     TASK = 2
-    num_trials = 1
+    num_trials = args.num_trials
     print(f'Num trials: {num_trials}')
 
+    #------ Worker pool options ------#
+    run_kwargs = {
+        'max_workers': args.max_workers,
+        'mem_per_worker': args.mem_per_worker,
+        'cache_size': args.cache_size,
+        'concurrency': args.concurrency,
+        'network_profile': args.network_profile,
+        'codec': args.codec,
+        'shard': args.shard,
+        'use_pyramid': args.pyramid,
+        'stream_block_size': args.stream_block_size,
+        'metadata_cache_dir': args.metadata_cache,
+        'warmup': args.warmup,
+        'max_trials': args.max_trials,
+        'target_rel_ci': args.target_rel_ci,
+    }
+
     #------ Run task ------#
+    # Every query of a task is measured on a strategy by the same worker, which opens the
+    # strategy's store once for all of them (see measure_queries())
     if TASK == 0:
         print(f'Drawing time series at single coordinate.')
         lat = 47.61
         lon = -122.19
         method = 'nearest'
-        run(all_strategies, 'time_series', dataset, variable, 
-            task='time', date=None, lat=lat, lon=lon, method=method, 
-            num_trials=num_trials, avg_aggregate=False)
+        query_list = [make_query('time_series', task='time', date=None, lat=lat, lon=lon, method=method,
+                                 avg_aggregate=False)]
 
     elif TASK == 1:
-        # BBox CSV format from: https://boundingbox.klokantech.com/
-        bbox_dict = {
-            'ohio':          [-84.91,38.21,-80.5,42.25],
-            'california':    [-124.92,32.64,-114.25,42.11],
-            'usa':           [-124.9,24.9,-66.7,49.4],
-            'north_america': [-168.0,15.3,-53.0,71.3]
-        }
-        bbox_type = 'north_america'
-        print(f'Drawing time series over region: {bbox_type}.')
-        bbox = bbox_dict[bbox_type] 
-        lon_slice = slice(bbox[0], bbox[2])
-        lat_slice = slice(bbox[1], bbox[3])
-        run(all_strategies, f'time_series_over_region_{bbox_type}', 
-            dataset, variable, task='time', date=None, 
-            lat=lat_slice, lon=lon_slice, method=None, 
-            num_trials=num_trials, avg_aggregate=True)
+        print(f'Drawing time series over regions: {", ".join(queries.REGIONS)}.')
+        query_list = []
+        for bbox_type, bbox in queries.REGIONS.items():
+            lon_slice = slice(bbox[0], bbox[2])
+            lat_slice = slice(bbox[1], bbox[3])
+            query_list.append(make_query(f'time_series_over_region_{bbox_type}', task='time', date=None,
+                                         lat=lat_slice, lon=lon_slice, method=None, avg_aggregate=True))
 
     elif TASK == 2:
-        time_dict = {
-            '6_hr':    ('2020-06-01T00', '2020-06-01T05'),
-            '12_hr':   ('2020-06-01T00', '2020-06-01T11'),
-            '1_day':   ('2020-06-01', '2020-06-01'),
-            '2_day':   ('2020-06-01', '2020-06-02'),
-            '7_day':   ('2020-06-01', '2020-06-07'),
-            '30_day':  ('2020-06-01', '2020-06-30'),
-            '60_day':  ('2020-06-01', '2020-07-30'),
-            '180_day': ('2020-06-01', '2020-11-27'),
-        }
-        time_type = '180_day'
-        print(f'Drawing map over time: {time_type}.')
-        time_range = time_dict[time_type]
-        date_start = time_range[0]
-        date_end = time_range[1]
-        time_bounds = slice(date_start, date_end)
-        run(all_strategies, f'map_over_time_{time_type}', dataset, variable, 
-            task='map', date=time_bounds, lat=None, lon=None, method=None, 
-            num_trials=num_trials, avg_aggregate=True)
+        print(f'Drawing map over time: {", ".join(queries.TIME_WINDOWS)}.')
+        query_list = []
+        for time_type, time_range in queries.TIME_WINDOWS.items():
+            date_start = time_range[0]
+            date_end = time_range[1]
+            time_bounds = slice(date_start, date_end)
+            query_list.append(make_query(f'map_over_time_{time_type}', task='map', date=time_bounds,
+                                         lat=None, lon=None, method=None, avg_aggregate=True))
     
     elif TASK == 3:
         print(f'Drawing map at one timestep.')
         date = '2020-06-01'
-        run(all_strategies, 'map_one_timestep', dataset, variable, 
-            task='map_one_timestep', date=date, lat=None, lon=None, method=None, 
-            num_trials=num_trials, avg_aggregate=False)
+        query_list = [make_query('map_one_timestep', task='map_one_timestep', date=date, lat=None, lon=None,
+                                 method=None, avg_aggregate=False)]
+
+    run(all_strategies, query_list, dataset, variable, num_trials=num_trials, **run_kwargs)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    args = setup_args()
+    main(args)
\ No newline at end of file
@@ -0,0 +1,127 @@
+import argparse
+import numpy as np
+import pandas as pd
+
+import modules.stores as stores
+import modules.cost_model as cost_model
+import modules.router as router
+import modules.netsim as netsim
+import modules.footprint as footprint
+import modules.handles as handles
+import measure_performance
+
+# Query mix served by the router: weight (share of requests) and selection of each query,
+# same selections as the tasks in measure_performance.main()
+QUERY_MIX = {
+    'time_series':                           (0.4, dict(task='time', date=None, lat=47.61, lon=-122.19,
+                                                        method='nearest', avg_aggregate=False)),
+    'time_series_over_region_north_america': (0.1, dict(task='time', date=None, lat=slice(15.3, 71.3),
+                                                        lon=slice(-168.0, -53.0), method=None, avg_aggregate=True)),
+    'map_over_time_7_day':                   (0.2, dict(task='map', date=slice('2020-06-01', '2020-06-07'),
+                                                        lat=None, lon=None, method=None, avg_aggregate=True)),
+    'map_one_timestep':                      (0.3, dict(task='map_one_timestep', date='2020-06-01',
+                                                        lat=None, lon=None, method=None, avg_aggregate=False)),
+}
+
+def setup_args():
+    parser = argparse.ArgumentParser(description="Benchmark a query router over several chunking strategies")
+    parser.add_argument('--store_url', type=str, default=None,
+                        help='Folder holding one sub-folder per strategy (any store URL, see measure_performance.py). '
+                             'Defaults to the rechunked archive on S3')
+    parser.add_argument('--layouts', type=str, nargs='+', default=None,
+                        help='Strategies kept as layouts, e.g. "time5136_lat0010_lon0010 time0001_lat0721_lon1152". '
+                             'Defaults to all strategies')
+    parser.add_argument('--num_trials', type=int, default=3, help='Executions per query and layout')
+    parser.add_argument('--latency', type=float, default=cost_model.REQUEST_LATENCY,
+                        help='Per-request latency (sec) assumed by the router')
+    parser.add_argument('--bandwidth', type=float, default=cost_model.BANDWIDTH,
+                        help='Bandwidth (byte/sec) assumed by the router')
+    parser.add_argument('--concurrency', type=int, default=1, help='Requests in flight assumed by the router')
+    parser.add_argument('--network_profile', type=str, default=None, choices=list(netsim.NETWORK_PROFILES),
+                        help='Simulate this network profile (modules/netsim.py) on every store')
+    return parser.parse_args()
+
+def get_layout_name(strategy_url):
+    # Strategy folder, e.g. .../time0048_lat0010_lon0100/inst.zarr/ -> time0048_lat0010_lon0100
+    return strategy_url.rstrip('/').split('/')[-2]
+
+def measure_query(select_data, coord_indexes, query, num_trials):
+    # Mean wall time and peak memory of the query on one layout
+    # Units: sec, Mebibyte
+    info = {'select_data': select_data, 'coord_indexes': coord_indexes, **query}
+    wall_times = []
+    peak_memories = []
+    for n in range(num_trials):
+        _, wall_time, peak_memory, _ = measure_performance.measure_execution(info)
+        wall_times.append(wall_time)
+        peak_memories.append(peak_memory)
+    return np.mean(wall_times), np.mean(peak_memories)
+
+def blend(query_df, column):
+    # Request-weighted mean of a per-query metric
+    return float(np.average(query_df[column], weights=query_df['weight']))
+
+def main(args):
+    dataset = 'geos-fp-global_inst'
+    archive = 'inst'
+    variable = 'BCEXTTAU'
+
+    store_url = args.store_url or f's3://eis-dh-fire/dieumynguyen_rechunked/{dataset}/'
+    layouts = {get_layout_name(url): url for url in stores.list_strategies(store_url, archive)}
+    if args.layouts is not None:
+        layouts = {name: layouts[name] for name in args.layouts}
+    print(f'Layouts: {list(layouts)}')
+
+    layout_router = router.LayoutRouter(layouts, variable, request_latency=args.latency,
+                                        bandwidth=args.bandwidth, concurrency=args.concurrency)
+
+    # Every query is measured on every layout, so the router can be compared with each single layout
+    select_data = {}
+    coord_indexes = {}
+    for name, url in layouts.items():
+        store = stores.get_mapper(url)
+        if args.network_profile is not None:
+            store = netsim.SimulatedStore(store, **netsim.NETWORK_PROFILES[args.network_profile])
+        select_data[name] = measure_performance.open_variable(store, variable)
+        coord_indexes[name] = handles.build_indexes(select_data[name])
+
+    rows = []
+    for query_name, (weight, query) in QUERY_MIX.items():
+        selection = {k: v for k, v in query.items() if k != 'avg_aggregate'}
+        costs = layout_router.estimate(**selection)
+        served_by = layout_router.route(**selection)
+        print(f'{query_name}: served by {served_by}')
+        for name in layouts:
+            wall_time, peak_memory = measure_query(select_data[name], coord_indexes[name], query,
+                                                   args.num_trials)
+            rows.append({'query': query_name, 'weight': weight, 'layout': name, 'pred_cost': costs[name],
+                         'wall_times': wall_time, 'peak_memories': peak_memory, 'served': name == served_by})
+            print(f'  {name}: predicted {costs[name]:0.3f} sec, wall time: {wall_time:0.3f} sec')
+    queries_df = pd.DataFrame(rows)
+
+    # Blended latency of the router and of each layout alone; storage multiplier of keeping
+    # all layouts, relative to the best single layout
+    sizes = {name: sum(footprint.list_object_sizes(url).values()) for name, url in layouts.items()}
+    summary = []
+    for name in layouts:
+        layout_df = queries_df[queries_df['layout'] == name]
+        summary.append({'layout': name, 'blended_wall_time': blend(layout_df, 'wall_times'),
+                        'archive_size': sizes[name]})
+    summary_df = pd.DataFrame(summary).sort_values(by='blended_wall_time').reset_index(drop=True)
+    best = summary_df.iloc[0]
+    routed_df = queries_df[queries_df['served']]
+    routed = {'layout': 'router', 'blended_wall_time': blend(routed_df, 'wall_times'),
+              'archive_size': sum(sizes.values())}
+    summary_df = pd.concat([pd.DataFrame([routed]), summary_df], ignore_index=True)
+    summary_df['storage_multiplier'] = summary_df['archive_size'] / best['archive_size']
+    summary_df['speedup'] = best['blended_wall_time'] / summary_df['blended_wall_time']
+    print(summary_df.to_string())
+
+    savepath = f'data/{dataset}/performance_data/router'
+    queries_df.to_csv(f'{savepath}_queries.csv')
+    summary_df.to_csv(f'{savepath}_summary.csv')
+    print(f'Saved data in {savepath}_queries.csv and {savepath}_summary.csv')
+
+if __name__ == '__main__':
+    args = setup_args()
+    main(args)
@@ -0,0 +1,108 @@
+import threading
+from collections import OrderedDict
+from zarr.storage import Store
+
+class ChunkCache(Store):
+    # Least-recently-used cache of store values (chunks and metadata), bounded in bytes,
+    # in front of a key/value store such as the mapper from stores.get_mapper()
+    # Read path only: writes go to the store and drop the cached value
+    def __init__(self, store, max_bytes):
+        self._store = store
+        self.max_bytes = int(max_bytes)
+        self.current_bytes = 0
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'cached_bytes': self.current_bytes}
+
+    def invalidate(self):
+        # Empty the cache, e.g. before a cold measurement
+        with self._lock:
+            self._values.clear()
+            self.current_bytes = 0
+
+    def _get_cached(self, key):
+        # Called with the lock held
+        value = self._values[key]
+        self._values.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def _cache_value(self, key, value):
+        with self._lock:
+            self.misses += 1
+            size = len(value)
+            # A value larger than the whole cache would only flush it
+            if size > self.max_bytes or key in self._values:
+                return
+            while self.current_bytes + size > self.max_bytes:
+                _, evicted = self._values.popitem(last=False)
+                self.current_bytes -= len(evicted)
+                self.evictions += 1
+            self._values[key] = value
+            self.current_bytes += size
+
+    def __getitem__(self, key):
+        with self._lock:
+            if key in self._values:
+                return self._get_cached(key)
+        # Fetch outside of the lock, so that misses of several threads overlap
+        value = self._store[key]
+        self._cache_value(key, value)
+        return value
+
+    def getitems(self, keys, *, contexts=None):
+        # Used by zarr to read all chunks of a selection: only the misses are fetched,
+        # in one concurrent request batch when the store supports it (fsspec mappers do)
+        values = {}
+        with self._lock:
+            for key in keys:
+                if key in self._values:
+                    values[key] = self._get_cached(key)
+        missing = [key for key in keys if key not in values]
+        if not missing:
+            return values
+        if hasattr(self._store, 'getitems'):
+            fetched = self._store.getitems(missing, on_error='omit')
+        else:
+            fetched = {key: self._store[key] for key in missing if key in self._store}
+        # Keys absent from the store are chunks never written (fill value): also a miss
+        with self._lock:
+            self.misses += len(missing) - len(fetched)
+        for key, value in fetched.items():
+            self._cache_value(key, value)
+        values.update(fetched)
+        return values
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._values:
+                return True
+        return key in self._store
+
+    def __setitem__(self, key, value):
+        self._store[key] = value
+        self._drop(key)
+
+    def __delitem__(self, key):
+        del self._store[key]
+        self._drop(key)
+
+    def _drop(self, key):
+        with self._lock:
+            if key in self._values:
+                self.current_bytes -= len(self._values.pop(key))
+
+    def __iter__(self):
+        return iter(self._store)
+
+    def __len__(self):
+        return len(self._store)
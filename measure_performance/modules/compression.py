@@ -0,0 +1,43 @@
+import numcodecs
+from numcodecs import Blosc
+
+# Codec specs, shared by rechunking (output encoding) and benchmarks (labels):
+# 'none' or '<cname>-<clevel>-<shuffle>' for Blosc, e.g. 'lz4-5-shuffle', 'zstd-9-bitshuffle', 'zlib-1-noshuffle'
+SHUFFLES = {
+    'noshuffle':  Blosc.NOSHUFFLE,
+    'shuffle':    Blosc.SHUFFLE,
+    'bitshuffle': Blosc.BITSHUFFLE,
+}
+
+def parse_codec(spec):
+    # Compressor of a codec spec, None for no compression
+    if spec == 'none':
+        return None
+    cname, clevel, shuffle = spec.split('-')
+    return Blosc(cname=cname, clevel=int(clevel), shuffle=SHUFFLES[shuffle])
+
+def describe_codec(compressor, filters=None):
+    # Codec spec of a zarr array's compressor and filters configs (from .zarray)
+    if compressor is None:
+        label = 'none'
+    elif compressor['id'] == 'blosc':
+        shuffle = {value: name for name, value in SHUFFLES.items()}.get(compressor['shuffle'], compressor['shuffle'])
+        label = f"{compressor['cname']}-{compressor['clevel']}-{shuffle}"
+    elif 'level' in compressor:
+        label = f"{compressor['id']}-{compressor['level']}"
+    else:
+        label = compressor['id']
+    for codec_filter in filters or []:
+        label = f"{label}+{codec_filter['id']}"
+    return label
+
+def get_decoders(compressor, filters=None):
+    # Codecs that turn a stored chunk back into its array bytes, in decoding order
+    decoders = [numcodecs.get_codec(compressor)] if compressor is not None else []
+    decoders += [numcodecs.get_codec(codec_filter) for codec_filter in reversed(filters or [])]
+    return decoders
+
+def decode(decoders, value):
+    for decoder in decoders:
+        value = decoder.decode(value)
+    return value
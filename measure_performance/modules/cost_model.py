@@ -0,0 +1,143 @@
+import json
+import itertools
+import numpy as np
+import pandas as pd
+
+# Object store assumptions used to turn chunk counts and bytes into a cost
+# Units: sec per request, byte per sec
+REQUEST_LATENCY = 0.02
+BANDWIDTH = 100e6
+
+def read_array_meta(mapper, variable):
+    # Zarr array metadata (shape, chunks, dtype, compressor, ...), from the consolidated metadata if present
+    try:
+        return json.loads(mapper['.zmetadata'])['metadata'][f'{variable}/.zarray']
+    except KeyError:
+        return json.loads(mapper[f'{variable}/.zarray'])
+
+def index_range(index, value, method=None):
+    # Positions [start, stop) of a label-based selection on one dimension
+    if value is None:
+        return 0, len(index)
+    if isinstance(value, slice):
+        loc = index.slice_indexer(value.start, value.stop)
+        return int(loc.start), int(loc.stop)
+    if method is not None:
+        pos = int(index.get_indexer([value], method=method)[0])
+        return pos, pos + 1
+    loc = index.get_loc(value)
+    if isinstance(loc, slice):
+        return int(loc.start), int(loc.stop)
+    return int(loc), int(loc) + 1
+
+def selection_ranges(select_data, task, date, lat, lon, method, coord_indexes=None):
+    # Index ranges read from the stored array by each execute() task, in select_data.dims order
+    # Mirrors select() in measure_performance.py, but only looks at the coordinate indexes
+    # coord_indexes: prebuilt {dim: handles.CoordIndex}, instead of the pandas indexes
+    def lookup(dim, value, method=None):
+        if coord_indexes is not None:
+            return coord_indexes[dim].index_range(value, method)
+        return index_range(select_data.indexes[dim], value, method)
+
+    if task == 'time':
+        ranges = {
+            'time': (0, select_data.sizes['time']),
+            'lat': lookup('lat', lat, method),
+            'lon': lookup('lon', lon, method),
+        }
+    elif task == 'map':
+        ranges = {
+            'time': lookup('time', date),
+            'lat': (0, select_data.sizes['lat']),
+            'lon': (0, select_data.sizes['lon']),
+        }
+    elif task == 'map_one_timestep':
+        start, _ = lookup('time', date)
+        ranges = {
+            'time': (start, start + 1),
+            'lat': (0, select_data.sizes['lat']),
+            'lon': (0, select_data.sizes['lon']),
+        }
+    return [ranges[dim] for dim in select_data.dims]
+
+def chunk_index_ranges(ranges, chunks):
+    # Chunk indices [first, last] touched along each dimension
+    return [(start // chunk, (stop - 1) // chunk) for (start, stop), chunk in zip(ranges, chunks)]
+
+def count_chunks(ranges, chunks):
+    return int(np.prod([last - first + 1 for first, last in chunk_index_ranges(ranges, chunks)]))
+
+def predict_access(ranges, chunks, itemsize, chunk_sizes=None, compression_ratio=1.0):
+    # Predict chunks touched, compressed bytes fetched and decompressed bytes for one query
+    # Zarr pads edge chunks, so every chunk decompresses to the full chunk shape
+    # chunk_sizes: stored object sizes (bytes) of a sample of the touched chunks, if known
+    num_chunks = count_chunks(ranges, chunks)
+    decompressed_bytes = num_chunks * int(np.prod(chunks)) * itemsize
+    if chunk_sizes:
+        compressed_bytes = num_chunks * float(np.mean(chunk_sizes))
+    else:
+        compressed_bytes = decompressed_bytes / compression_ratio
+    return {
+        'num_chunks': num_chunks,
+        'compressed_bytes': compressed_bytes,
+        'decompressed_bytes': decompressed_bytes,
+    }
+
+def touched_chunk_keys(variable, ranges, chunks, separator='.', max_keys=1000, seed=0):
+    # Keys of the chunks touched by a query; a random sample if there are more than max_keys
+    index_ranges = [np.arange(first, last + 1) for first, last in chunk_index_ranges(ranges, chunks)]
+    grid_shape = [len(idx) for idx in index_ranges]
+    num_chunks = int(np.prod(grid_shape))
+    if num_chunks <= max_keys:
+        positions = itertools.product(*index_ranges)
+    else:
+        rng = np.random.default_rng(seed)
+        flat = rng.choice(num_chunks, size=max_keys, replace=False)
+        positions = zip(*[idx[i] for idx, i in zip(index_ranges, np.unravel_index(flat, grid_shape))])
+    return [f'{variable}/' + separator.join(str(int(i)) for i in pos) for pos in positions]
+
+def chunk_object_sizes(mapper, keys):
+    # Stored (compressed) size of each chunk object from HEAD requests, no data is read
+    # Chunks that were never written (all fill value) have size 0
+    fs = mapper.fs
+    paths = [mapper._key_to_str(key) for key in keys]
+    try:
+        return [int(size) for size in fs.sizes(paths)]
+    except FileNotFoundError:
+        sizes = []
+        for path in paths:
+            try:
+                sizes.append(int(fs.size(path)))
+            except FileNotFoundError:
+                sizes.append(0)
+        return sizes
+
+def estimate_cost(prediction, request_latency=REQUEST_LATENCY, bandwidth=BANDWIDTH, concurrency=1):
+    # Seconds to fetch a query: per-request latency, overlapped across concurrent requests, plus transfer time
+    return prediction['num_chunks'] * request_latency / concurrency + prediction['compressed_bytes'] / bandwidth
+
+def rank_chunk_shapes(dims, queries, candidates, itemsize, compression_ratios=None, default_ratio=1.0,
+                      weights=None, request_latency=REQUEST_LATENCY, bandwidth=BANDWIDTH, concurrency=1):
+    # Rank candidate chunk shapes from metadata alone, without rechunking or reading anything
+    # queries: {name: ranges}, ranges as returned by selection_ranges()
+    # candidates: list of {dim: chunk} dicts
+    # compression_ratios: {chunk tuple: ratio} measured for chunkings that exist, default_ratio otherwise
+    compression_ratios = compression_ratios or {}
+    weights = weights or {name: 1.0 for name in queries}
+    rows = []
+    for candidate in candidates:
+        chunks = tuple(candidate[dim] for dim in dims)
+        ratio = compression_ratios.get(chunks, default_ratio)
+        row = {f'{dim}_chunks': candidate[dim] for dim in dims}
+        row['compression_ratio'] = ratio
+        total_cost = 0
+        for name, ranges in queries.items():
+            prediction = predict_access(ranges, chunks, itemsize, compression_ratio=ratio)
+            cost = estimate_cost(prediction, request_latency, bandwidth, concurrency)
+            row[f'{name}_num_chunks'] = prediction['num_chunks']
+            row[f'{name}_compressed_bytes'] = prediction['compressed_bytes']
+            row[f'{name}_cost'] = cost
+            total_cost += weights.get(name, 0) * cost
+        row['weighted_cost'] = total_cost
+        rows.append(row)
+    return pd.DataFrame(rows).sort_values(by='weighted_cost').reset_index(drop=True)
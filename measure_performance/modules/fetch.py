@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+from zarr.storage import Store
+
+def is_async(store):
+    # Whether the requests of a store end in an async fsspec filesystem (s3, http), which gathers
+    # a batch of requests on one event loop; store layers that pass requests on to the store
+    # below (InstrumentedStore, MetadataCache) tell through their async_impl
+    if hasattr(store, 'async_impl'):
+        return store.async_impl
+    mapper = getattr(store, 'map', store)  # FSStore wraps an fsspec mapper
+    return getattr(getattr(mapper, 'fs', None), 'async_impl', False)
+
+def read_items(store, keys, batch_size=None):
+    # {key: value} of the keys in store, like getitems() (missing keys omitted), with at most
+    # batch_size requests in flight on an async filesystem
+    # Store layers take batch_size themselves and pass it down, so that their requests are still
+    # counted and timed (see modules/io_stats.py)
+    keys = list(keys)
+    if hasattr(store, 'async_impl'):
+        return store.getitems(keys, on_error='omit', batch_size=batch_size)
+    mapper = getattr(store, 'map', store)
+    fs = getattr(mapper, 'fs', None)
+    if fs is not None:
+        paths = [mapper._key_to_str(key) for key in keys]
+        kwargs = {'batch_size': batch_size} if fs.async_impl and batch_size is not None else {}
+        results = fs.cat(paths, on_error='return', **kwargs)
+        values = {}
+        for key, path in zip(keys, paths):
+            value = results.get(path, FileNotFoundError(path))
+            if isinstance(value, FileNotFoundError):
+                continue
+            if isinstance(value, Exception):
+                raise value
+            values[key] = value
+        return values
+    if hasattr(store, 'getitems'):
+        return store.getitems(keys, on_error='omit')
+    return {key: store[key] for key in keys if key in store}
+
+class ConcurrentFetcher(Store):
+    # Fetch layer in front of a store: all chunk keys of a getitems() call (zarr
+    # asks for every chunk of a selection at once) are requested with at most
+    # `concurrency` requests in flight, whatever dask and s3fs would do by themselves
+    def __init__(self, mapper, concurrency):
+        self._mapper = mapper
+        self.concurrency = int(concurrency)
+        self._executor = None
+        if not is_async(mapper):
+            # Blocking filesystems (e.g. local disk) and other stores: one thread per request in flight
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+    def getitems(self, keys, *, contexts=None, on_error='omit'):
+        # Keys that are not in the store (chunks never written) are omitted, as in zarr
+        keys = list(keys)
+        if not keys:
+            return {}
+        if self._executor is None:
+            # Async filesystems (s3, http): one event loop gathers batches of `concurrency` requests
+            return read_items(self._mapper, keys, batch_size=self.concurrency)
+        fetched = self._executor.map(self._fetch, keys)
+        return {key: value for key, value in zip(keys, fetched) if value is not None}
+
+    def _fetch(self, key):
+        try:
+            return self._mapper[key]
+        except KeyError:
+            return None
+
+    def __getitem__(self, key):
+        return self._mapper[key]
+
+    def __contains__(self, key):
+        return key in self._mapper
+
+    def __setitem__(self, key, value):
+        self._mapper[key] = value
+
+    def __delitem__(self, key):
+        del self._mapper[key]
+
+    def __iter__(self):
+        return iter(self._mapper)
+
+    def __len__(self):
+        return len(self._mapper)
@@ -0,0 +1,123 @@
+import json
+import inspect
+import itertools
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import modules.stores as stores
+import modules.sharding as sharding
+
+METADATA_KEYS = ('.zarray', '.zattrs', '.zgroup', '.zmetadata', sharding.LAYOUT_KEY)
+SIZE_QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+# Keys per LIST response of S3
+LIST_PAGE_SIZE = 1000
+
+def chunk_prefixes(array_meta, chunks_per_shard=None, min_prefixes=16):
+    # Key prefixes that split the chunk keys of an array by their leading chunk indexes, e.g.
+    # ['0.', '1.', ...] or ['0/', ...], going as many dimensions deep as it takes to get
+    # min_prefixes of them; shard keys of a sharded array (see modules/sharding.py) by their
+    # leading shard indexes, e.g. ['shards/0.', ...]
+    # [] if the keys cannot be split (1-d arrays), or if there would be more prefixes than pages of
+    # keys to list, i.e. if splitting would take more LIST requests than listing the array at once
+    grid = [int(np.ceil(size / chunk)) for size, chunk in zip(array_meta['shape'], array_meta['chunks'])]
+    separator = array_meta.get('dimension_separator') or '.'
+    key_prefix = ''
+    if chunks_per_shard is not None:
+        grid = [int(np.ceil(n / per_shard)) for n, per_shard in zip(grid, chunks_per_shard)]
+        separator = '.'
+        key_prefix = f'{sharding.SHARD_PREFIX}/'
+    depth = 1
+    while depth < len(grid) - 1 and np.prod(grid[:depth]) < min_prefixes:
+        depth += 1
+    if depth >= len(grid) or np.prod(grid[:depth]) > np.prod(grid) / LIST_PAGE_SIZE:
+        return []
+    return [key_prefix + separator.join(str(i) for i in index) + separator
+            for index in itertools.product(*[range(n) for n in grid[:depth]])]
+
+def _read_json(fs, path):
+    try:
+        return json.loads(fs.cat(path))
+    except FileNotFoundError:
+        return None
+
+def _listings(fs, prefix_path, max_workers):
+    # (folder, key prefix or None) listings that together cover one top-level prefix of a store:
+    # the whole folder, or, for an array on a filesystem that lists by key prefix (S3), its
+    # metadata ('.z*') and its chunk keys split by chunk_prefixes()
+    array_meta = _read_json(fs, f'{prefix_path}/.zarray')
+    if array_meta is None or 'prefix' not in inspect.signature(fs.find).parameters:
+        return [(prefix_path, None)]
+    layout = _read_json(fs, f'{prefix_path}/{sharding.LAYOUT_KEY}')
+    chunks_per_shard = layout['chunks_per_shard'] if layout is not None else None
+    prefixes = chunk_prefixes(array_meta, chunks_per_shard, max_workers)
+    if not prefixes:
+        return [(prefix_path, None)]
+    return [(prefix_path, prefix) for prefix in ['.'] + prefixes]
+
+def list_object_sizes(url, max_workers=16):
+    # {key: size in bytes} of every object of a store, listed by up to max_workers request streams
+    # in parallel: one per top-level prefix (one per array), and, on S3, the keys of each array
+    # split further by their leading chunk indexes, so that the data variable, which holds nearly
+    # every key of a small-chunk strategy, is not listed by a single stream
+    # A zarr array folder holds its metadata ('.z*') and chunk (or shard) keys only
+    fs, path = stores.get_filesystem(url)
+    entries = fs.ls(path, detail=True)
+    sizes = {entry['name'][len(path) + 1:]: entry['size'] for entry in entries if entry['type'] != 'directory'}
+    prefixes = [entry['name'] for entry in entries if entry['type'] == 'directory']
+
+    def find(listing):
+        folder, prefix = listing
+        if prefix is None:
+            return fs.find(folder, detail=True)
+        return fs.find(folder, prefix=prefix, detail=True)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        listings = [listing for prefix_listings in executor.map(lambda prefix: _listings(fs, prefix, max_workers), prefixes)
+                    for listing in prefix_listings]
+        for listing in executor.map(find, listings):
+            for name, entry in listing.items():
+                sizes[name[len(path) + 1:]] = entry['size']
+    return sizes
+
+def is_metadata_key(key):
+    return key.split('/')[-1] in METADATA_KEYS
+
+def analyze_footprint(url, variable, max_workers=16):
+    # Storage footprint of a store and chunk statistics of one of its arrays
+    # Units: byte, except counts and ratios
+    sizes = list_object_sizes(url, max_workers)
+    metadata_sizes = [size for key, size in sizes.items() if is_metadata_key(key)]
+    chunk_sizes = np.array([size for key, size in sizes.items()
+                            if key.startswith(f'{variable}/') and not is_metadata_key(key)])
+
+    # Every stored chunk of a zarr v2 array holds a full chunk, edge chunks included
+    fs, path = stores.get_filesystem(url)
+    array_meta = json.loads(fs.cat(f'{path}/{variable}/.zarray'))
+    chunk_nbytes = int(np.prod(array_meta['chunks'])) * np.dtype(array_meta['dtype']).itemsize
+    n_expected = int(np.prod([int(np.ceil(s / c)) for s, c in zip(array_meta['shape'], array_meta['chunks'])]))
+
+    footprint = {
+        'archive_size': int(sum(sizes.values())),
+        'num_objects': len(sizes),
+        'metadata_size': int(sum(metadata_sizes)),
+        'metadata_objects': len(metadata_sizes),
+        'num_chunks': len(chunk_sizes),
+        'num_chunks_expected': n_expected,
+        'chunk_nbytes': chunk_nbytes,
+    }
+    if len(chunk_sizes) == 0:
+        return footprint
+    ratios = chunk_nbytes / chunk_sizes
+    footprint.update({
+        'chunk_size_mean': chunk_sizes.mean(),
+        'chunk_size_min': chunk_sizes.min(),
+        'chunk_size_max': chunk_sizes.max(),
+        **{f'chunk_size_p{int(q * 100)}': value for q, value in
+           zip(SIZE_QUANTILES, np.quantile(chunk_sizes, SIZE_QUANTILES))},
+        # Overall ratio of the array, and spread of the per-chunk ratios
+        'compression_ratio': chunk_nbytes * len(chunk_sizes) / chunk_sizes.sum(),
+        'compression_ratio_min': ratios.min(),
+        'compression_ratio_p50': np.median(ratios),
+        'compression_ratio_max': ratios.max(),
+    })
+    return footprint
@@ -0,0 +1,122 @@
+import time
+import threading
+import numpy as np
+import pandas as pd
+
+import modules.cost_model as cost_model
+
+# Relative tolerance of the regular grid check and of exact label lookups on it
+GRID_RTOL = 1e-6
+
+class CoordIndex:
+    # Label -> position lookups on one coordinate, built once per opened dataset, with the
+    # semantics of DataArray.sel():
+    # - regular numeric grids (e.g. GEOS-FP lat/lon): O(1) arithmetic
+    # - increasing (verified) arrays, e.g. time: binary search; date strings select the whole
+    #   period they name, as pandas partial string indexing does
+    # - anything else: the pandas index
+    def __init__(self, values):
+        values = np.asarray(values)
+        labels = values
+        self.is_time = np.issubdtype(values.dtype, np.datetime64)
+        if self.is_time:
+            values = values.astype('datetime64[ns]').view('int64')
+        self.values = values
+        self.size = len(values)
+        steps = np.diff(values)
+        self.increasing = bool(np.all(steps > 0))
+        self.regular = (not self.is_time and self.increasing and self.size > 1 and
+                        bool(np.allclose(steps, steps[0], rtol=GRID_RTOL, atol=0)))
+        self.start = values[0] if self.size else None
+        self.step = (values[-1] - values[0]) / (self.size - 1) if self.regular else None
+        self._pandas_index = None if self.increasing else pd.Index(labels)
+
+    def _label(self, value):
+        # Label as a number of the coordinate's type, or (lo, hi) bounds for a date string
+        if self.is_time:
+            if isinstance(value, str):
+                period = pd.Period(value)
+                return period.start_time.value, period.end_time.value
+            return pd.Timestamp(value).value
+        return value
+
+    def _search(self, value, side):
+        if self.regular:
+            position = (value - self.start) / self.step
+            if side == 'left':
+                return int(np.clip(np.ceil(position - GRID_RTOL), 0, self.size))
+            return int(np.clip(np.floor(position + GRID_RTOL) + 1, 0, self.size))
+        return int(np.searchsorted(self.values, value, side=side))
+
+    def index_range(self, value, method=None):
+        # Positions [start, stop) selected by value (label, date string or label slice)
+        if value is None:
+            return 0, self.size
+        if self._pandas_index is not None:
+            return cost_model.index_range(self._pandas_index, value, method)
+        if isinstance(value, slice):
+            start = self._label(value.start) if value.start is not None else None
+            stop = self._label(value.stop) if value.stop is not None else None
+            first = 0 if start is None else self._search(start[0] if isinstance(start, tuple) else start, 'left')
+            last = self.size if stop is None else self._search(stop[1] if isinstance(stop, tuple) else stop, 'right')
+            return first, max(first, last)
+        label = self._label(value)
+        if isinstance(label, tuple):
+            first = self._search(label[0], 'left')
+            return first, max(first, self._search(label[1], 'right'))
+        if method == 'nearest':
+            position = self.locate_nearest(label)
+            return position, position + 1
+        first = self._search(label, 'left')
+        if first >= self.size or not np.isclose(self.values[first], label, rtol=GRID_RTOL, atol=0):
+            raise KeyError(value)
+        return first, first + 1
+
+    def locate_nearest(self, label):
+        # Ties go to the larger position, as in pandas
+        if self.regular:
+            return int(np.clip(np.floor((label - self.start) / self.step + 0.5), 0, self.size - 1))
+        if self.size == 1:
+            return 0
+        right = int(np.clip(np.searchsorted(self.values, label, side='left'), 1, self.size - 1))
+        left = right - 1
+        return left if label - self.values[left] < self.values[right] - label else right
+
+    def isel_key(self, value, method=None):
+        # Positional key for DataArray.isel() equivalent to DataArray.sel() with value:
+        # an int (the dimension is dropped) for single labels, a slice otherwise
+        start, stop = self.index_range(value, method)
+        if isinstance(value, slice) or value is None or (self.is_time and isinstance(value, str)):
+            return slice(start, stop)
+        return start
+
+def build_indexes(select_data):
+    # {dim: CoordIndex} for every dimension coordinate of select_data
+    return {dim: CoordIndex(select_data[dim].values) for dim in select_data.dims if dim in select_data.coords}
+
+class HandleCache:
+    # Opened stores, datasets and coordinate indexes, kept for the life of the process so that
+    # trials and queries on the same store reuse them; opening is timed once, apart from queries
+    def __init__(self):
+        self._handles = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, opener):
+        # (handle, whether it was cached); opener() returns the handle, a dict, which gets its open time
+        # Units of open_time: sec
+        with self._lock:
+            if key in self._handles:
+                return self._handles[key], True
+        start = time.perf_counter()
+        handle = opener()
+        handle['open_time'] = time.perf_counter() - start
+        with self._lock:
+            self._handles.setdefault(key, handle)
+            return self._handles[key], False
+
+    def clear(self):
+        with self._lock:
+            self._handles.clear()
+
+# Handles of this process (each benchmark worker has its own)
+HANDLES = HandleCache()
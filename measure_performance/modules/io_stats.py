@@ -0,0 +1,164 @@
+import time
+import asyncio
+import threading
+import numpy as np
+import fsspec.asyn
+from concurrent.futures import ThreadPoolExecutor
+from zarr.storage import Store
+
+import modules.sharding as sharding
+import modules.fetch as fetch
+
+class RequestStats:
+    # Request counters of a store that talks to the storage itself
+    def reset_stats(self):
+        with self._lock:
+            self.gets = 0
+            self.heads = 0
+            self.lists = 0
+            self.bytes_received = 0
+            self.latencies = []
+
+    def _record(self, kind, latencies, nbytes=0):
+        with self._lock:
+            setattr(self, kind, getattr(self, kind) + len(latencies))
+            self.bytes_received += nbytes
+            self.latencies.extend(latencies)
+
+    def stats(self):
+        # Units: -, -, -, byte
+        return [self.gets, self.heads, self.lists, self.bytes_received]
+
+class InstrumentedStore(RequestStats, Store):
+    # Counts the requests made to a key/value store (GET, HEAD, LIST), the bytes received
+    # and the latency of every request; sits directly in front of the store mapper
+    def __init__(self, store):
+        self._store = store
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def __getitem__(self, key):
+        start = time.perf_counter()
+        try:
+            value = self._store[key]
+        except KeyError:
+            # Requests for missing keys (chunks never written) are paid for too
+            self._record('gets', [time.perf_counter() - start])
+            raise
+        self._record('gets', [time.perf_counter() - start], len(value))
+        return value
+
+    @property
+    def async_impl(self):
+        # Seen through by the fetch layer (see fetch.is_async), which then batches on the event loop
+        return fetch.is_async(self._store)
+
+    def _filesystem(self):
+        # (fsspec mapper, filesystem) of the store if it is an async filesystem, else None
+        mapper = getattr(self._store, 'map', self._store)
+        fs = getattr(mapper, 'fs', None)
+        return (mapper, fs) if getattr(fs, 'async_impl', False) else None
+
+    def _timed_batch(self, requests, batch_size):
+        # [fn() -> value or None] -> [(value, latency)], run on threads with at most batch_size
+        # (default: all) in flight; each request is timed on its own, not as part of the batch
+        def timed(fn):
+            start = time.perf_counter()
+            try:
+                value = fn()
+            except KeyError:
+                value = None
+            return value, time.perf_counter() - start
+        if len(requests) == 1:
+            return [timed(requests[0])]
+        with ThreadPoolExecutor(max_workers=min(batch_size or len(requests), len(requests))) as executor:
+            return list(executor.map(timed, requests))
+
+    def _record_batch(self, results):
+        self._record('gets', [latency for _, latency in results],
+                     sum(len(value) for value, _ in results if value is not None))
+
+    def getitems(self, keys, *, contexts=None, on_error='omit', batch_size=None):
+        # Requests of a batch are concurrent (at most batch_size in flight), each timed on its own
+        keys = list(keys)
+        if not keys:
+            return {}
+        filesystem = self._filesystem()
+        if filesystem is not None:
+            mapper, fs = filesystem
+            results = timed_cat(fs, [(mapper._key_to_str(key), None, None) for key in keys], batch_size)
+        else:
+            results = self._timed_batch([lambda key=key: self._store[key] for key in keys], batch_size)
+        self._record_batch(results)
+        return {key: value for key, (value, _) in zip(keys, results) if value is not None}
+
+    def getranges(self, ranges, batch_size=None):
+        # Byte-range GETs (see sharding.read_ranges), each timed on its own like getitems()
+        if not ranges:
+            return []
+        filesystem = self._filesystem()
+        if filesystem is not None:
+            mapper, fs = filesystem
+            results = timed_cat(fs, [(mapper._key_to_str(key), start, end) for key, start, end in ranges],
+                                batch_size)
+        else:
+            results = self._timed_batch([lambda byte_range=byte_range: sharding.read_ranges(self._store, [byte_range])[0]
+                                         for byte_range in ranges], batch_size)
+        self._record_batch(results)
+        return [value for value, _ in results]
+
+    def __contains__(self, key):
+        start = time.perf_counter()
+        found = key in self._store
+        self._record('heads', [time.perf_counter() - start])
+        return found
+
+    def listdir(self, path=''):
+        start = time.perf_counter()
+        if hasattr(self._store, 'listdir'):
+            children = self._store.listdir(path)
+        else:
+            prefix = f"{path.rstrip('/')}/" if path else ''
+            children = sorted({key[len(prefix):].split('/')[0] for key in self._store if key.startswith(prefix)})
+        self._record('lists', [time.perf_counter() - start])
+        return children
+
+    def __iter__(self):
+        start = time.perf_counter()
+        keys = list(self._store)
+        self._record('lists', [time.perf_counter() - start])
+        return iter(keys)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __setitem__(self, key, value):
+        self._store[key] = value
+
+    def __delitem__(self, key):
+        del self._store[key]
+
+def timed_cat(fs, requests, batch_size=None):
+    # [(path, start, end)] -> [(bytes or None if missing, latency)] on the event loop of an async
+    # filesystem, with at most batch_size (default: all) requests in flight; each request is timed
+    # from when it is sent, so waiting for a free slot is not part of its latency
+    async def request(semaphore, path, start, end):
+        async with semaphore:
+            request_start = time.perf_counter()
+            try:
+                value = await fs._cat_file(path, start=start, end=end)
+            except FileNotFoundError:
+                value = None
+            return value, time.perf_counter() - request_start
+
+    async def gather():
+        semaphore = asyncio.Semaphore(batch_size or len(requests))
+        return await asyncio.gather(*[request(semaphore, *r) for r in requests])
+
+    return list(fsspec.asyn.sync(fs.loop, gather))
+
+def latency_percentiles(latencies):
+    # p50, p95, p99 of request latencies (sec)
+    if len(latencies) == 0:
+        return [np.nan] * 3
+    return list(np.percentile(latencies, [50, 95, 99]))
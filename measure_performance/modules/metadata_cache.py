@@ -0,0 +1,196 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from zarr.storage import Store
+
+import modules.stores as stores
+import modules.cost_model as cost_model
+import modules.sharding as sharding
+import modules.footprint as footprint
+import modules.fetch as fetch
+
+# Coordinate arrays whose chunks are cached along with the metadata
+COORDINATES = ('time', 'lat', 'lon')
+
+# Suffix of the file that records a key missing from the store (e.g. .zshard of an unsharded array)
+MISSING_SUFFIX = '.missing'
+MISSING = object()
+
+def store_token(url):
+    # Identity of the store's consolidated metadata, from one HEAD request: size and ETag
+    # (S3) or modification time (local); None if the store has no .zmetadata
+    # A rewritten store is consolidated again, so its token changes
+    fs, path = stores.get_filesystem(url)
+    try:
+        info = fs.info(f'{path}/.zmetadata')
+    except FileNotFoundError:
+        return None
+    identity = info.get('ETag') or info.get('mtime') or info.get('LastModified') or info.get('created')
+    return f"{info.get('size')}-{identity}"
+
+def get_entry_dir(cache_dir, url):
+    # Folder of the cached values of one version of a store, named after the store URL and its
+    # token: a stale entry is never read again, nor deleted while another worker may read it
+    token = store_token(url)
+    if token is None:
+        return None
+    url_hash = hashlib.sha1(url.rstrip('/').encode()).hexdigest()[:16]
+    token_hash = hashlib.sha1(token.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f'{url_hash}-{token_hash}')
+
+def coordinate_keys(zmetadata, coordinates=COORDINATES):
+    # Keys of every chunk of the coordinate arrays, from the consolidated metadata
+    metadata = json.loads(zmetadata)['metadata']
+    keys = []
+    for name in coordinates:
+        array_meta = metadata.get(f'{name}/.zarray')
+        if array_meta is None:
+            continue
+        ranges = [(0, size) for size in array_meta['shape']]
+        separator = array_meta.get('dimension_separator') or '.'
+        keys += cost_model.touched_chunk_keys(name, ranges, array_meta['chunks'], separator, max_keys=np.inf)
+    return keys
+
+def is_cached_key(key, coordinates=COORDINATES):
+    # Metadata of any array or group, and chunks of the coordinate arrays
+    return key.split('/')[-1] in footprint.METADATA_KEYS or key.split('/')[0] in coordinates
+
+class MetadataCache(Store):
+    # Serves metadata and coordinate chunks from memory and, with cache_dir, from a local folder
+    # shared by every worker process; everything else (the data chunks) goes to the store
+    # Values are written to the folder atomically (write, then rename), so a worker never reads
+    # a partial file; the folder of a store is validated against its token, see get_entry_dir()
+    # Keys missing from the store are cached as missing, so probes for optional metadata are not repeated
+    def __init__(self, store, url=None, cache_dir=None, coordinates=COORDINATES):
+        self._store = store
+        self.coordinates = coordinates
+        self.entry_dir = get_entry_dir(cache_dir, url) if cache_dir is not None and url is not None else None
+        self._values = {}
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        # disk_hits: values read from the local folder, misses: values requested from the store
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses}
+
+    def _path(self, key):
+        return os.path.join(self.entry_dir, *key.split('/'))
+
+    def _read_disk(self, key):
+        if self.entry_dir is None:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return MISSING if os.path.exists(self._path(key) + MISSING_SUFFIX) else None
+
+    def _write_disk(self, key, value):
+        if self.entry_dir is None:
+            return
+        path = self._path(key)
+        if value is MISSING:
+            path, value = path + MISSING_SUFFIX, b''
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+
+    def _get_cached(self, key):
+        # Value (or MISSING) from memory, else from the local folder; None if neither has it
+        with self._lock:
+            if key in self._values:
+                self.hits += 1
+                return self._values[key]
+        value = self._read_disk(key)
+        if value is not None:
+            with self._lock:
+                self.disk_hits += 1
+                self._values[key] = value
+        return value
+
+    def _cache_value(self, key, value):
+        with self._lock:
+            self.misses += 1
+            self._values[key] = value
+        self._write_disk(key, value if value is MISSING else bytes(value))
+
+    def __getitem__(self, key):
+        if not is_cached_key(key, self.coordinates):
+            return self._store[key]
+        value = self._get_cached(key)
+        if value is None:
+            try:
+                value = self._store[key]
+            except KeyError:
+                value = MISSING
+            self._cache_value(key, value)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    @property
+    def async_impl(self):
+        # Seen through by the fetch layer, see fetch.is_async
+        return fetch.is_async(self._store)
+
+    def getitems(self, keys, *, contexts=None, on_error='omit', batch_size=None):
+        # batch_size: requests in flight for the keys not cached, passed down (see fetch.read_items)
+        values = {}
+        missing = []
+        for key in keys:
+            value = self._get_cached(key) if is_cached_key(key, self.coordinates) else None
+            if value is None:
+                missing.append(key)
+            elif value is not MISSING:
+                values[key] = value
+        if not missing:
+            return values
+        fetched = fetch.read_items(self._store, missing, batch_size)
+        for key in missing:
+            if is_cached_key(key, self.coordinates):
+                self._cache_value(key, fetched.get(key, MISSING))
+        values.update(fetched)
+        return values
+
+    def getranges(self, ranges, batch_size=None):
+        # Byte ranges of shards, never cached
+        return sharding.read_ranges(self._store, ranges, batch_size)
+
+    def __contains__(self, key):
+        if is_cached_key(key, self.coordinates):
+            value = self._get_cached(key)
+            if value is not None:
+                return value is not MISSING
+        return key in self._store
+
+    def listdir(self, path=''):
+        if hasattr(self._store, 'listdir'):
+            return self._store.listdir(path)
+        prefix = f"{path.rstrip('/')}/" if path else ''
+        return sorted({key[len(prefix):].split('/')[0] for key in self._store if key.startswith(prefix)})
+
+    def __setitem__(self, key, value):
+        # Read path only: a write leaves the local folder of this version of the store behind
+        self._store[key] = value
+        with self._lock:
+            self._values.pop(key, None)
+
+    def __delitem__(self, key):
+        del self._store[key]
+        with self._lock:
+            self._values.pop(key, None)
+
+    def __iter__(self):
+        return iter(self._store)
+
+    def __len__(self):
+        return len(self._store)
@@ -0,0 +1,140 @@
+import time
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from zarr.storage import Store
+
+import modules.sharding as sharding
+
+# Network profiles to replay against local stores
+# latency: median seconds per request, latency_sigma: spread of the log-normal latency (0 = constant),
+# bandwidth: byte/sec shared by all connections, max_connections: requests in flight,
+# throttle_rate: fraction of requests rejected (e.g. S3 503 SlowDown) and retried with backoff
+NETWORK_PROFILES = {
+    's3_same_region':  dict(latency=0.02, latency_sigma=0.5, bandwidth=100e6, max_connections=64, throttle_rate=0.0),
+    's3_cross_region': dict(latency=0.08, latency_sigma=0.5, bandwidth=50e6, max_connections=64, throttle_rate=0.0),
+    's3_throttled':    dict(latency=0.02, latency_sigma=0.5, bandwidth=100e6, max_connections=64, throttle_rate=0.02),
+    'slow_link':       dict(latency=0.05, latency_sigma=0.2, bandwidth=10e6, max_connections=8, throttle_rate=0.0),
+}
+
+# Keys listed per LIST request, as in S3
+LIST_PAGE_SIZE = 1000
+
+class ThrottlingError(OSError):
+    pass
+
+class SimulatedStore(Store):
+    # Key/value store (e.g. a local directory mapper) that behaves like an object store on a
+    # network: every request waits for a latency draw, transfers share the bandwidth, at most
+    # max_connections requests are served at once and some can be throttled
+    def __init__(self, store, latency=0.02, latency_sigma=0.0, bandwidth=100e6, max_connections=64,
+                 throttle_rate=0.0, max_retries=5, backoff=0.1, seed=0):
+        self._store = store
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.bandwidth = bandwidth
+        self.max_connections = max_connections
+        self.throttle_rate = throttle_rate
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.throttled = 0
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+        self._link_free_at = 0.0
+        self._connections = threading.BoundedSemaphore(max_connections)
+        self._executor = ThreadPoolExecutor(max_workers=max_connections)
+
+    def _draw(self):
+        # Latency and throttling draws of one request
+        with self._lock:
+            latency = self.latency * np.exp(self.latency_sigma * self._rng.standard_normal())
+            throttled = self._rng.random() < self.throttle_rate
+        return latency, throttled
+
+    def _transfer(self, nbytes):
+        # All connections share one link: transfers are queued on it
+        with self._lock:
+            start = max(time.time(), self._link_free_at)
+            self._link_free_at = start + nbytes / self.bandwidth
+            done_at = self._link_free_at
+        time.sleep(max(0.0, done_at - time.time()))
+
+    def _request(self, fn, nbytes_sent=0):
+        # One request: connection slot, latency, (retries of throttled attempts), transfer
+        for attempt in range(self.max_retries + 1):
+            with self._connections:
+                latency, throttled = self._draw()
+                time.sleep(latency)
+                if not throttled:
+                    self._transfer(nbytes_sent)
+                    result = fn()
+                    if isinstance(result, (bytes, bytearray, memoryview)):
+                        self._transfer(len(result))
+                    return result
+            with self._lock:
+                self.throttled += 1
+            time.sleep(self.backoff * 2**attempt)
+        raise ThrottlingError(f'Request throttled {self.max_retries + 1} times')
+
+    def __getitem__(self, key):
+        return self._request(lambda: self._store[key])
+
+    def getitems(self, keys, *, contexts=None, on_error='omit'):
+        # Requests of a batch run concurrently, up to max_connections
+        def fetch(key):
+            try:
+                return self[key]
+            except KeyError:
+                return None
+        keys = list(keys)
+        values = self._executor.map(fetch, keys)
+        return {key: value for key, value in zip(keys, values) if value is not None}
+
+    def getranges(self, ranges, batch_size=None):
+        # Byte-range GETs (see sharding.read_ranges), one request each, run like getitems()
+        def fetch(byte_range):
+            return self._request(lambda: sharding.read_ranges(self._store, [byte_range])[0])
+        return list(self._executor.map(fetch, ranges))
+
+    def __contains__(self, key):
+        # HEAD
+        return self._request(lambda: key in self._store)
+
+    def __setitem__(self, key, value):
+        # PUT: the body is uploaded before the store has it
+        def put():
+            self._store[key] = value
+        self._request(put, nbytes_sent=len(value))
+
+    def __delitem__(self, key):
+        def delete():
+            del self._store[key]
+        self._request(delete)
+
+    def _list(self, keys):
+        # LIST: one request per page of keys
+        for _ in range(max(1, int(np.ceil(len(keys) / LIST_PAGE_SIZE)))):
+            self._request(lambda: None)
+        return keys
+
+    def listdir(self, path=''):
+        if hasattr(self._store, 'listdir'):
+            return self._list(self._store.listdir(path))
+        prefix = f"{path.rstrip('/')}/" if path else ''
+        children = {key[len(prefix):].split('/')[0] for key in self._store if key.startswith(prefix)}
+        return self._list(sorted(children))
+
+    def rmdir(self, path=''):
+        # One request for the whole prefix, as a batch delete
+        if hasattr(self._store, 'rmdir'):
+            return self._request(lambda: self._store.rmdir(path))
+        prefix = f"{path.rstrip('/')}/" if path else ''
+        for key in [key for key in self._store if key.startswith(prefix)]:
+            del self._store[key]
+        self._request(lambda: None)
+
+    def __iter__(self):
+        return iter(self._list(list(self._store)))
+
+    def __len__(self):
+        return len(self._list(list(self._store)))
@@ -0,0 +1,197 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+
+import modules.cost_model as cost_model
+
+# Aggregate pyramid of a variable, stored next to it in the same store under pyramid/:
+# - temporal levels, pyramid/time_<level>: sums and counts (of valid values) over each period of the
+#   level, one map per period
+# - spatial levels, pyramid/space_<factor>: sums and counts over blocks of factor x factor cells,
+#   one time series per block
+# Each level records, per dimension, the [start, stop) indices of the raw data its cells cover, so a
+# query can be answered exactly from whole cells of the coarsest levels plus raw data at the edges
+PYRAMID_GROUP = 'pyramid'
+TEMPORAL_LEVELS = {'daily': 'D', 'weekly': 'W', 'monthly': 'MS'}
+SPATIAL_FACTORS = [2, 4, 8, 16]
+
+# Cells of a spatial level per chunk along lat and lon (each chunk holds the whole time series)
+SPATIAL_LEVEL_CHUNK = 32
+
+def get_level_group(level):
+    # level: a TEMPORAL_LEVELS name or a spatial coarsening factor
+    if isinstance(level, str):
+        return f'{PYRAMID_GROUP}/time_{level}'
+    return f'{PYRAMID_GROUP}/space_{level}'
+
+def period_bounds(times, freq):
+    # [start, stop) indices of the timesteps in each period of freq, periods without timesteps dropped
+    positions = pd.Series(np.arange(len(times)), index=pd.DatetimeIndex(times)).resample(freq)
+    bounds = pd.DataFrame({'start': positions.min(), 'stop': positions.max() + 1}).dropna()
+    return bounds['start'].to_numpy(dtype=int), bounds['stop'].to_numpy(dtype=int)
+
+def block_bounds(size, factor):
+    starts = np.arange(0, size, factor)
+    return starts, np.minimum(starts + factor, size)
+
+def build_temporal_level(data, level):
+    # Sum and count of data over each period of the level
+    # Units: units of data, -
+    starts, stops = period_bounds(data['time'].values, TEMPORAL_LEVELS[level])
+    sums = [data.isel(time=slice(start, stop)).sum('time', dtype='float64') for start, stop in zip(starts, stops)]
+    counts = [data.isel(time=slice(start, stop)).notnull().sum('time').astype('int32') for start, stop in zip(starts, stops)]
+    level_data = xr.Dataset({
+        'sum': xr.concat(sums, dim='time'),
+        'count': xr.concat(counts, dim='time'),
+        'time_start': ('time', starts),
+        'time_stop': ('time', stops),
+    })
+    level_data = level_data.assign_coords(time=data['time'].values[starts])
+    return level_data.chunk({'time': 1, 'lat': -1, 'lon': -1})
+
+def build_spatial_level(data, factor):
+    # Sum and count of data over each block of factor x factor cells
+    # Units: units of data, -
+    coarsen = dict(lat=factor, lon=factor, boundary='pad')
+    level_data = xr.Dataset({
+        'sum': data.astype('float64').coarsen(**coarsen).sum(),
+        'count': data.notnull().astype('float32').coarsen(**coarsen).sum().astype('int32'),
+    })
+    for dim in ['lat', 'lon']:
+        starts, stops = block_bounds(data.sizes[dim], factor)
+        centers = [data[dim].values[start:stop].mean() for start, stop in zip(starts, stops)]
+        level_data = level_data.assign_coords({dim: centers})
+        level_data[f'{dim}_start'] = (dim, starts)
+        level_data[f'{dim}_stop'] = (dim, stops)
+    chunk = SPATIAL_LEVEL_CHUNK
+    return level_data.chunk({'time': -1, 'lat': chunk, 'lon': chunk})
+
+def list_levels(store):
+    # Levels written so far, from the pyramid group's attributes
+    try:
+        attrs = zarr.open_group(store, path=PYRAMID_GROUP, mode='r').attrs
+    except (KeyError, ValueError, zarr.errors.GroupNotFoundError):
+        return {'variable': None, 'temporal': [], 'spatial': []}
+    return {'variable': attrs.get('variable'), 'temporal': attrs.get('temporal', []),
+            'spatial': attrs.get('spatial', [])}
+
+def write_level(store, variable, level, level_data):
+    # A level is only listed in the pyramid's attributes once it is completely written,
+    # so an interrupted build rebuilds it
+    level_data.to_zarr(store, group=get_level_group(level), mode='w', consolidated=False)
+    group = zarr.open_group(store, path=PYRAMID_GROUP, mode='a')
+    levels = list_levels(store)
+    kind = 'temporal' if isinstance(level, str) else 'spatial'
+    group.attrs.update({'variable': variable, kind: sorted(set(levels[kind]) | {level}, key=str)})
+
+def plan_cover(ranges, levels):
+    # Cover the box of raw index ranges [(start, stop)] with whole cells of the levels, coarsest first
+    # levels: [(level, [(starts, stops)] per dimension)], cell bounds in raw indices
+    # Returns [(level, [(first, last)] per dimension)]: cell ranges of a level, or raw index ranges
+    # for level None; together they cover every raw index of the box exactly once
+    if any(stop <= start for start, stop in ranges):
+        return []
+    if not levels:
+        return [(None, list(ranges))]
+    level, bounds = levels[0]
+    cells = []
+    for (start, stop), (starts, stops) in zip(ranges, bounds):
+        inside = np.nonzero((starts >= start) & (stops <= stop))[0]
+        if len(inside) == 0:
+            return plan_cover(ranges, levels[1:])
+        cells.append((int(inside[0]), int(inside[-1]) + 1))
+    covered = [(int(starts[first]), int(stops[last - 1])) for (first, last), (starts, stops) in zip(cells, bounds)]
+
+    # What is left around the covered block, as slabs before and after it along each dimension
+    pieces = [(level, cells)]
+    for dim in range(len(ranges)):
+        for slab in [(ranges[dim][0], covered[dim][0]), (covered[dim][1], ranges[dim][1])]:
+            slab_ranges = covered[:dim] + [slab] + list(ranges[dim + 1:])
+            pieces += plan_cover(slab_ranges, levels[1:])
+    return pieces
+
+def describe_plan(pieces):
+    # e.g. "monthly:5+weekly:2+daily:6+raw:8": cells (or raw values) read per level
+    counts = {}
+    for level, cells in pieces:
+        name = 'raw' if level is None else str(level)
+        counts[name] = counts.get(name, 0) + int(np.prod([last - first for first, last in cells]))
+    return '+'.join(f'{name}:{count}' for name, count in counts.items())
+
+class Pyramid:
+    # Answers the aggregate queries of execute() (avg_aggregate=True) from the pyramid levels of a store
+    # A store without a pyramid of variable has no levels: every query is answered from raw data
+    def __init__(self, store, variable, open_kwargs=None):
+        self.levels = {}
+        self._cell_bounds = {}
+        open_kwargs = {'consolidated': True, 'chunks': None, **(open_kwargs or {})}
+        written = list_levels(store)
+        if written['variable'] != variable:
+            return
+        for level in written['temporal'] + written['spatial']:
+            self.levels[level] = xr.open_zarr(store, group=get_level_group(level), **open_kwargs)
+
+    def _bounds(self, level, dims):
+        # Read once per level, like coordinates
+        if level not in self._cell_bounds:
+            level_data = self.levels[level]
+            self._cell_bounds[level] = [(level_data[f'{dim}_start'].values, level_data[f'{dim}_stop'].values)
+                                        for dim in dims]
+        return self._cell_bounds[level]
+
+    def _coarsest_first(self, levels, dims):
+        # Levels ordered by the mean number of raw values per cell
+        def cell_size(level):
+            return np.prod([np.mean(stops - starts) for starts, stops in self._bounds(level, dims)])
+        return sorted(levels, key=cell_size, reverse=True)
+
+    def plan(self, ranges, dims):
+        # Pieces that cover the raw index ranges along dims (['time'] or ['lat', 'lon'])
+        levels = [level for level in self.levels if isinstance(level, str) == (dims == ['time'])]
+        levels = [(level, self._bounds(level, dims)) for level in self._coarsest_first(levels, dims)]
+        return plan_cover(ranges, levels)
+
+    def aggregate(self, select_data, pieces, dims, keep=None):
+        # Sum and count over dims of every piece, added up
+        # keep: {dim: slice} of the other dimensions, same in raw data and in the levels
+        if not pieces:
+            # Empty selection: an empty raw piece, so the mean is NaN as with raw data
+            pieces = [(None, [(0, 0)] * len(dims))]
+        total_sum = 0
+        total_count = 0
+        for level, cells in pieces:
+            selection = {**(keep or {}), **{dim: slice(first, last) for dim, (first, last) in zip(dims, cells)}}
+            if level is None:
+                raw = select_data.isel(selection)
+                total_sum = total_sum + raw.sum(dims, dtype='float64').values
+                total_count = total_count + raw.notnull().sum(dims).values
+            else:
+                level_data = self.levels[level].isel(selection)
+                total_sum = total_sum + level_data['sum'].sum(dims).values
+                total_count = total_count + level_data['count'].sum(dims).values
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return total_sum / total_count
+
+    def plan_query(self, select_data, task, date, lat, lon, method, coord_indexes=None):
+        # Dimensions aggregated, pieces that cover them and the selection of the other dimensions
+        # of an execute() query, from its index ranges only
+        ranges = dict(zip(select_data.dims, cost_model.selection_ranges(select_data, task, date, lat, lon,
+                                                                        method, coord_indexes)))
+        if task == 'map':
+            # Mean over the time window
+            dims = ['time']
+        elif task == 'time':
+            # Mean over the region
+            dims = ['lat', 'lon']
+        else:
+            raise ValueError(f'No aggregate query for task {task}')
+        keep = {dim: slice(*ranges[dim]) for dim in select_data.dims if dim not in dims}
+        return dims, self.plan([ranges[dim] for dim in dims], dims), keep
+
+    def query(self, select_data, task, date, lat, lon, method, coord_indexes=None):
+        # Same result as execute(..., avg_aggregate=True) on select_data
+        dims, pieces, keep = self.plan_query(select_data, task, date, lat, lon, method, coord_indexes)
+        values = self.aggregate(select_data, pieces, dims, keep)
+        coords = {dim: select_data[dim].values[keep[dim]] for dim in keep}
+        return xr.DataArray(values, dims=list(keep), coords=coords)
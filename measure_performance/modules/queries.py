@@ -0,0 +1,45 @@
+import pandas as pd
+
+# Queries of the benchmark tasks, shared with the visualization (query size weights)
+
+# Regions of time_series_over_region_<name>: [lon_min, lat_min, lon_max, lat_max]
+# BBox CSV format from: https://boundingbox.klokantech.com/
+REGIONS = {
+    'ohio':          [-84.91,38.21,-80.5,42.25],
+    'california':    [-124.92,32.64,-114.25,42.11],
+    'usa':           [-124.9,24.9,-66.7,49.4],
+    'north_america': [-168.0,15.3,-53.0,71.3]
+}
+
+# Time windows of map_over_time_<name>: (start, end), both included
+TIME_WINDOWS = {
+    '6_hr':    ('2020-06-01T00', '2020-06-01T05'),
+    '12_hr':   ('2020-06-01T00', '2020-06-01T11'),
+    '1_day':   ('2020-06-01', '2020-06-01'),
+    '2_day':   ('2020-06-01', '2020-06-02'),
+    '7_day':   ('2020-06-01', '2020-06-07'),
+    '30_day':  ('2020-06-01', '2020-06-30'),
+    '60_day':  ('2020-06-01', '2020-07-30'),
+    '180_day': ('2020-06-01', '2020-11-27'),
+}
+
+def region_area(bbox):
+    # Area of a bbox in square degrees (grid cells of a regular lat/lon grid, up to a constant)
+    lon_min, lat_min, lon_max, lat_max = bbox
+    return (lon_max - lon_min) * (lat_max - lat_min)
+
+def window_hours(time_range):
+    # Length of a time window in hours (timesteps of an hourly series); as in a label-based
+    # selection, a partial date covers the whole period, e.g. '2020-06-01' the whole day
+    start = pd.Period(time_range[0]).start_time
+    end = pd.Period(time_range[1]).end_time
+    return round((end - start) / pd.Timedelta(hours=1))
+
+def query_size(task):
+    # Extent of the query of a task: bbox area of a region task, hours of a time window task;
+    # None for the tasks without one of those (e.g. time_series)
+    for prefix, queries, size in [('time_series_over_region_', REGIONS, region_area),
+                                  ('map_over_time_', TIME_WINDOWS, window_hours)]:
+        if task.startswith(prefix) and task[len(prefix):] in queries:
+            return size(queries[task[len(prefix):]])
+    return None
@@ -0,0 +1,164 @@
+import os
+import json
+import uuid
+import sqlite3
+import datetime
+import numpy as np
+import pandas as pd
+from ast import literal_eval
+
+# Append-only store of benchmark results (SQLite, one file per dataset), next to the per-task CSVs:
+# - measurements: one row per strategy measured by a run, keyed by (run_id, task, params,
+#   time_chunks, lon_chunks, lat_chunks); array_shape is kept as integer columns shape_0, ...
+# - trials: one row per trial of a measurement (raw wall time, CPU time and peak memory)
+# Rows are only ever inserted; columns are added as new metrics appear. Repeated measurements of
+# a strategy (e.g. a sweep run again) are all kept, and load() returns the latest one
+# Chunk sizes are integers; a full dimension ('all') is stored as its size when known, else as 'all'
+KEY_COLUMNS = ['run_id', 'task', 'params', 'time_chunks', 'lon_chunks', 'lat_chunks']
+MAX_DIMS = 3
+SHAPE_COLUMNS = [f'shape_{i}' for i in range(MAX_DIMS)]
+TRIAL_COLUMNS = ['trial', 'wall_time', 'cpu_time', 'peak_memory']
+
+# Raw samples of measure_performance.py (JSON lists), stored as trials
+SAMPLE_COLUMNS = {'wall_time_samples': 'wall_time', 'cpu_time_samples': 'cpu_time',
+                  'peak_memory_samples': 'peak_memory'}
+
+def get_results_path(dataset, root='data'):
+    return f'{root}/{dataset}/performance_data/results.sqlite'
+
+def new_run_id():
+    # e.g. 20240131T120000-3f2a9c
+    return f'{datetime.datetime.now():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:6]}'
+
+def encode_params(params):
+    # Sweep settings of a run (codec, cache size, concurrency level, ...) as the same string for
+    # the same settings; settings left at their default (None/False) are dropped
+    return json.dumps({k: v for k, v in sorted(params.items()) if v is not None and v is not False})
+
+def connect(path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    conn = sqlite3.connect(path)
+    key_sql = ', '.join(KEY_COLUMNS)
+    conn.execute(f'CREATE TABLE IF NOT EXISTS measurements ({key_sql})')
+    conn.execute(f'CREATE TABLE IF NOT EXISTS trials ({key_sql}, {", ".join(TRIAL_COLUMNS)})')
+    conn.execute('CREATE INDEX IF NOT EXISTS measurements_task ON measurements (task, params)')
+    return conn
+
+def _ensure_columns(conn, table, columns):
+    existing = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+    for column in columns:
+        if column not in existing:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN "{column}"')
+
+def _sql_value(value):
+    # Python scalars (NaN as NULL); anything else, e.g. a list, as its string
+    if isinstance(value, (np.generic,)):
+        value = value.item()
+    if value is None or isinstance(value, (bool, int, str)):
+        return value
+    if isinstance(value, float):
+        return None if np.isnan(value) else value
+    return str(value)
+
+def split_shape(array_shape):
+    # Shape tuple (or its string, as in the CSVs) -> {shape_0: ..., shape_1: ..., ...}
+    if isinstance(array_shape, str):
+        array_shape = literal_eval(array_shape)
+    if array_shape is None or (isinstance(array_shape, float) and np.isnan(array_shape)):
+        array_shape = ()
+    array_shape = tuple(array_shape)
+    return {column: (int(array_shape[i]) if i < len(array_shape) else None)
+            for i, column in enumerate(SHAPE_COLUMNS)}
+
+def chunk_key(value, dim_size=None):
+    # Chunk size of a strategy as an integer; 'all' (full dimension, as in the strategy names)
+    # as dim_size, or kept as 'all' if the size of the dimension is not known (e.g. imported CSVs)
+    if str(value) == 'all':
+        return 'all' if dim_size is None else int(dim_size)
+    return int(value)
+
+def append_measurement(path, run_id, task, params, metrics, dim_sizes=None):
+    # metrics: {column: value} of one strategy, e.g. dict(zip(METRIC_COLUMNS, metrics_list))
+    # dim_sizes: {'time_chunks': size of the time dimension, ...}, for the chunk sizes given as 'all'
+    metrics = dict(metrics)
+    dim_sizes = dim_sizes or {}
+    keys = {'run_id': run_id, 'task': task, 'params': encode_params(params)}
+    for column in ['time_chunks', 'lon_chunks', 'lat_chunks']:
+        keys[column] = chunk_key(metrics.pop(column), dim_sizes.get(column))
+    row = {**keys, **split_shape(metrics.pop('array_shape', None))}
+    samples = {SAMPLE_COLUMNS[column]: json.loads(metrics.pop(column))
+               for column in list(metrics) if column in SAMPLE_COLUMNS and isinstance(metrics[column], str)}
+    row.update({column: _sql_value(value) for column, value in metrics.items()})
+
+    conn = connect(path)
+    with conn:
+        _ensure_columns(conn, 'measurements', row)
+        columns = ', '.join(f'"{column}"' for column in row)
+        conn.execute(f'INSERT INTO measurements ({columns}) VALUES ({", ".join("?" * len(row))})',
+                     [row[column] for column in row])
+        num_trials = max((len(values) for values in samples.values()), default=0)
+        trial_rows = [[keys[column] for column in KEY_COLUMNS] + [trial] +
+                      [_sql_value(samples[column][trial]) if column in samples else None
+                       for column in TRIAL_COLUMNS[1:]]
+                      for trial in range(num_trials)]
+        conn.executemany(f'INSERT INTO trials VALUES ({", ".join("?" * (len(KEY_COLUMNS) + len(TRIAL_COLUMNS)))})',
+                         trial_rows)
+    conn.close()
+
+def import_csv(path, csv_path, task, params=None):
+    # One-time import of a per-task CSV of an earlier sweep, as run 'csv:<file name>';
+    # skipped if already imported. Derived columns of the CSV (norm_*, 'lon x lat', ...) are dropped
+    run_id = f'csv:{os.path.basename(csv_path)}'
+    conn = connect(path)
+    imported = conn.execute('SELECT 1 FROM measurements WHERE run_id = ? LIMIT 1', [run_id]).fetchone()
+    conn.close()
+    if imported:
+        return False
+    metrics_df = pd.read_csv(csv_path, index_col=0)
+    derived = ['lon x lat', 'lonlat_product', 'time x lon x lat', 'total_product', 'num_data_points',
+               'norm_cpu_times', 'norm_wall_times', 'norm_peak_memories']
+    metrics_df = metrics_df.drop(columns=[c for c in derived if c in metrics_df])
+    for metrics in metrics_df.to_dict('records'):
+        append_measurement(path, run_id, task, params or {}, metrics)
+    return True
+
+def _filter(task=None, params=None, latest=True):
+    # WHERE clause (and its arguments) on measurements, see load()
+    where = []
+    args = []
+    if task is not None:
+        tasks = [task] if isinstance(task, str) else list(task)
+        where.append('(' + ' OR '.join(['task GLOB ?'] * len(tasks)) + ')')
+        args += tasks
+    if params is not None:
+        where.append('params = ?')
+        args.append(encode_params(params))
+    if latest:
+        where.append('rowid IN (SELECT MAX(rowid) FROM measurements '
+                     'GROUP BY task, params, time_chunks, lon_chunks, lat_chunks)')
+    return (' WHERE ' + ' AND '.join(where) if where else ''), args
+
+def load(path, columns=None, task=None, params=None, latest=True):
+    # Measurements as a DataFrame: only the given columns (plus the key columns), of the tasks
+    # matching task (a name, a glob such as 'map_over_time_*', or a list of them) and of the
+    # given sweep params ({} for the default sweep, None for any)
+    # latest: only the last measurement of each (task, params, chunks)
+    conn = connect(path)
+    existing = [row[1] for row in conn.execute('PRAGMA table_info(measurements)')]
+    selected = KEY_COLUMNS + [c for c in (existing if columns is None else columns)
+                              if c in existing and c not in KEY_COLUMNS]
+    where, args = _filter(task, params, latest)
+    selected_sql = ', '.join(f'"{column}"' for column in selected)
+    metrics_df = pd.read_sql_query(f'SELECT {selected_sql} FROM measurements{where}', conn, params=args)
+    conn.close()
+    return metrics_df
+
+def load_trials(path, task=None, params=None, latest=True):
+    # Raw trials of the measurements load() returns, one row per trial
+    conn = connect(path)
+    where, args = _filter(task, params, latest)
+    keys_sql = ', '.join(KEY_COLUMNS)
+    trials_df = pd.read_sql_query(f'SELECT trials.* FROM trials JOIN (SELECT {keys_sql} FROM measurements{where}) '
+                                  f'USING ({keys_sql})', conn, params=args)
+    conn.close()
+    return trials_df
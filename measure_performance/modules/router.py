@@ -0,0 +1,57 @@
+import numpy as np
+import xarray as xr
+
+import modules.stores as stores
+import modules.cost_model as cost_model
+
+class LayoutRouter:
+    # Routes each execute()-style query to the cheapest of several rechunked copies (layouts) of a
+    # variable, by the cost model of modules/cost_model.py: chunks touched x request latency plus
+    # compressed bytes over bandwidth; nothing but metadata, coordinates and a sample of chunk sizes is read
+    # layouts: {name: store URL}, e.g. {'time5136_lat0010_lon0010': 's3://.../inst.zarr/', ...}
+    def __init__(self, layouts, variable, request_latency=cost_model.REQUEST_LATENCY,
+                 bandwidth=cost_model.BANDWIDTH, concurrency=1, sample_chunks=100):
+        self.layouts = dict(layouts)
+        self.variable = variable
+        self.request_latency = request_latency
+        self.bandwidth = bandwidth
+        self.concurrency = concurrency
+        self.array_meta = {}
+        self.compression_ratios = {}
+        for name, url in self.layouts.items():
+            mapper = stores.get_mapper(url)
+            self.array_meta[name] = cost_model.read_array_meta(mapper, variable)
+            self.compression_ratios[name] = self.sample_compression_ratio(mapper, self.array_meta[name], sample_chunks)
+
+        # Layouts share their coordinates: selections are resolved on the first one
+        data = xr.open_zarr(stores.get_mapper(next(iter(self.layouts.values()))), consolidated=True)
+        self.coords_data = data[variable]
+        self.coords_data['time'] = np.sort(self.coords_data['time'].values)
+
+    def sample_compression_ratio(self, mapper, array_meta, sample_chunks):
+        # Uncompressed over stored chunk size, from the sizes of a random sample of chunks
+        ranges = [(0, size) for size in array_meta['shape']]
+        separator = array_meta.get('dimension_separator') or '.'
+        keys = cost_model.touched_chunk_keys(self.variable, ranges, array_meta['chunks'], separator,
+                                             max_keys=sample_chunks)
+        chunk_sizes = [size for size in cost_model.chunk_object_sizes(mapper, keys) if size > 0]
+        if not chunk_sizes:
+            return 1.0
+        chunk_nbytes = int(np.prod(array_meta['chunks'])) * np.dtype(array_meta['dtype']).itemsize
+        return chunk_nbytes / float(np.mean(chunk_sizes))
+
+    def estimate(self, task, date, lat, lon, method):
+        # Estimated cost (sec) of the query on each layout
+        ranges = cost_model.selection_ranges(self.coords_data, task, date, lat, lon, method)
+        costs = {}
+        for name, array_meta in self.array_meta.items():
+            itemsize = np.dtype(array_meta['dtype']).itemsize
+            prediction = cost_model.predict_access(ranges, array_meta['chunks'], itemsize,
+                                                   compression_ratio=self.compression_ratios[name])
+            costs[name] = cost_model.estimate_cost(prediction, self.request_latency, self.bandwidth, self.concurrency)
+        return costs
+
+    def route(self, task, date, lat, lon, method):
+        # Name of the layout that serves the query
+        costs = self.estimate(task, date, lat, lon, method)
+        return min(costs, key=costs.get)
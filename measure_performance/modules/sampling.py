@@ -0,0 +1,54 @@
+import json
+import numpy as np
+
+# Confidence level of the intervals, and bootstrap resamples they are estimated from
+CONFIDENCE = 0.95
+BOOTSTRAP_RESAMPLES = 2000
+
+# Fewest trials whose confidence interval can stop an adaptive series: the bootstrap interval
+# of the median of 2-4 samples is too coarse to say anything
+MIN_CI_TRIALS = 5
+
+def confidence_interval(samples, confidence=CONFIDENCE, resamples=BOOTSTRAP_RESAMPLES, seed=0):
+    # Bootstrap (percentile) interval of the median: no assumption on the shape of the
+    # distribution, whose tail is long with S3 latency; NaN with fewer than 2 samples
+    samples = np.asarray(samples, dtype='float64')
+    if len(samples) < 2:
+        return np.nan, np.nan
+    rng = np.random.default_rng(seed)
+    medians = np.median(rng.choice(samples, size=(resamples, len(samples))), axis=1)
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(medians, [alpha, 1 - alpha])
+    return float(low), float(high)
+
+def relative_ci(samples, confidence=CONFIDENCE):
+    # Half width of the confidence interval over the median
+    low, high = confidence_interval(samples, confidence)
+    median = np.median(samples)
+    if np.isnan(low) or median == 0:
+        return np.inf
+    return (high - low) / 2 / abs(median)
+
+def needs_more(samples, min_trials=1, max_trials=None, target_rel_ci=None):
+    # Whether to run another trial: at least min_trials; then, with target_rel_ci, until the
+    # relative confidence interval (of at least MIN_CI_TRIALS samples) is within it or max_trials
+    # are run
+    if len(samples) < min_trials:
+        return True
+    if target_rel_ci is None or (max_trials is not None and len(samples) >= max_trials):
+        return False
+    if len(samples) < MIN_CI_TRIALS:
+        return True
+    return relative_ci(samples) > target_rel_ci
+
+def summarize(samples, confidence=CONFIDENCE):
+    # Median, 95th percentile, standard deviation and confidence interval of the median
+    samples = np.asarray(samples, dtype='float64')
+    ci_low, ci_high = confidence_interval(samples, confidence)
+    return {'median': float(np.median(samples)), 'p95': float(np.percentile(samples, 95)),
+            'std': float(np.std(samples, ddof=1)) if len(samples) > 1 else np.nan,
+            'ci_low': ci_low, 'ci_high': ci_high}
+
+def encode_samples(samples):
+    # Raw samples of a trial series, kept in one CSV cell
+    return json.dumps([float(sample) for sample in samples])
@@ -0,0 +1,296 @@
+import json
+import threading
+import itertools
+import numpy as np
+from collections import defaultdict
+from zarr.storage import Store
+
+# Sharded layout (as in Zarr v3 sharding): the chunks of a block of chunks_per_shard chunks are
+# stored back to back in one shard object, <array>/shards/<i>.<j>.<k>, followed by an index of
+# (offset, nbytes) pairs, one per chunk of the block in C order, as little-endian uint64
+# Chunks that are not in a shard have offset = nbytes = 2**64 - 1
+# The layout of each sharded array is kept in <array>/.zshard, next to its .zarray
+LAYOUT_KEY = '.zshard'
+SHARD_PREFIX = 'shards'
+EMPTY = np.iinfo(np.uint64).max
+
+def read_ranges(store, ranges, batch_size=None):
+    # [(key, start, end)] -> [bytes or None], one byte-range request per entry
+    # Negative starts read from the end of the object; None for missing objects
+    if hasattr(store, 'getranges'):
+        return store.getranges(ranges, batch_size=batch_size)
+    mapper = getattr(store, 'map', store)  # FSStore wraps an fsspec mapper
+    fs = mapper.fs
+    paths = [mapper._key_to_str(key) for key, _, _ in ranges]
+    starts = [start for _, start, _ in ranges]
+    ends = [end for _, _, end in ranges]
+    kwargs = {'batch_size': batch_size} if fs.async_impl and batch_size is not None else {}
+    results = fs.cat_ranges(paths, starts, ends, on_error='return', **kwargs)
+    values = []
+    for result in results:
+        if isinstance(result, FileNotFoundError):
+            result = None
+        elif isinstance(result, Exception):
+            raise result
+        values.append(result)
+    return values
+
+def read_layout(store, array):
+    # chunks_per_shard of an array, None if it is not sharded
+    try:
+        return tuple(json.loads(store[f'{array}/{LAYOUT_KEY}'])['chunks_per_shard'])
+    except KeyError:
+        return None
+
+def write_layout(store, array, chunks_per_shard):
+    store[f'{array}/{LAYOUT_KEY}'] = json.dumps({'chunks_per_shard': list(chunks_per_shard)}).encode()
+
+def get_shard_block(chunks, chunks_per_shard, shape):
+    # Array elements covered by one shard, capped at the array shape
+    return tuple(min(chunk * n, size) for chunk, n, size in zip(chunks, chunks_per_shard, shape))
+
+def encode_shard(chunks, num_inner):
+    # {inner position: encoded chunk} -> shard object
+    index = np.full((num_inner, 2), EMPTY, dtype='<u8')
+    offset = 0
+    for position in sorted(chunks):
+        index[position] = offset, len(chunks[position])
+        offset += len(chunks[position])
+    return b''.join(bytes(chunks[position]) for position in sorted(chunks)) + index.tobytes()
+
+def decode_index(value, num_inner):
+    return np.frombuffer(value, dtype='<u8').reshape(num_inner, 2)
+
+class ArrayLayout:
+    # Chunk grid of a sharded array and the position of each chunk in its shard
+    def __init__(self, array, shape, chunks, chunks_per_shard):
+        self.array = array
+        self.chunks_per_shard = tuple(chunks_per_shard)
+        self.grid = tuple(int(np.ceil(size / chunk)) for size, chunk in zip(shape, chunks))
+        self.num_inner = int(np.prod(self.chunks_per_shard))
+
+    def locate(self, coords):
+        # Chunk coordinates -> (shard key, position of the chunk in the shard index)
+        shard = tuple(c // n for c, n in zip(coords, self.chunks_per_shard))
+        inner = tuple(c % n for c, n in zip(coords, self.chunks_per_shard))
+        shard_key = f"{self.array}/{SHARD_PREFIX}/{'.'.join(str(s) for s in shard)}"
+        return shard_key, int(np.ravel_multi_index(inner, self.chunks_per_shard))
+
+    def shard_chunk_coords(self, shard_key):
+        # Coordinates of the chunks of a shard, edge shards hold fewer chunks
+        shard = [int(s) for s in shard_key.split('/')[-1].split('.')]
+        ranges = [range(s * n, min((s + 1) * n, size)) for s, n, size in zip(shard, self.chunks_per_shard, self.grid)]
+        return list(itertools.product(*ranges))
+
+    def chunk_key(self, coords):
+        return f"{self.array}/{'.'.join(str(c) for c in coords)}"
+
+class ShardedStore(Store):
+    # Key/value view of a sharded store with the usual zarr chunk keys, so zarr and xarray
+    # read and write it as any other store
+    # Reads: one request per shard for its index (kept until invalidate()), then byte-range requests
+    # for the chunks, where chunks stored next to each other in a shard are fetched by one request
+    # Writes: chunks are held until their shard is complete, then the shard is written as one object,
+    # so writers must cover whole shards (see get_shard_block())
+    def __init__(self, store, concurrency=None):
+        self._store = store
+        self.concurrency = concurrency
+        self._layouts = {}
+        self._indexes = {}
+        self._pending = defaultdict(dict)
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        # Drop the shard indexes read so far, e.g. before a cold measurement
+        with self._lock:
+            self._indexes.clear()
+
+    def _get_layout(self, array):
+        if array not in self._layouts:
+            layout = None
+            chunks_per_shard = read_layout(self._store, array)
+            if chunks_per_shard is not None:
+                array_meta = json.loads(self._store[f'{array}/.zarray'])
+                layout = ArrayLayout(array, array_meta['shape'], array_meta['chunks'], chunks_per_shard)
+            self._layouts[array] = layout
+        return self._layouts[array]
+
+    def _locate(self, key):
+        # (layout, shard key, inner position) of a chunk key of a sharded array, None for other keys
+        array, _, name = key.rpartition('/')
+        if not array or not all(part.isdigit() for part in name.split('.')):
+            return None
+        layout = self._get_layout(array)
+        if layout is None:
+            return None
+        shard_key, inner = layout.locate(tuple(int(part) for part in name.split('.')))
+        return layout, shard_key, inner
+
+    def _load_indexes(self, shards):
+        # {shard key: layout}; reads the missing indexes, one suffix range request per shard
+        missing = [shard_key for shard_key in shards if shard_key not in self._indexes]
+        if not missing:
+            return
+        ranges = [(shard_key, -16 * shards[shard_key].num_inner, None) for shard_key in missing]
+        values = read_ranges(self._store, ranges, self.concurrency)
+        with self._lock:
+            for shard_key, value in zip(missing, values):
+                self._indexes[shard_key] = None if value is None else decode_index(value, shards[shard_key].num_inner)
+
+    def _chunk_ranges(self, keys):
+        # {key: (shard key, offset, nbytes)} of the stored chunks among keys
+        located = {key: self._locate(key) for key in keys}
+        self._load_indexes({shard_key: layout for layout, shard_key, _ in located.values()})
+        chunk_ranges = {}
+        for key, (_, shard_key, inner) in located.items():
+            index = self._indexes[shard_key]
+            if index is None or index[inner, 0] == EMPTY:
+                continue
+            chunk_ranges[key] = (shard_key, int(index[inner, 0]), int(index[inner, 1]))
+        return chunk_ranges
+
+    def chunk_sizes(self, keys):
+        # Stored size of each chunk from the shard indexes, 0 for chunks that are not stored
+        chunk_ranges = self._chunk_ranges(keys)
+        return [chunk_ranges[key][2] if key in chunk_ranges else 0 for key in keys]
+
+    def getitems(self, keys, *, contexts=None, on_error='omit'):
+        keys = list(keys)
+        sharded = [key for key in keys if self._locate(key) is not None]
+        plain = [key for key in keys if self._locate(key) is None]
+        # Metadata and unsharded arrays (e.g. coordinates): key by key, stores differ in their getitems()
+        values = {}
+        for key in plain:
+            try:
+                values[key] = self._store[key]
+            except KeyError:
+                pass
+        if not sharded:
+            return values
+
+        # Coalesce: one request per run of chunks stored back to back in a shard
+        by_shard = defaultdict(list)
+        for key, (shard_key, offset, nbytes) in self._chunk_ranges(sharded).items():
+            by_shard[shard_key].append((offset, nbytes, key))
+        requests = []
+        for shard_key, chunks in by_shard.items():
+            for offset, nbytes, key in sorted(chunks):
+                if requests and requests[-1][0] == shard_key and requests[-1][2] == offset:
+                    requests[-1][2] = offset + nbytes
+                    requests[-1][3].append((key, offset, nbytes))
+                else:
+                    requests.append([shard_key, offset, offset + nbytes, [(key, offset, nbytes)]])
+        results = read_ranges(self._store, [(shard_key, start, end) for shard_key, start, end, _ in requests],
+                              self.concurrency)
+        for (_, start, _, chunks), result in zip(requests, results):
+            if result is None:
+                continue
+            for key, offset, nbytes in chunks:
+                values[key] = result[offset - start:offset - start + nbytes]
+        return values
+
+    def __getitem__(self, key):
+        values = self.getitems([key])
+        if key not in values:
+            raise KeyError(key)
+        return values[key]
+
+    def __contains__(self, key):
+        if self._locate(key) is None:
+            return key in self._store
+        return key in self._chunk_ranges([key])
+
+    def setitems(self, values):
+        plain = {}
+        complete = {}
+        located = {key: self._locate(key) for key in values}
+        with self._lock:
+            for key, value in values.items():
+                if located[key] is None:
+                    plain[key] = value
+                    continue
+                layout, shard_key, inner = located[key]
+                pending = self._pending[shard_key]
+                pending[inner] = value
+                if len(pending) == len(layout.shard_chunk_coords(shard_key)):
+                    complete[shard_key] = (layout, self._pending.pop(shard_key))
+        for key, value in plain.items():
+            self._store[key] = value
+        for shard_key, (layout, chunks) in complete.items():
+            self._store[shard_key] = encode_shard(chunks, layout.num_inner)
+            with self._lock:
+                self._indexes.pop(shard_key, None)
+
+    def __setitem__(self, key, value):
+        self.setitems({key: value})
+
+    def __delitem__(self, key):
+        # A chunk is deleted by writing its shard again without it (its index entry cleared);
+        # a shard left without chunks is deleted
+        located = self._locate(key)
+        if located is None:
+            del self._store[key]
+            return
+        layout, shard_key, inner = located
+        with self._lock:
+            pending = self._pending.get(shard_key, {})
+            if inner in pending:
+                del pending[inner]
+                return
+        try:
+            shard = self._store[shard_key]
+        except KeyError:
+            raise KeyError(key)
+        index = decode_index(shard[-16 * layout.num_inner:], layout.num_inner)
+        if index[inner, 0] == EMPTY:
+            raise KeyError(key)
+        chunks = {position: shard[offset:offset + nbytes] for position, (offset, nbytes) in enumerate(index)
+                  if offset != EMPTY and position != inner}
+        if chunks:
+            self._store[shard_key] = encode_shard(chunks, layout.num_inner)
+        else:
+            del self._store[shard_key]
+        with self._lock:
+            self._indexes.pop(shard_key, None)
+
+    def _store_listdir(self, path):
+        if hasattr(self._store, 'listdir'):
+            return self._store.listdir(path)
+        prefix = f"{path.rstrip('/')}/" if path else ''
+        return sorted({key[len(prefix):].split('/')[0] for key in self._store if key.startswith(prefix)})
+
+    def _expand(self, layout, shard_keys):
+        # Chunk keys of the chunks held by shards
+        return [layout.chunk_key(coords) for shard_key in shard_keys for coords in layout.shard_chunk_coords(shard_key)]
+
+    def listdir(self, path=''):
+        children = self._store_listdir(path)
+        layout = self._get_layout(path.rstrip('/')) if path else None
+        if layout is None or SHARD_PREFIX not in children:
+            return children
+        shard_keys = [f'{layout.array}/{SHARD_PREFIX}/{name}' for name in self._store_listdir(f'{layout.array}/{SHARD_PREFIX}')]
+        chunk_names = [key.split('/')[-1] for key in self._expand(layout, shard_keys)]
+        return sorted([child for child in children if child != SHARD_PREFIX] + chunk_names)
+
+    def rmdir(self, path=''):
+        if hasattr(self._store, 'rmdir'):
+            self._store.rmdir(path)
+        else:
+            prefix = f"{path.rstrip('/')}/" if path else ''
+            for key in [key for key in self._store if key.startswith(prefix)]:
+                del self._store[key]
+        with self._lock:
+            self._layouts.clear()
+            self._indexes.clear()
+
+    def __iter__(self):
+        for key in list(self._store):
+            array, _, shard = key.rpartition(f'/{SHARD_PREFIX}/')
+            layout = self._get_layout(array) if array else None
+            if layout is None:
+                yield key
+            else:
+                yield from self._expand(layout, [key])
+
+    def __len__(self):
+        return sum(1 for _ in self)
@@ -0,0 +1,48 @@
+import fsspec
+from urllib.parse import urlparse
+
+# Local S3-compatible stand-ins (e.g. MinIO or a moto server) are addressed as
+# s3+http://host:port/bucket/prefix so the endpoint travels with the URL
+S3_COMPATIBLE_SCHEMES = ('s3+http', 's3+https')
+
+def get_filesystem(url, **storage_options):
+    # Pick the filesystem from the URL scheme:
+    # s3://bucket/prefix         -> AWS S3
+    # s3+http://host:port/bucket -> local S3-compatible server
+    # file:///path or /path      -> local directory stores
+    # memory://path              -> in-memory store (shared with forked workers)
+    parsed = urlparse(url)
+    if parsed.scheme in S3_COMPATIBLE_SCHEMES:
+        endpoint_url = f"{parsed.scheme.split('+')[-1]}://{parsed.netloc}"
+        client_kwargs = storage_options.pop('client_kwargs', {})
+        client_kwargs['endpoint_url'] = endpoint_url
+        fs = fsspec.filesystem('s3', client_kwargs=client_kwargs, **storage_options)
+        path = parsed.path.lstrip('/')
+    else:
+        if parsed.scheme == 's3':
+            storage_options.setdefault('anon', False)
+        fs, path = fsspec.core.url_to_fs(url, **storage_options)
+    return fs, path.rstrip('/')
+
+def get_mapper(url, **storage_options):
+    # Key/value view of a Zarr store, usable by xr.open_zarr and zarr.open
+    fs, path = get_filesystem(url, **storage_options)
+    return fs.get_mapper(path)
+
+def list_strategies(url, archive, **storage_options):
+    # Each chunking strategy lives in its own folder under url, holding <archive>.zarr
+    fs, path = get_filesystem(url, **storage_options)
+    all_strategies = []
+    for entry in fs.ls(path, detail=True):
+        if entry['type'] != 'directory':
+            continue
+        strategy = entry['name'].rstrip('/').split('/')[-1]
+        all_strategies.append(f"{url.rstrip('/')}/{strategy}/{archive}.zarr/")
+    return sorted(all_strategies)
+
+def copy_store(source_url, target_url):
+    # Copy every key of a store, e.g. to load a local sweep into memory:// for CI
+    source = get_mapper(source_url)
+    target = get_mapper(target_url)
+    target.setitems({key: source[key] for key in source.keys()})
+    return target
@@ -0,0 +1,110 @@
+import itertools
+import numpy as np
+import xarray as xr
+from concurrent.futures import ThreadPoolExecutor
+
+# Reductions of the streaming engine; NaN values are skipped, as by xarray's reductions
+REDUCTIONS = ['mean', 'sum', 'count', 'min', 'max', 'std']
+
+# Default bytes loaded per block
+BLOCK_BYTES = 64 * 2**20
+
+class RunningStats:
+    # Running reductions of the values seen so far in each output cell: count of valid values, sum,
+    # mean and sum of squared deviations (merged block by block as in Chan et al.), min and max
+    def __init__(self, shape):
+        self.count = np.zeros(shape, dtype='int64')
+        self.sum = np.zeros(shape, dtype='float64')
+        self.mean = np.zeros(shape, dtype='float64')
+        self.m2 = np.zeros(shape, dtype='float64')
+        self.min = np.full(shape, np.nan)
+        self.max = np.full(shape, np.nan)
+
+    def update(self, block, axis, out):
+        # Fold block, reduced over axis, into the output cells out (tuple of slices)
+        block = block.astype('float64')
+        count = np.sum(~np.isnan(block), axis=axis)
+        total = np.nansum(block, axis=axis)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+            m2 = np.nansum((block - np.expand_dims(mean, axis)) ** 2, axis=axis)
+            new_count = self.count[out] + count
+            delta = np.where(count > 0, mean - self.mean[out], 0.0)
+            weight = np.where(new_count > 0, count / new_count, 0.0)
+            self.m2[out] += np.where(count > 0, m2 + delta ** 2 * self.count[out] * weight, 0.0)
+            self.mean[out] += delta * weight
+        self.count[out] = new_count
+        self.sum[out] += total
+        self.min[out] = np.fmin(self.min[out], np.fmin.reduce(block, axis=axis))
+        self.max[out] = np.fmax(self.max[out], np.fmax.reduce(block, axis=axis))
+
+    def result(self, reduction):
+        # Population std (ddof=0) as xarray's std; mean, min, max and std are NaN without valid values
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if reduction == 'mean':
+                return np.where(self.count > 0, self.sum / self.count, np.nan)
+            if reduction == 'std':
+                return np.where(self.count > 0, np.sqrt(self.m2 / self.count), np.nan)
+        return getattr(self, reduction)
+
+def chunk_bounds(data, origin=None):
+    # [start, stop) of the stored chunks along each dimension of data, from its dask chunks,
+    # else from the chunks of its encoding
+    # origin: index in the stored array of the first element of data along each dimension, for a
+    # selection without dask, whose first stored chunk is cut by the selection start
+    if data.chunks is not None:
+        sizes = data.chunks
+    else:
+        chunks = data.encoding.get('chunks') or data.shape
+        sizes = []
+        for size, chunk, start in zip(data.shape, chunks, origin or [0] * data.ndim):
+            first = min(size, chunk - start % chunk)
+            sizes.append([first] + [chunk] * int(np.ceil((size - first) / chunk)))
+    bounds = []
+    for dim_sizes, size in zip(sizes, data.shape):
+        stops = np.minimum(np.cumsum(dim_sizes), size)
+        bounds.append(list(zip(np.concatenate([[0], stops[:-1]]), stops)))
+    return bounds
+
+def plan_blocks(data, block_bytes=BLOCK_BYTES, origin=None):
+    # Slices of blocks of whole stored chunks, at most block_bytes each (but at least one chunk);
+    # chunks are grouped along the last dimensions first. No blocks for an empty selection
+    if 0 in data.shape:
+        return []
+    bounds = chunk_bounds(data, origin)
+    groups = [1] * len(bounds)
+    nbytes = data.dtype.itemsize * int(np.prod([max(stop - start for start, stop in dim) for dim in bounds]))
+    for axis in reversed(range(len(bounds))):
+        groups[axis] = int(max(1, min(len(bounds[axis]), block_bytes // nbytes)))
+        nbytes *= groups[axis]
+    dim_slices = []
+    for dim_bounds, group in zip(bounds, groups):
+        dim_slices.append([slice(int(dim_bounds[i][0]), int(dim_bounds[min(i + group, len(dim_bounds)) - 1][1]))
+                           for i in range(0, len(dim_bounds), group)])
+    return list(itertools.product(*dim_slices))
+
+def reduce(data, dims, reductions=('mean',), block_bytes=BLOCK_BYTES, origin=None):
+    # Reductions of data over dims, computed block by block: only a block (and the next one,
+    # fetched meanwhile) is in memory, plus the accumulators, which have the shape of the result
+    # origin: see chunk_bounds(); an empty selection gives NaN (0 for sum and count), as xarray
+    # Returns {reduction: DataArray}
+    axis = tuple(data.dims.index(dim) for dim in dims)
+    kept = [dim for dim in data.dims if dim not in dims]
+    stats = RunningStats(tuple(data.sizes[dim] for dim in kept))
+    blocks = plan_blocks(data, block_bytes, origin)
+
+    def load(block):
+        return np.asarray(data.isel(dict(zip(data.dims, block))).values)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(load, blocks[0]) if blocks else None
+        for block_i, block in enumerate(blocks):
+            values = future.result()
+            if block_i + 1 < len(blocks):
+                future = executor.submit(load, blocks[block_i + 1])
+            out = tuple(block[data.dims.index(dim)] for dim in kept)
+            stats.update(values, axis, out)
+            del values
+
+    coords = {dim: data[dim].values for dim in kept if dim in data.coords}
+    return {reduction: xr.DataArray(stats.result(reduction), dims=kept, coords=coords) for reduction in reductions}
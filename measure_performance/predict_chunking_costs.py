@@ -0,0 +1,88 @@
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import modules.stores as stores
+import modules.cost_model as cost_model
+
+# Candidate chunkings, including ones that were never rechunked
+# Note: 999 = maximal chunk size (e.g., time dim in geos-fp: 5136)
+TIME_CHUNKS = [1, 6, 12, 24, 48, 120, 240, 720, 1440, 2160, 999]
+LONLAT_CHUNKS = [(10, 10), (10, 50), (50, 10), (10, 100), (100, 10), (50, 50),
+                 (50, 100), (100, 50), (100, 100), (200, 200), (999, 999)]
+
+# Same selections as the tasks in measure_performance.main()
+QUERIES = {
+    'time_series':                 dict(task='time', date=None, lat=47.61, lon=-122.19, method='nearest'),
+    'time_series_over_region_usa': dict(task='time', date=None, lat=slice(24.9, 49.4), lon=slice(-124.9, -66.7), method=None),
+    'map_over_time_30_day':        dict(task='map', date=slice('2020-06-01', '2020-06-30'), lat=None, lon=None, method=None),
+    'map_one_timestep':            dict(task='map_one_timestep', date='2020-06-01', lat=None, lon=None, method=None),
+}
+
+def setup_args():
+    parser = argparse.ArgumentParser(description="Rank chunk shapes with the chunk access cost model")
+    parser.add_argument('--store_url', type=str, default='s3://eis-dh-fire/geos-fp-global/inst.zarr',
+                        help='Any store holding the variable; only its metadata and coordinates are read')
+    parser.add_argument('--latency', type=float, default=cost_model.REQUEST_LATENCY, help='Per-request latency (sec)')
+    parser.add_argument('--bandwidth', type=float, default=cost_model.BANDWIDTH, help='Bandwidth (byte/sec)')
+    parser.add_argument('--concurrency', type=int, default=1, help='Number of requests in flight')
+    return parser.parse_args()
+
+def read_compression_ratios(filepath, nbytes, all_lookup):
+    # Measured ratio of uncompressed to stored size for each rechunked strategy, keyed by (time, lat, lon)
+    df = pd.read_csv(filepath, index_col=0, dtype=str)
+    ratios = {}
+    columns = ['time_chunks', 'lon_chunks', 'lat_chunks', 'archive_size']
+    for time_chunk, lon_chunk, lat_chunk, archive_size in df[columns].itertuples(index=False, name=None):
+        time_chunk = all_lookup['time'] if time_chunk == 'all' else int(time_chunk)
+        lon_chunk = all_lookup['lon'] if lon_chunk == 'all' else int(lon_chunk)
+        lat_chunk = all_lookup['lat'] if lat_chunk == 'all' else int(lat_chunk)
+        ratios[(time_chunk, lat_chunk, lon_chunk)] = nbytes / int(archive_size)
+    return ratios
+
+def main(args):
+    dataset = 'geos-fp-global_inst'
+    variable = 'BCEXTTAU'
+
+    # Open metadata and coordinates only
+    mapper = stores.get_mapper(args.store_url)
+    data = xr.open_zarr(mapper, consolidated=True)
+    select_data = data[variable]
+    select_data['time'] = np.sort(select_data['time'].values)
+    all_lookup = dict(select_data.sizes)
+
+    queries = {name: cost_model.selection_ranges(select_data, **query) for name, query in QUERIES.items()}
+
+    candidates = []
+    for time_chunk, (lon_chunk, lat_chunk) in itertools.product(TIME_CHUNKS, LONLAT_CHUNKS):
+        candidates.append({
+            'time': all_lookup['time'] if time_chunk == 999 else time_chunk,
+            'lon': all_lookup['lon'] if lon_chunk == 999 else lon_chunk,
+            'lat': all_lookup['lat'] if lat_chunk == 999 else lat_chunk,
+        })
+
+    # Chunkings without a measured archive size use the median ratio
+    compression_ratios = read_compression_ratios(f'../data/{dataset}/performance_data/archive_sizes.csv',
+                                                 select_data.nbytes, all_lookup)
+    default_ratio = float(np.median(list(compression_ratios.values())))
+    print(f'Median compression ratio: {default_ratio:0.2f}')
+
+    ranking = cost_model.rank_chunk_shapes(
+        select_data.dims,
+        queries,
+        candidates,
+        select_data.dtype.itemsize,
+        compression_ratios=compression_ratios,
+        default_ratio=default_ratio,
+        request_latency=args.latency,
+        bandwidth=args.bandwidth,
+        concurrency=args.concurrency
+    )
+    ranking.to_csv(f'../data/{dataset}/performance_data/predicted_chunking_costs.csv')
+    print(ranking[['time_chunks', 'lon_chunks', 'lat_chunks', 'weighted_cost']].head(20).to_string())
+
+if __name__ == '__main__':
+    args = setup_args()
+    main(args)
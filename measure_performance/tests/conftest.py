@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The benchmark modules are imported as modules.<name>, from measure_performance/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+
+import modules.pyramid as pyramid
+
+def make_pyramid(levels=('daily',), factors=(2,)):
+    # Hourly data on a coarse grid, with its pyramid in a memory store
+    times = pd.date_range('2020-06-01', periods=24 * 10, freq='h')
+    lat = np.arange(-90, 91, 10.0)
+    lon = np.arange(-180, 180, 20.0)
+    values = np.random.default_rng(0).random((len(times), len(lat), len(lon))).astype('float32')
+    data = xr.DataArray(values, dims=['time', 'lat', 'lon'], coords={'time': times, 'lat': lat, 'lon': lon})
+    store = zarr.MemoryStore()
+    for level in levels:
+        pyramid.write_level(store, 'var', level, pyramid.build_temporal_level(data, level))
+    for factor in factors:
+        pyramid.write_level(store, 'var', factor, pyramid.build_spatial_level(data, factor))
+    zarr.consolidate_metadata(store)
+    return data, pyramid.Pyramid(store, 'var')
+
+def test_region_mean_equals_raw():
+    data, pyr = make_pyramid()
+    lat, lon = slice(-50, 50), slice(-100, 100)
+    result = pyr.query(data, 'time', None, lat, lon, None)
+    expected = data.sel(lat=lat, lon=lon).mean(['lat', 'lon'])
+    np.testing.assert_allclose(result.values, expected.values, rtol=1e-6)
+
+def test_empty_region_is_nan():
+    # No grid cell between two grid lines: NaN for every timestep, as the mean of raw data
+    data, pyr = make_pyramid()
+    lat, lon = slice(41, 49), slice(-100, 100)
+    result = pyr.query(data, 'time', None, lat, lon, None)
+    assert result.sizes == {'time': data.sizes['time']}
+    assert np.isnan(result.values).all()
+    assert np.isnan(data.sel(lat=lat, lon=lon).mean(['lat', 'lon']).values).all()
+
+def test_empty_time_window_is_nan():
+    data, pyr = make_pyramid()
+    date = slice('2021-01-01', '2021-01-02')
+    result = pyr.query(data, 'map', date, None, None, None)
+    assert result.sizes == {'lat': data.sizes['lat'], 'lon': data.sizes['lon']}
+    assert np.isnan(result.values).all()
@@ -0,0 +1,19 @@
+import modules.sampling as sampling
+
+def test_no_early_stop_on_few_samples():
+    # Two equal samples have a zero-width interval, which must not stop the series
+    assert sampling.relative_ci([1.0, 1.0]) == 0
+    assert sampling.needs_more([1.0, 1.0], min_trials=2, max_trials=20, target_rel_ci=0.05)
+    assert sampling.needs_more([1.0] * (sampling.MIN_CI_TRIALS - 1), min_trials=2, max_trials=20,
+                               target_rel_ci=0.05)
+
+def test_stops_once_ci_is_within_target():
+    samples = [1.0] * sampling.MIN_CI_TRIALS
+    assert not sampling.needs_more(samples, min_trials=2, max_trials=20, target_rel_ci=0.05)
+
+def test_max_trials_caps_the_floor():
+    assert not sampling.needs_more([1.0, 2.0, 3.0], min_trials=2, max_trials=3, target_rel_ci=0.05)
+
+def test_fixed_trials_without_target():
+    assert sampling.needs_more([1.0], min_trials=2)
+    assert not sampling.needs_more([1.0, 5.0], min_trials=2)
@@ -0,0 +1,44 @@
+import numpy as np
+import xarray as xr
+import zarr
+
+import modules.streaming as streaming
+
+def open_stored(chunks=(10, 4, 4), use_dask=False):
+    # Variable of a memory store with the given stored chunks, opened with or without dask
+    values = np.random.default_rng(0).random((50, 19, 36))
+    values[values < 0.05] = np.nan
+    data = xr.Dataset({'var': (['time', 'lat', 'lon'], values)},
+                      coords={'time': np.arange(50), 'lat': np.arange(19.0), 'lon': np.arange(36.0)})
+    store = zarr.MemoryStore()
+    data.to_zarr(store, encoding={'var': {'chunks': chunks}}, consolidated=True)
+    return xr.open_zarr(store, consolidated=True, chunks={} if use_dask else None)['var']
+
+def test_streaming_equals_raw():
+    data = open_stored(use_dask=True)
+    result = streaming.reduce(data, ['lat', 'lon'], streaming.REDUCTIONS, block_bytes=4096)
+    for reduction in streaming.REDUCTIONS:
+        np.testing.assert_allclose(result[reduction].values, getattr(data, reduction)(['lat', 'lon']).values)
+
+def test_blocks_line_up_with_stored_chunks_without_dask():
+    # Selection starting inside a stored chunk: blocks split at the stored chunk boundaries,
+    # counted from the array origin, so no chunk is read by two blocks
+    origin = [13, 5, 2]
+    data = open_stored().isel(time=slice(13, 47), lat=slice(5, 19), lon=slice(2, 30))
+    blocks = streaming.plan_blocks(data, block_bytes=1, origin=origin)
+    for block in blocks:
+        for dim_slice, start, chunk, size in zip(block, origin, (10, 4, 4), data.shape):
+            assert dim_slice.start == 0 or (start + dim_slice.start) % chunk == 0
+            assert dim_slice.stop == size or (start + dim_slice.stop) % chunk == 0
+    result = streaming.reduce(data, ['time'], ['mean'], block_bytes=1, origin=origin)['mean']
+    np.testing.assert_allclose(result.values, data.mean('time').values)
+
+def test_empty_selection_is_nan():
+    # Same result as xarray's mean of an empty selection, with or without dask
+    for use_dask in [True, False]:
+        data = open_stored(use_dask=use_dask).isel(lat=slice(0, 0))
+        assert streaming.plan_blocks(data) == []
+        result = streaming.reduce(data, ['lat', 'lon'], ['mean', 'count'])
+        assert result['mean'].sizes == {'time': 50}
+        assert np.isnan(result['mean'].values).all()
+        assert (result['count'].values == 0).all()
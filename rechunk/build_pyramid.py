@@ -0,0 +1,55 @@
+import sys
+import zarr
+import argparse
+import xarray as xr
+from pathlib import Path
+from dask.diagnostics import ProgressBar
+
+# Pyramid levels are shared with the query planner in ../measure_performance/modules
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'measure_performance'))
+import modules.pyramid as pyramid
+import modules.sharding as sharding
+
+def setup_args():
+    parser = argparse.ArgumentParser(description="Build aggregate pyramids next to rechunked Zarr stores")
+    parser.add_argument('--store_url', type=str, nargs='+',
+                        help='Rechunked store URL(s), e.g. s3://eis-dh-fire/dieumynguyen_rechunked/<dataset>/<strategy>/inst.zarr')
+    parser.add_argument('--data_variable', type=str, default='BCEXTTAU', help='Variable to aggregate')
+    parser.add_argument('--temporal', type=str, default=','.join(pyramid.TEMPORAL_LEVELS),
+                        help=f'Temporal levels, any of {list(pyramid.TEMPORAL_LEVELS)}; "" for none')
+    parser.add_argument('--spatial', type=str, default=','.join(str(f) for f in pyramid.SPATIAL_FACTORS),
+                        help='Spatial coarsening factors, e.g. "2,4,8,16"; "" for none')
+    parser.add_argument('--restart', action='store_true', help='Rebuild levels written by an earlier run')
+    return parser.parse_args()
+
+def build_pyramid(store_url, args):
+    # Levels already listed in the pyramid are complete: a rerun only builds the others
+    store = sharding.ShardedStore(zarr.storage.FSStore(store_url))
+    data = xr.open_zarr(store, consolidated=True)[args.data_variable]
+    written = pyramid.list_levels(store)
+    if args.restart or written['variable'] != args.data_variable:
+        written = {'temporal': [], 'spatial': []}
+    levels = [level for level in args.temporal.split(',') if level and level not in written['temporal']]
+    levels += [int(f) for f in args.spatial.split(',') if f and int(f) not in written['spatial']]
+
+    for level in levels:
+        print(f'Building level: {pyramid.get_level_group(level)}')
+        if isinstance(level, str):
+            level_data = pyramid.build_temporal_level(data, level)
+        else:
+            level_data = pyramid.build_spatial_level(data, level)
+        with ProgressBar():
+            pyramid.write_level(store, args.data_variable, level, level_data)
+
+    # Levels are opened from the store's consolidated metadata
+    zarr.consolidate_metadata(store)
+
+def main(args):
+    for store_url in args.store_url:
+        print(f'Building pyramid of {args.data_variable} in: {store_url}')
+        build_pyramid(store_url, args)
+    print("Done!")
+
+if __name__ == '__main__':
+    args = setup_args()
+    main(args)
@@ -0,0 +1,29 @@
+import sys
+import zarr
+import argparse
+from pathlib import Path
+
+import modules.resumable as resumable
+
+# Sharded outputs are read through the sharded layout of ../measure_performance/modules
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'measure_performance'))
+import modules.sharding as sharding
+
+def setup_args():
+    parser = argparse.ArgumentParser(description="Check whether a rechunked Zarr store was completely written")
+    parser.add_argument('--store_url', type=str, nargs='+',
+                        help='Output store URL(s), e.g. s3://eis-dh-fire/dieumynguyen_rechunked/<dataset>/<strategy>/inst.zarr')
+    return parser.parse_args()
+
+def main(args):
+    n_incomplete = 0
+    for store_url in args.store_url:
+        print(f'Checking: {store_url}')
+        report, complete = resumable.check_complete(sharding.ShardedStore(zarr.storage.FSStore(store_url, mode='r')))
+        resumable.print_report(report, complete)
+        n_incomplete += not complete
+    print(f'Incomplete stores: {n_incomplete} / {len(args.store_url)}')
+
+if __name__ == '__main__':
+    args = setup_args()
+    main(args)
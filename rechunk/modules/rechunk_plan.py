@@ -0,0 +1,106 @@
+import os
+import psutil
+import numpy as np
+import pandas as pd
+from dask.utils import parse_bytes, format_bytes
+from rechunker.algorithm import rechunking_plan
+
+# Leave room for the Python process, dask bookkeeping and compression buffers
+MEM_FRACTION = 0.6
+
+def read_cgroup_limit():
+    # Memory limit of the job's cgroup (v2, then v1), None if unlimited
+    for path in ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']:
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value != 'max' and int(value) < 2**60:
+            return int(value)
+    return None
+
+def get_available_memory():
+    # Memory actually available to the job: the smallest of the slurm allocation,
+    # the cgroup limit and the memory currently free on the node
+    # Units: byte
+    limits = [psutil.virtual_memory().available]
+    if 'SLURM_MEM_PER_NODE' in os.environ:
+        limits.append(int(os.environ['SLURM_MEM_PER_NODE']) * 2**20)
+    elif 'SLURM_MEM_PER_CPU' in os.environ:
+        n_cpus = int(os.environ.get('SLURM_CPUS_ON_NODE', 1))
+        limits.append(int(os.environ['SLURM_MEM_PER_CPU']) * n_cpus * 2**20)
+    cgroup_limit = read_cgroup_limit()
+    if cgroup_limit is not None:
+        limits.append(cgroup_limit)
+    return min(limits)
+
+def choose_max_mem(available_memory, num_workers=1, mem_fraction=MEM_FRACTION):
+    # rechunker's max_mem bounds a single copy task; num_workers tasks run at the same time
+    return int(available_memory * mem_fraction / num_workers)
+
+def count_chunk_ops(shape, block_chunks, array_chunks):
+    # Number of (block, chunk) pairs when an array with array_chunks is read or written in blocks of block_chunks
+    n_ops = 1
+    for size, block, chunk in zip(shape, block_chunks, array_chunks):
+        starts = np.arange(0, size, block)
+        stops = np.minimum(starts + block, size)
+        n_ops *= int(np.sum((stops - 1) // chunk - starts // chunk + 1))
+    return n_ops
+
+def plan_rechunk(shape, source_chunks, target_chunks, itemsize, max_mem, consolidate_reads=False):
+    # Plan of one array (rechunker's rechunking_plan()), as resumable.execute_plan() then copies it
+    # stage by stage with copy_stage(); only planned here, nothing is copied
+    # consolidate_reads is False for xarray/dask sources, as in rechunker
+    max_mem = parse_bytes(max_mem) if isinstance(max_mem, str) else int(max_mem)
+    read_chunks, int_chunks, write_chunks = rechunking_plan(
+        shape, source_chunks, target_chunks, itemsize, max_mem, consolidate_reads=consolidate_reads
+    )
+    nbytes = int(np.prod(shape)) * itemsize
+    use_intermediate = not (read_chunks == write_chunks or read_chunks == int_chunks)
+    n_stages = 2 if use_intermediate else 1
+
+    # Chunk reads and writes of each stage: source -> (intermediate ->) target
+    if use_intermediate:
+        chunk_reads = (count_chunk_ops(shape, read_chunks, source_chunks) +
+                       count_chunk_ops(shape, write_chunks, int_chunks))
+        chunk_writes = (count_chunk_ops(shape, read_chunks, int_chunks) +
+                        count_chunk_ops(shape, write_chunks, target_chunks))
+    else:
+        chunk_reads = count_chunk_ops(shape, read_chunks, source_chunks)
+        chunk_writes = count_chunk_ops(shape, write_chunks, target_chunks)
+
+    return {
+        'max_mem': max_mem,
+        'n_stages': n_stages,
+        'read_chunks': tuple(int(c) for c in read_chunks),
+        'int_chunks': tuple(int(c) for c in int_chunks) if use_intermediate else None,
+        'write_chunks': tuple(int(c) for c in write_chunks),
+        'chunk_reads': chunk_reads,
+        'chunk_writes': chunk_writes,
+        # Uncompressed bytes moved; every stage reads and writes the whole array
+        'bytes_read': nbytes * n_stages,
+        'bytes_written': nbytes * n_stages,
+        # Uncompressed upper bound of the temp store
+        'temp_bytes': nbytes if use_intermediate else 0,
+    }
+
+def print_plan(name, plan):
+    print(f'Rechunking plan for {name} (max_mem: {format_bytes(plan["max_mem"])}):')
+    print(f'  stages: {plan["n_stages"]} -- read chunks: {plan["read_chunks"]} -- '
+          f'intermediate chunks: {plan["int_chunks"]} -- write chunks: {plan["write_chunks"]}')
+    print(f'  chunk reads: {plan["chunk_reads"]} -- chunk writes: {plan["chunk_writes"]}')
+    print(f'  bytes read: {format_bytes(plan["bytes_read"])} -- bytes written: {format_bytes(plan["bytes_written"])} -- '
+          f'temp store: {format_bytes(plan["temp_bytes"])}')
+
+def compare_plans(shape, source_chunks, target_chunks, itemsize, budgets, consolidate_reads=False):
+    # Plans at several memory budgets, e.g. to pick the node size for a target chunking
+    rows = []
+    for budget in budgets:
+        try:
+            plan = plan_rechunk(shape, source_chunks, target_chunks, itemsize, budget, consolidate_reads)
+        except ValueError as e:
+            # A source or target chunk does not fit in the budget
+            plan = {'max_mem': parse_bytes(budget) if isinstance(budget, str) else budget, 'error': str(e)}
+        rows.append(plan)
+    return pd.DataFrame(rows)
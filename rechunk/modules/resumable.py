@@ -0,0 +1,123 @@
+import sys
+import itertools
+import zarr
+from concurrent.futures import ThreadPoolExecutor
+
+# Completion markers live next to the data, so a rerun of the same job finds them
+# wherever it runs: one empty object per copied block, one per finished stage
+PROGRESS_PREFIX = '.rechunk_progress'
+INITIALIZED_KEY = f'{PROGRESS_PREFIX}/initialized'
+
+def iter_blocks(shape, block_chunks):
+    # (block id, slices) of every block of block_chunks covering an array of shape
+    grid = [range(0, size, block) for size, block in zip(shape, block_chunks)]
+    for starts in itertools.product(*grid):
+        block_id = '.'.join(str(start // block) for start, block in zip(starts, block_chunks))
+        slices = tuple(slice(start, min(start + block, size))
+                       for start, block, size in zip(starts, block_chunks, shape))
+        yield block_id, slices
+
+def get_stage_name(stage, block_chunks):
+    # The block shape is part of the name: a rerun with another plan (e.g. on a node with
+    # less memory) must not trust markers of blocks it would cut differently
+    return f"{stage}_{'x'.join(str(c) for c in block_chunks)}"
+
+def completed_blocks(store, name, stage_name):
+    return set(zarr.storage.listdir(store, f'{PROGRESS_PREFIX}/{name}/{stage_name}'))
+
+def copy_stage(source, target, block_chunks, progress_store, name, stage, num_workers):
+    # Copy source to target in blocks of block_chunks, skipping blocks copied by an earlier run
+    stage_name = get_stage_name(stage, block_chunks)
+    stage_key = f'{PROGRESS_PREFIX}/{name}/{stage_name}.complete'
+    if stage_key in progress_store:
+        print(f'{name} - {stage}: already complete, skipping')
+        return
+
+    done = completed_blocks(progress_store, name, stage_name)
+    blocks = [(block_id, slices) for block_id, slices in iter_blocks(source.shape, block_chunks)
+              if block_id not in done]
+    n_blocks = len(done) + len(blocks)
+    print(f'{name} - {stage}: {len(done)} / {n_blocks} blocks already copied')
+
+    def copy_block(block):
+        block_id, slices = block
+        target[slices] = source[slices]
+        # Only marked once the whole block is in the target
+        progress_store[f'{PROGRESS_PREFIX}/{name}/{stage_name}/{block_id}'] = b''
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for block_i, _ in enumerate(executor.map(copy_block, blocks), start=len(done) + 1):
+            sys.stdout.write(f'\r{name} - {stage}: {block_i} / {n_blocks} blocks')
+            sys.stdout.flush()
+    print()
+    progress_store[stage_key] = b''
+
+def open_intermediate(temp_store, name, source, int_chunks):
+    # Reuse the intermediate of an earlier run if it has the same layout, else start it over
+    # Blocks of the first stage may share intermediate chunks: writes are synchronized
+    synchronizer = zarr.ThreadSynchronizer()
+    try:
+        int_array = zarr.open_array(temp_store, mode='r+', path=name, synchronizer=synchronizer,
+                                    write_empty_chunks=True)
+        if (int_array.shape == source.shape and int_array.chunks == tuple(int_chunks) and
+                int_array.dtype == source.dtype):
+            return int_array
+    except (KeyError, ValueError, zarr.errors.ArrayNotFoundError):
+        pass
+    zarr.storage.rmdir(temp_store, f'{PROGRESS_PREFIX}/{name}')
+    return zarr.open_array(temp_store, mode='w', path=name, shape=source.shape, chunks=int_chunks,
+                           dtype=source.dtype, fill_value=source.fill_value, synchronizer=synchronizer,
+                           write_empty_chunks=True)
+
+def init_target(input_data, target_chunks, target_store, encoding=None):
+    # Write the target's metadata and coordinates once; a rerun keeps the chunks written so far
+    # encoding: replaces parts of the source encoding of the data variables, e.g. the compressor
+    if INITIALIZED_KEY in target_store:
+        print('Target store already initialized, resuming')
+        return
+    target_data = input_data.copy()
+    for name in input_data.data_vars:
+        chunks = target_chunks[name]
+        source_encoding = {k: v for k, v in input_data[name].encoding.items() if k not in ['chunks', 'preferred_chunks']}
+        target_data[name] = input_data[name].chunk(chunks)
+        target_data[name].encoding = {**source_encoding, **(encoding or {}),
+                                      'chunks': tuple(chunks[dim] for dim in input_data[name].dims)}
+    target_data.to_zarr(target_store, mode='w', compute=False, consolidated=False)
+    target_store[INITIALIZED_KEY] = b''
+
+def execute_plan(source, target_store, temp_store, name, plan, num_workers, data_store=None):
+    # Run a rechunk_plan.plan_rechunk() plan for one array: source -> (intermediate ->) target
+    # data_store: view of target_store the chunks are written through (e.g. a sharding.ShardedStore),
+    # progress markers still go to target_store
+    target = zarr.open_array(data_store or target_store, mode='r+', path=name, write_empty_chunks=True)
+    if plan['int_chunks'] is not None:
+        int_array = open_intermediate(temp_store, name, source, plan['int_chunks'])
+        copy_stage(source, int_array, plan['read_chunks'], temp_store, name, 'stage1', num_workers)
+        copy_stage(int_array, target, plan['write_chunks'], target_store, name, 'stage2', num_workers)
+    else:
+        # Write blocks are whole target chunks, so no two blocks write to the same chunk
+        copy_stage(source, target, plan['write_chunks'], target_store, name, 'stage1', num_workers)
+
+def check_complete(store):
+    # Compare the chunks each array's metadata expects with the chunks present in the store
+    # Returns {array name: (chunks present, chunks expected)} and whether the store is complete,
+    # i.e. has every chunk and was finalized (no progress markers left)
+    group = zarr.open_group(store, mode='r')
+    report = {}
+    for name, array in group.arrays():
+        report[name] = (array.nchunks_initialized, array.nchunks)
+    finalized = PROGRESS_PREFIX not in zarr.storage.listdir(store)
+    return report, finalized and has_all_chunks(report)
+
+def has_all_chunks(report):
+    return len(report) > 0 and all(present == expected for present, expected in report.values())
+
+def print_report(report, complete):
+    for name, (present, expected) in report.items():
+        status = 'ok' if present == expected else f'missing {expected - present}'
+        print(f'  {name}: {present} / {expected} chunks -- {status}')
+    print(f'  complete: {complete}')
+
+def finalize_target(target_store):
+    zarr.storage.rmdir(target_store, PROGRESS_PREFIX)
+    zarr.consolidate_metadata(target_store)
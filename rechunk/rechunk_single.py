@@ -1,18 +1,33 @@
+import os
+import sys
 import s3fs 
 import zarr
+import fsspec
 import shutil
 import argparse
-import rechunker
 import xarray as xr
 from pathlib import Path
-from dask.diagnostics import ProgressBar
+from dask.utils import format_bytes
+
+import modules.rechunk_plan as rechunk_plan
+import modules.resumable as resumable
+
+# Network simulation, codec specs and the sharded layout are shared with the benchmarks in ../measure_performance/modules
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'measure_performance'))
+import modules.netsim as netsim
+import modules.compression as compression
+import modules.sharding as sharding
 
 def setup_args():
     parser = argparse.ArgumentParser(description="Generic rechunking script")
     parser.add_argument('--strat_description', type=str, help='Kind of chunking strategy, e.g. "hybrid" ') 
-    parser.add_argument('--input_path', type=str, help='Input path on S3') # If no default, default is None  # 'eis-dh-fire/imerg-fwi.zarr'
-    parser.add_argument('--output_path', type=str, help='Output path on S3')
+    parser.add_argument('--input_path', type=str, help='Input path on S3, or URL of another store, '
+                        'e.g. file:///data/inst.zarr') # If no default, default is None  # 'eis-dh-fire/imerg-fwi.zarr'
+    parser.add_argument('--output_path', type=str, help='Output folder URL, one sub-folder per strategy. '
+                        'Defaults to s3://eis-dh-fire/dieumynguyen_rechunked/<dataset>')
     parser.add_argument('--tmp_path', type=str, help='Temporary path')
+    parser.add_argument('--stage_path', type=str, default=None,
+                        help='Local copy of the input shared by the --targets. Defaults to <tmp_path>-staged')
     parser.add_argument('--timevar', type=str, help='Name of time variable', default='time')
     parser.add_argument('--xvar', type=str, help='Name of x variable', default='lon')
     parser.add_argument('--yvar', type=str, help='Name of y variable', default='lat')
@@ -20,86 +35,162 @@ def setup_args():
     parser.add_argument('--xchunk', type=int, help='Chunks for x variable', default=10)
     parser.add_argument('--ychunk', type=int, help='Chunks for y variable', default=10)
     parser.add_argument('--data_variable', type=str, help='Variable to select from dataset', default=None)
+    parser.add_argument('--targets', type=str, default=None,
+                        help='Several target chunkings written from one read of the input, as '
+                             '"time,x,y;time,x,y;..." (999 = all). Overrides --timechunk/--xchunk/--ychunk')
+    parser.add_argument('--max_requests', type=int, default=64,
+                        help='Max number of chunk uploads in flight to the output store')
+    parser.add_argument('--max_mem', type=str, default=None,
+                        help='Memory per copy task, e.g. "16GiB". Defaults to a share of the memory available to the job')
+    parser.add_argument('--compare_mem', type=str, default=None,
+                        help='Also report the plans at these memory budgets, e.g. "8GiB,32GiB,128GiB"')
+    parser.add_argument('--plan_only', action='store_true', help='Report the rechunking plans without executing them')
+    parser.add_argument('--codec', type=str, default=None,
+                        help='Compressor of the output: "none" or "<cname>-<clevel>-<shuffle>" (Blosc), e.g. '
+                             '"zstd-5-bitshuffle". Defaults to the source encoding')
+    parser.add_argument('--shard', type=str, default=None,
+                        help='Store the output sharded: chunks per shard object along "time,x,y", e.g. "1,4,4". '
+                             'Defaults to one object per chunk')
+    parser.add_argument('--network_profile', type=str, default=None, choices=list(netsim.NETWORK_PROFILES),
+                        help='Simulate the latency, bandwidth, connection limit and throttling of this network '
+                             'profile on input reads and output writes, e.g. to rehearse S3 jobs on local stores')
+    parser.add_argument('--restart', action='store_true',
+                        help='Delete the output and temp data of an earlier run instead of resuming it')
     return parser.parse_args()
 
-def setup_output_path(path, strategy, base_name, dataset_name, folder_name, output_type):
+def setup_output_path(path, strategy, base_name, dataset_name, folder_name, output_type, restart=False):
     if path is None:
         path = Path(f'/efs/dieumynguyen/{dataset_name}/{folder_name}/{strategy}') / base_name
-        if path.is_dir():
+        # An old dir holds the progress of an interrupted run, which is resumed
+        if path.is_dir() and restart:
             print('Cleaning up old dir.')
             shutil.rmtree(str(path)) 
         path.parent.mkdir(exist_ok=True, parents=True)
     return path
 
-def create_dirs(args):
-    if args.timechunk == 'all' and args.xchunk == 'all' and args.ychunk == 'all':
-        strategy = f'time{args.timechunk}_lat{args.ychunk}_lon{args.xchunk}'
-    elif args.timechunk == 'all' and args.xchunk != 'all' and args.ychunk != 'all':
-        strategy = f'time{args.timechunk}_lat{args.ychunk:04d}_lon{args.xchunk:04d}'
-    elif args.timechunk != 'all' and args.xchunk == 'all' and args.ychunk == 'all':
-        strategy = f'time{args.timechunk:04d}_lat{args.ychunk}_lon{args.xchunk}'
-    elif args.timechunk != 'all' and args.xchunk == 'all' and args.ychunk != 'all':  # x = lon
-        strategy = f'time{args.timechunk:04d}_lat{args.ychunk:04d}_lon{args.xchunk}'
-    elif args.timechunk != 'all' and args.xchunk != 'all' and args.ychunk == 'all':  # y = lat
-        strategy = f'time{args.timechunk:04d}_lat{args.ychunk}_lon{args.xchunk:04d}'
+def get_strategy(timechunk, xchunk, ychunk):
+    if timechunk == 'all' and xchunk == 'all' and ychunk == 'all':
+        strategy = f'time{timechunk}_lat{ychunk}_lon{xchunk}'
+    elif timechunk == 'all' and xchunk != 'all' and ychunk != 'all':
+        strategy = f'time{timechunk}_lat{ychunk:04d}_lon{xchunk:04d}'
+    elif timechunk != 'all' and xchunk == 'all' and ychunk == 'all':
+        strategy = f'time{timechunk:04d}_lat{ychunk}_lon{xchunk}'
+    elif timechunk != 'all' and xchunk == 'all' and ychunk != 'all':  # x = lon
+        strategy = f'time{timechunk:04d}_lat{ychunk:04d}_lon{xchunk}'
+    elif timechunk != 'all' and xchunk != 'all' and ychunk == 'all':  # y = lat
+        strategy = f'time{timechunk:04d}_lat{ychunk}_lon{xchunk:04d}'
     else:
-        strategy = f'time{args.timechunk:04d}_lat{args.ychunk:04d}_lon{args.xchunk:04d}'
+        strategy = f'time{timechunk:04d}_lat{ychunk:04d}_lon{xchunk:04d}'
+    return strategy
 
+def get_dataset_name(input_path):
     # Get base dir name
-    base_name = Path(args.input_path).name   # Truncate to only file part
-    if args.input_path == 'eis-dh-fire/imerg-fwi.zarr':
+    base_name = Path(input_path).name   # Truncate to only file part
+    if input_path == 'eis-dh-fire/imerg-fwi.zarr':
         dataset_name = f"{base_name.split('.')[0]}"
     else:
-        dataset_name = f"{args.input_path.split('/')[1]}_{base_name.split('.')[0]}"
+        dataset_name = f"{input_path.split('/')[1]}_{base_name.split('.')[0]}"
+    return base_name, dataset_name
 
-    # Output path
-    output_path = args.output_path
-    output_path = setup_output_path(output_path, strategy, base_name, dataset_name,'rechunked', 'final output')
+def get_output_name(args):
+    # Outputs of each codec and shard layout go to their own folders
+    base_name, dataset_name = get_dataset_name(args.input_path)
+    if args.codec is not None:
+        dataset_name = f'{dataset_name}_{args.codec}'
+    if args.shard is not None:
+        dataset_name = f"{dataset_name}_shard{args.shard.replace(',', 'x')}"
+    return base_name, dataset_name
 
-    # Temp path
+def create_dirs(args, timechunk, xchunk, ychunk):
+    strategy = get_strategy(timechunk, xchunk, ychunk)
+    base_name, dataset_name = get_output_name(args)
+
+    # Temp path, local: only holds the intermediate of the rechunking
     tmp_path = args.tmp_path
-    tmp_path = setup_output_path(tmp_path, strategy, base_name, dataset_name, 'tmp-rechunk', 'temp output')
+    tmp_path = setup_output_path(tmp_path, strategy, base_name, dataset_name, 'tmp-rechunk', 'temp output',
+                                 restart=args.restart)
+
+    # Output URL, written directly by the copy tasks
+    output_root = args.output_path or f's3://eis-dh-fire/dieumynguyen_rechunked/{dataset_name}'
+    output_url = f"{output_root.rstrip('/')}/{strategy}/{base_name}"
 
-    # Create s3 path
-    s3_target = Path(f'eis-dh-fire/dieumynguyen_rechunked/{dataset_name}/{strategy}') / base_name
+    return output_url, tmp_path, strategy, base_name
 
-    return output_path, tmp_path, strategy, base_name, s3_target
+def setup_target_store(output_url, restart=False):
+    target_store = zarr.storage.FSStore(output_url)
+    if restart and target_store.fs.exists(target_store.path):
+        print('Cleaning up old output.')
+        target_store.fs.rm(target_store.path, recursive=True)
+    return target_store
+
+def simulate_network(store, args):
+    # Requests to store get the latency and bandwidth of the chosen network profile
+    if args.network_profile is None:
+        return store
+    return netsim.SimulatedStore(store, **netsim.NETWORK_PROFILES[args.network_profile])
 
 def convert_all(var):
     if var == 999:
         var = 'all'
     return var
 
-def main(args):
-    args.timechunk = convert_all(args.timechunk)
-    args.xchunk = convert_all(args.xchunk)
-    args.ychunk = convert_all(args.ychunk)
-    print(args.timechunk, args.xchunk, args.ychunk)
+def parse_shard(args):
+    # Chunks per shard by dimension name, None for unsharded outputs
+    if args.shard is None:
+        return None
+    time_shard, x_shard, y_shard = [int(n) for n in args.shard.split(',')]
+    return {args.timevar: time_shard, args.xvar: x_shard, args.yvar: y_shard}
 
-    # Create output dirs
-    output_path, tmp_path, strategy, base_name, s3_target = create_dirs(args)
+def parse_targets(args):
+    # List of (time, x, y) target chunkings
+    if args.targets is None:
+        return [(args.timechunk, args.xchunk, args.ychunk)]
+    targets = []
+    for target in args.targets.split(';'):
+        timechunk, xchunk, ychunk = [convert_all(int(c)) for c in target.split(',')]
+        targets.append((timechunk, xchunk, ychunk))
+    return targets
 
-    print(f"Reading data from S3: {args.input_path}")
-    print(f'Strategy: timechunk: {args.timechunk}, lat/y-chunk: {args.ychunk}, lon/x-chunk: {args.xchunk}')
-    print(f'Storing final output in: {output_path}')
-    print(f'Storing temp output in: {tmp_path}')
-    print(f'S3 target path: {s3_target}')
+def get_stage_path(args):
+    # --stage_path, else next to --tmp_path (not inside it: the temp data of each target is
+    # removed when the target is done), else under /efs
+    if args.stage_path is None and args.tmp_path is None:
+        base_name, dataset_name = get_output_name(args)
+        return setup_output_path(None, 'staged', base_name, dataset_name, 'staged-input', 'staged input',
+                                 restart=args.restart)
+    path = Path(args.stage_path or f"{args.tmp_path.rstrip('/')}-staged")
+    if path.is_dir() and args.restart:
+        print('Cleaning up old staged input.')
+        shutil.rmtree(str(path))
+    path.parent.mkdir(exist_ok=True, parents=True)
+    return path
 
-    # Load and open input file
-    s3 = s3fs.S3FileSystem(anon=False) # API: Access S3 as if it were a file system
-    assert s3.exists(args.input_path), f"Input path {args.input_path} not found on S3"
+def stage_input(input_fs, input_data, args, batch_size=1000):
+    # Copy the selected variable and its coordinates from S3 to local disk once, as stored
+    # (no decoding or rechunking), so that every target is rechunked from the local copy
+    staged_path = get_stage_path(args)
+    print(f'Staging input in: {staged_path}')
 
-    # Create key/value store based on this file-system
-    input_s3 = s3.get_mapper(args.input_path)
+    input_s3 = simulate_network(input_fs.get_mapper(args.input_path), args)
+    staged_store = zarr.DirectoryStore(str(staged_path))
+    for key in ['.zgroup', '.zattrs']:
+        if key in input_s3:
+            staged_store[key] = input_s3[key]
+    for name in input_data.variables:
+        source = simulate_network(input_fs.get_mapper(f'{args.input_path}/{name}'), args)
+        # Objects staged by an interrupted run are complete files: only fetch the rest
+        staged_keys = set(staged_store.listdir(name))
+        keys = [key for key in source if key not in staged_keys]
+        # Fetch chunk objects concurrently, in batches
+        for batch_i in range(0, len(keys), batch_size):
+            for key, value in source.getitems(keys[batch_i:batch_i + batch_size]).items():
+                staged_store[f'{name}/{key}'] = value
+    zarr.consolidate_metadata(staged_store)
 
-    # Load and decode a dataset from a Zarr store
-    input_data = xr.open_zarr(input_s3, consolidated=True).unify_chunks()  # Return dataset: multi-dimensional, in memory, array database
-
-    # Select only a variable if applicable 
-    if args.data_variable != 'None': 
-        print(f'Selecting variable: {args.data_variable}')
-        input_data = input_data[[args.data_variable]]
+    staged_data = xr.open_zarr(staged_store, consolidated=True).unify_chunks()
+    return staged_data, staged_store, staged_path
 
+def get_target_chunks(input_data, args, timechunk, xchunk, ychunk):
     # Get current chunks
     current_chunks = input_data.chunks  
     ntime = len(current_chunks["time"])
@@ -115,9 +206,9 @@ def main(args):
 
    # Make dict of assigned arguments
     new_chunks = {
-        args.timevar: all_time if args.timechunk=='all' else args.timechunk,
-        args.xvar: all_lon if args.xchunk=='all' else args.xchunk,
-        args.yvar: all_lat if args.ychunk=='all' else args.ychunk
+        args.timevar: all_time if timechunk=='all' else timechunk,
+        args.xvar: all_lon if xchunk=='all' else xchunk,
+        args.yvar: all_lat if ychunk=='all' else ychunk
     }
 
     # Another dict to assign new_chunks as key to each input_data key
@@ -129,29 +220,142 @@ def main(args):
         args.yvar: None
     }
     print(new_chunks2)
+    return new_chunks2
 
-    print("Preparing rechunker...")
-    rechunked = rechunker.rechunk(
-        input_data,
-        max_mem='100GiB',
-        target_chunks=new_chunks2,
-        target_store=str(output_path),
-        temp_store=str(tmp_path)
-    )
+def get_concurrency(max_requests):
+    # Chunks are uploaded by dask threads, each sending its chunks as one batch of concurrent 
+    # requests: cap threads x batch size at max_requests
+    num_workers = max(1, min(os.cpu_count(), max_requests))
+    batch_size = max(1, max_requests // num_workers)
+    return num_workers, batch_size
+
+def get_max_mem(args, num_workers):
+    if args.max_mem is not None:
+        return args.max_mem
+    available_memory = rechunk_plan.get_available_memory()
+    max_mem = rechunk_plan.choose_max_mem(available_memory, num_workers)
+    print(f'Available memory: {format_bytes(available_memory)} -- max_mem per task ({num_workers} workers): {format_bytes(max_mem)}')
+    return max_mem
+
+def report_plans(input_data, new_chunks2, max_mem, args):
+    plans = {}
+    shard = parse_shard(args)
+    for name in input_data.data_vars:
+        variable = input_data[name]
+        shape = variable.shape
+        source_chunks = variable.data.chunksize
+        target_chunks = tuple(new_chunks2[name][dim] for dim in variable.dims)
+        if shard is not None:
+            # Shards are written whole: plan for blocks of whole shards
+            chunks_per_shard = tuple(shard[dim] for dim in variable.dims)
+            target_chunks = sharding.get_shard_block(target_chunks, chunks_per_shard, shape)
+        itemsize = variable.dtype.itemsize
+        # Blocks are read straight from the source zarr array, so reads can span several source chunks
+        plan = rechunk_plan.plan_rechunk(shape, source_chunks, target_chunks, itemsize, max_mem,
+                                         consolidate_reads=True)
+        rechunk_plan.print_plan(name, plan)
+        if args.compare_mem is not None:
+            budgets = args.compare_mem.split(',')
+            plans_df = rechunk_plan.compare_plans(shape, source_chunks, target_chunks, itemsize, budgets,
+                                                  consolidate_reads=True)
+            print(plans_df.to_string())
+        plans[name] = plan
+    return plans
+
+def rechunk_target(input_data, source_store, args, timechunk, xchunk, ychunk):
+    # Create output dirs
+    output_url, tmp_path, strategy, base_name = create_dirs(args, timechunk, xchunk, ychunk)
+
+    print(f'Strategy: timechunk: {timechunk}, lat/y-chunk: {ychunk}, lon/x-chunk: {xchunk}')
+    print(f'Storing final output in: {output_url}')
+    print(f'Storing temp output in: {tmp_path}')
 
-    print("Executing rechunker...")
-    with ProgressBar():
-        rechunked.execute()
+    new_chunks2 = get_target_chunks(input_data, args, timechunk, xchunk, ychunk)
+
+    # Size the copy tasks and intermediate from the memory the job actually has
+    num_workers, batch_size = get_concurrency(args.max_requests)
+    max_mem = get_max_mem(args, num_workers)
+    plans = report_plans(input_data, new_chunks2, max_mem, args)
+    if args.plan_only:
+        shutil.rmtree(str(tmp_path), ignore_errors=True)
+        return
+
+    target_store = simulate_network(setup_target_store(output_url, args.restart), args)
+    temp_store = zarr.DirectoryStore(str(tmp_path))
+    encoding = None
+    if args.codec is not None:
+        encoding = {'compressor': compression.parse_codec(args.codec), 'filters': None}
+    resumable.init_target(input_data, new_chunks2, target_store, encoding)
+
+    # Chunks of the data variables go through the sharded view of the target, coordinates stay as written
+    data_store = None
+    shard = parse_shard(args)
+    if shard is not None:
+        for name in plans:
+            sharding.write_layout(target_store, name, tuple(shard[dim] for dim in input_data[name].dims))
+        data_store = sharding.ShardedStore(target_store)
+
+    # Every copied block is marked in the temp or target store: a rerun skips them
+    print(f"Rechunking with {num_workers} threads x {batch_size} requests in flight...")
+    fsspec.config.conf['gather_batch_size'] = batch_size
+    source_group = zarr.open_group(source_store, mode='r')
+    for name, plan in plans.items():
+        resumable.execute_plan(source_group[name], target_store, temp_store, name, plan, num_workers,
+                               data_store=data_store)
+
+    print("Checking output...")
+    report, _ = resumable.check_complete(data_store or target_store)
+    resumable.print_report(report, resumable.has_all_chunks(report))
+    if not resumable.has_all_chunks(report):
+        raise RuntimeError(f'Output {output_url} is missing chunks, rerun to resume')
 
     print("Consolidating metadata...")
-    zarr.consolidate_metadata(str(output_path))
+    resumable.finalize_target(target_store)
+
+    print("Removing temp data from /efs/")
+    # Single-stage plans never create the temp store
+    shutil.rmtree(str(tmp_path), ignore_errors=True)
+
+def main(args):
+    args.timechunk = convert_all(args.timechunk)
+    args.xchunk = convert_all(args.xchunk)
+    args.ychunk = convert_all(args.ychunk)
+    targets = parse_targets(args)
+    print(f'Target chunkings (time, x, y): {targets}')
+
+    print(f"Reading data from: {args.input_path}")
+
+    # Load and open input file
+    if '://' in args.input_path:
+        input_fs, args.input_path = fsspec.core.url_to_fs(args.input_path)
+    else:
+        input_fs = s3fs.S3FileSystem(anon=False) # API: Access S3 as if it were a file system
+    assert input_fs.exists(args.input_path), f"Input path {args.input_path} not found"
+
+    # Create key/value store based on this file-system
+    input_s3 = simulate_network(input_fs.get_mapper(args.input_path), args)
+
+    # Load and decode a dataset from a Zarr store
+    input_data = xr.open_zarr(input_s3, consolidated=True).unify_chunks()  # Return dataset: multi-dimensional, in memory, array database
+
+    # Select only a variable if applicable 
+    if args.data_variable != 'None': 
+        print(f'Selecting variable: {args.data_variable}')
+        input_data = input_data[[args.data_variable]]
+
+    # Several targets share a single read of the S3 input
+    source_store = input_s3
+    staged_path = None
+    if len(targets) > 1:
+        input_data, source_store, staged_path = stage_input(input_fs, input_data, args)
 
-    print("Copying results to S3")
-    s3.put(str(output_path), f"s3://{s3_target}", recursive=True)
+    for target_i, (timechunk, xchunk, ychunk) in enumerate(targets):
+        print(f'Rechunking target {target_i} / {len(targets)-1}')
+        rechunk_target(input_data, source_store, args, timechunk, xchunk, ychunk)
 
-    print("Removing data from /efs/")
-    shutil.rmtree(str(output_path))
-    shutil.rmtree(str(tmp_path))
+    if staged_path is not None:
+        print(f'Removing staged input from {staged_path}')
+        shutil.rmtree(str(staged_path))
 
     print("Done!")
 
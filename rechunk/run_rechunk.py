@@ -7,12 +7,29 @@ BASH_FILE = 'do-rechunk.sh'
 def create_bash_script(params):
     strat_description = params['strat_description']
     input_path = params['input_path']
-    timechunk = params['timechunk']
-    xchunk = params['xchunk']
-    ychunk = params['ychunk']
     data_variable = params['data_variable']
     dataset = input_path.split('/')[1]
-    strategy = f'{dataset}_{strat_description}_time{timechunk:04d}_lat{ychunk:04d}_lon{xchunk:04d}'
+    codec = params.get('codec')
+    shard = params.get('shard')
+    # Job label, e.g. hybrid, hybrid_zstd-5-bitshuffle or hybrid_shard1x4x4
+    label = strat_description if codec is None else f'{strat_description}_{codec}'
+    if shard is not None:
+        label = f"{label}_shard{'x'.join(str(n) for n in shard)}"
+    if 'targets' in params:
+        # All (time, x, y) targets in one job, sharing one read of the input
+        targets = ';'.join(f'{t},{x},{y}' for t, x, y in params['targets'])
+        strategy = f'{dataset}_{label}_multi{len(params["targets"]):03d}'
+        chunk_args = f'--targets="{targets}"'
+    else:
+        timechunk = params['timechunk']
+        xchunk = params['xchunk']
+        ychunk = params['ychunk']
+        strategy = f'{dataset}_{label}_time{timechunk:04d}_lat{ychunk:04d}_lon{xchunk:04d}'
+        chunk_args = f'--timechunk="{timechunk}" --xchunk="{xchunk}" --ychunk="{ychunk}"'
+    if codec is not None:
+        chunk_args = f'{chunk_args} --codec="{codec}"'
+    if shard is not None:
+        chunk_args = f"{chunk_args} --shard=\"{','.join(str(n) for n in shard)}\""
 
     with open(BASH_FILE, "w") as outfile:
         outfile.write(f'#!/usr/bin/env bash \n')
@@ -27,7 +44,7 @@ def create_bash_script(params):
         outfile.write(f'eval "$(conda shell.bash hook)" \n') 
         outfile.write(f'conda activate /backup/dieumynguyen/.conda/envs/eisfire \n') 
         outfile.write(f'echo "Using Python: $(which python)" \n') 
-        outfile.write(f'python {PY_FILE} --strat_description="{strat_description}" --input_path="{input_path}" --timechunk="{timechunk}" --xchunk="{xchunk}" --ychunk="{ychunk}" --data_variable="{data_variable}" \n')
+        outfile.write(f'python {PY_FILE} --strat_description="{strat_description}" --input_path="{input_path}" {chunk_args} --data_variable="{data_variable}" \n')
         outfile.write(f'echo "*** End time: $(date) *** " \n') 
     return BASH_FILE 
 
@@ -39,18 +56,45 @@ def main():
     lon = [200]
     param_sets = list(itertools.product(time,lon,lat))
 
+    # Compressor of the output, swept like the chunk sizes: "none" or "<cname>-<clevel>-<shuffle>"
+    # (Blosc cname: lz4, zstd, zlib...; shuffle: noshuffle, shuffle, bitshuffle); None keeps the source encoding
+    # e.g. ['lz4-5-shuffle', 'zstd-5-shuffle', 'zstd-5-bitshuffle', 'zlib-5-shuffle', 'none']
+    codecs = [None]
+
+    # Chunks per shard object along (time, x, y), swept like the codecs; None writes one object per chunk
+    # e.g. [None, (1, 4, 4), (4, 4, 4)] to benchmark both layouts side by side
+    shards = [None]
+
+    # True: a single job writes every combination from one read of the input
+    # False: one job per combination
+    MULTI_TARGET = False
+
     # Create combination of chunking parameters to run rechunking job
     param_list = []
-    for p in param_sets:
-        p_dict = {
-            'strat_description': 'hybrid',
-            'input_path': 'eis-dh-fire/geos-fp-global/inst.zarr',  
-            'timechunk': p[0],
-            'xchunk': p[1],
-            'ychunk': p[2],
-            'data_variable': 'BCEXTTAU' 
-        }
-        param_list.append(p_dict)
+    if MULTI_TARGET:
+        for codec, shard in itertools.product(codecs, shards):
+            p_dict = {
+                'strat_description': 'hybrid',
+                'input_path': 'eis-dh-fire/geos-fp-global/inst.zarr',  
+                'targets': param_sets,
+                'data_variable': 'BCEXTTAU',
+                'codec': codec,
+                'shard': shard
+            }
+            param_list.append(p_dict)
+    else:
+        for p, codec, shard in itertools.product(param_sets, codecs, shards):
+            p_dict = {
+                'strat_description': 'hybrid',
+                'input_path': 'eis-dh-fire/geos-fp-global/inst.zarr',  
+                'timechunk': p[0],
+                'xchunk': p[1],
+                'ychunk': p[2],
+                'data_variable': 'BCEXTTAU',
+                'codec': codec,
+                'shard': shard
+            }
+            param_list.append(p_dict)
 
     # Submit bash script to slurm
     for params_i, params in enumerate(param_list):
@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+
+# Chunking strategy of a measurement; rows of the same strategy (one per task) are aggregated together
+GROUP_COLUMNS = ['time_chunks', 'lon_chunks', 'lat_chunks']
+
+# Statistics of every aggregated metric besides its mean, as columns <metric>_<stat>
+STATS = ['std', 'count', 'min', 'max']
+
+def query_weights(metrics_df, weight_by=None):
+    # Weight of each row from its task: None (every task counts once), a dict {task: weight}
+    # (e.g. a workload mix) or a function of the task name (e.g. queries.query_size)
+    if weight_by is None:
+        return pd.Series(1.0, index=metrics_df.index)
+    tasks = metrics_df['task']
+    weights = tasks.map(weight_by)
+    unweighted = sorted(tasks[weights.isna()].unique())
+    if unweighted:
+        raise ValueError(f'No weight for the tasks: {unweighted}')
+    return weights.astype('float64')
+
+def metric_columns(metrics_df):
+    # Numeric columns other than the strategy, the query shape and the chunk labels
+    exclude = set(GROUP_COLUMNS) | {'lonlat_product', 'total_product'}
+    return [c for c in metrics_df.select_dtypes('number').columns
+            if c not in exclude and not c.startswith('shape_')]
+
+def aggregate(metrics_df, columns=None, weights=None):
+    # One row per chunking strategy: weighted mean of every metric (same column name) and its
+    # weighted (population) standard deviation, count of measured tasks, min and max
+    # NaN values (e.g. a task not measured with some metric) are left out of every statistic
+    columns = metric_columns(metrics_df) if columns is None else columns
+    values = metrics_df[columns].astype('float64')
+    weights = pd.Series(1.0, index=metrics_df.index) if weights is None else weights
+    groups = [metrics_df[c] for c in GROUP_COLUMNS]
+
+    measured_weights = values.notna().mul(weights, axis=0)
+    weight_sums = measured_weights.groupby(groups).transform('sum')
+    means = values.mul(weights, axis=0).groupby(groups).transform('sum') / weight_sums
+    variances = (values - means).pow(2).mul(weights, axis=0).groupby(groups).transform('sum') / weight_sums
+
+    agg_df = values.groupby(groups).agg(['count', 'min', 'max'])
+    agg_df.columns = [f'{metric}_{stat}' for metric, stat in agg_df.columns]
+    mean_df = means.groupby(groups).first()
+    std_df = np.sqrt(variances.groupby(groups).first()).add_suffix('_std')
+    result = pd.concat([mean_df, std_df, agg_df], axis=1)
+    stat_columns = [f'{metric}_{stat}' for metric in columns for stat in STATS]
+    return result[columns + stat_columns].reset_index()
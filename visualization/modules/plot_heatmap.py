@@ -19,6 +19,11 @@ def sort_pivot_table(df, results):
     results = results.reindex(column_order, axis=1)
     return results
 
+def get_heatmap_path(dataset, column_name, task_name):
+    if 'norm' in column_name:
+        return f'../data/{dataset}/normalized_heatmaps/{task_name}_{column_name}.png'
+    return f'../data/{dataset}/heatmaps/{task_name}_{column_name}.png'
+
 def make_pivot_tables(metrics_df_1, metrics_df_2, 
                       column_name, convert_mb_to_gb, product):
     # Pivot table 1
@@ -61,13 +66,17 @@ def make_heatmap(
     fontsize=14,
     num_decimals=4,
     convert_mb_to_gb=False,
-    show_title=False
+    show_title=False,
+    tied=None
 ):
+    # tied: pivot table like results, True where the strategy is not significantly different
+    # from the best one (see modules/significance.py); those cells are marked with *
     xlabel = "Longitude chunk size x Latitude chunk size"
     ylabel = "Time chunk size"
     
     if transpose:
         results = results.T
+        tied = tied.T if tied is not None else None
         xlabel, ylabel = ylabel, xlabel
     
     # Mask
@@ -81,6 +90,19 @@ def make_heatmap(
         result_vals = (result_vals[~np.isnan(result_vals)]).flatten()
         vmax = np.quantile(result_vals, q=quantile_q)
         
+    # Annotations
+    fmt = ".2g" if 'norm' in column_name else f"0.{num_decimals}f"
+    annot = True
+    if tied is not None:
+        tied = tied.reindex(index=results.index, columns=results.columns)
+        annot = results.copy().astype(object)
+        for row in results.index:
+            for col in results.columns:
+                value = results.loc[row, col]
+                mark = '*' if tied.loc[row, col] == True else ''
+                annot.loc[row, col] = '' if np.isnan(value) else f'{value:{fmt}}{mark}'
+        fmt = ''
+
     # Get colormap
     cmap = plt.get_cmap('RdPu' if 'norm' in column_name else 'Reds')
     new_cmap = truncate_colormap(cmap, 0.0, 0.95, 100)
@@ -90,9 +112,9 @@ def make_heatmap(
     g = sns.heatmap(
         results, 
 #         mask=mask, 
-        annot=True, 
+        annot=annot, 
         annot_kws={"fontsize": fontsize},
-        fmt=".2g" if 'norm' in column_name else f"0.{num_decimals}f", 
+        fmt=fmt, 
 #         fmt=f"0.{num_decimals}f", 
         cmap=new_cmap, 
         square=True,
@@ -117,7 +139,5 @@ def make_heatmap(
         plt.title(titles_dict[column_name])
 
     # Save heatmap
-    if 'norm' in column_name:
-        plt.savefig(f'../data/{dataset}/normalized_heatmaps/{task_name}_{column_name}.png', bbox_inches='tight')
-    else:
-        plt.savefig(f'../data/{dataset}/heatmaps/{task_name}_{column_name}.png', bbox_inches='tight')
\ No newline at end of file
+    plt.savefig(get_heatmap_path(dataset, column_name, task_name), bbox_inches='tight')
+    plt.close()
\ No newline at end of file
@@ -7,7 +7,47 @@ def prod(val) :
         res *= ele 
     return res  
 
+def add_chunk_labels(metrics_df):
+    # Label and product columns of the chunk sizes, computed column-wise
+    time_chunks = metrics_df.time_chunks.astype(str)
+    lon_chunks = metrics_df.lon_chunks.astype(str)
+    lat_chunks = metrics_df.lat_chunks.astype(str)
+    metrics_df['lon x lat'] = lon_chunks + 'x' + lat_chunks
+    metrics_df['lonlat_product'] = metrics_df.lon_chunks * metrics_df.lat_chunks
+    metrics_df['time x lon x lat'] = time_chunks + 'x' + lon_chunks + 'x' + lat_chunks
+    metrics_df['total_product'] = metrics_df.time_chunks * metrics_df.lon_chunks * metrics_df.lat_chunks
+    return metrics_df
+
+def add_derived_columns(metrics_df):
+    # Chunk labels, and metrics normalized by the data points of the query; data points from the
+    # shape columns of the results store (shape_0, ...) or from the array_shape strings of a CSV
+    metrics_df = add_chunk_labels(metrics_df)
+
+    shape_columns = [c for c in metrics_df.columns if c.startswith('shape_')]
+    if shape_columns:
+        metrics_df['num_data_points'] = metrics_df[shape_columns].astype('float64').fillna(1).prod(axis=1)
+    elif 'array_shape' in metrics_df:
+        metrics_df['num_data_points'] = metrics_df.array_shape.apply(lambda shape: prod(literal_eval(shape)))
+    if 'num_data_points' in metrics_df:
+        if 'cpu_times' in metrics_df:
+            metrics_df['norm_cpu_times'] = metrics_df.num_data_points / metrics_df.cpu_times
+        if 'wall_times' in metrics_df:
+            metrics_df['norm_wall_times'] = metrics_df.num_data_points / metrics_df.wall_times
+        if 'peak_memories' in metrics_df:
+            metrics_df['norm_peak_memories'] = metrics_df.peak_memories / metrics_df.num_data_points
+    return metrics_df
+
+def sort_metrics(metrics_df, sort_by='lonlat'):
+    if sort_by == 'lonlat':
+        metrics_df = metrics_df.sort_values(by='lonlat_product')
+    elif sort_by == 'timelonlat':
+        metrics_df = metrics_df.sort_values(by='total_product')
+
+    # In case of any duplicate rows
+    return metrics_df.drop_duplicates(subset='time x lon x lat', keep='first')
+
 def read_process_csv(filepath, timeall, lonall, latall, sort_by='lonlat'):
+    # Metrics of a CSV with the derived columns; the file itself is left as it is
     metrics_df = pd.read_csv(filepath, index_col=0)
         
     # Replace 'all' and convert units
@@ -15,42 +55,13 @@ def read_process_csv(filepath, timeall, lonall, latall, sort_by='lonlat'):
     metrics_df.lon_chunks = metrics_df.lon_chunks.replace('all', lonall).astype('int')
     metrics_df.lat_chunks = metrics_df.lat_chunks.replace('all', latall).astype('int')
 
-    # Add product column for latxlon
-    metrics_df['lon x lat'] = [f'{lon}x{lat}' for lon, lat in zip(metrics_df.lon_chunks, metrics_df.lat_chunks)]
-    metrics_df['lonlat_product'] = [lon*lat for lon, lat in zip(metrics_df.lon_chunks, metrics_df.lat_chunks)]
-    
-    # Another column of timexlatxlon
-    metrics_df['time x lon x lat'] = [f'{time}x{lon}x{lat}' for time, lon, lat in zip(metrics_df.time_chunks, metrics_df.lon_chunks, metrics_df.lat_chunks)]
-    metrics_df['total_product'] = [lon*lat*time for time, lon, lat in zip(metrics_df.time_chunks, metrics_df.lon_chunks, metrics_df.lat_chunks)]
+    metrics_df = add_derived_columns(metrics_df)
+    return sort_metrics(metrics_df, sort_by)
 
-    # Sort
-    if sort_by == 'lonlat':
-        metrics_df = metrics_df.sort_values(by='lonlat_product')
-    elif sort_by == 'timelonlat':
-        metrics_df = metrics_df.sort_values(by='total_product')
-        
-    # In case of any duplicate rows
-    metrics_df.drop_duplicates(subset='time x lon x lat', keep='first', inplace=True)
-    
-    try:
-        # Convert array_shape column to number
-        num_data_points = prod(list(literal_eval(metrics_df.array_shape[0])))
-        metrics_df['num_data_points'] = [num_data_points] * len(metrics_df)
-
-        # Add normalized columns to df
-        # 1. Normalized cpu time
-        metrics_df['norm_cpu_times'] = metrics_df.num_data_points / metrics_df.cpu_times
-
-        # 2. Normalized wall time
-        metrics_df['norm_wall_times'] = metrics_df.num_data_points / metrics_df.wall_times
-
-        # 3. Normalized peak memory
-        metrics_df['norm_peak_memories'] =  metrics_df.peak_memories / metrics_df.num_data_points
-    except:
-        pass
-    
-    # Save processed df - overwrite old file, unless need to save separately later
-    savepath = filepath
-    metrics_df.to_csv(savepath)
-
-    return metrics_df
\ No newline at end of file
+def read_chunk_table(filepath, timeall, lonall, latall):
+    # Per-strategy tables (archive sizes, rechunking time): chunk sizes as int, 'all'/999 = full dimension
+    df = pd.read_csv(filepath, index_col=0)
+    for column, all_value in [('time_chunks', timeall), ('lon_chunks', lonall), ('lat_chunks', latall)]:
+        df[column] = df[column].astype(str).replace('all', '999').astype(int).replace(999, all_value)
+    df = df.drop_duplicates(['time_chunks', 'lon_chunks', 'lat_chunks'], keep='last')
+    return df
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+
+def design_matrix(time_chunks, lon_chunks, lat_chunks):
+    # Log-log features of a (time, lon, lat) chunking; the squared and cross terms let
+    # the fit bend, since both too-small and too-large chunks are slow
+    log_time = np.log(np.asarray(time_chunks, dtype=float))
+    log_lonlat = np.log(np.asarray(lon_chunks, dtype=float) * np.asarray(lat_chunks, dtype=float))
+    log_aspect = np.log(np.asarray(lon_chunks, dtype=float) / np.asarray(lat_chunks, dtype=float))
+    return np.column_stack([
+        np.ones_like(log_time),
+        log_time,
+        log_lonlat,
+        log_aspect,
+        log_time**2,
+        log_lonlat**2,
+        log_time * log_lonlat
+    ])
+
+def fit_loglog(df, column):
+    # Least squares fit of log(column) on the chunking features
+    df = df[df[column] > 0]
+    X = design_matrix(df.time_chunks, df.lon_chunks, df.lat_chunks)
+    y = np.log(df[column].values)
+    coefs, _, _, _ = np.linalg.lstsq(X, y, rcond=None)
+    residuals = y - X @ coefs
+    r_squared = 1 - np.sum(residuals**2) / np.sum((y - y.mean())**2)
+    return coefs, r_squared
+
+def predict_loglog(coefs, time_chunks, lon_chunks, lat_chunks):
+    return np.exp(design_matrix(time_chunks, lon_chunks, lat_chunks) @ coefs)
+
+def within_measured_range(candidates, measured_df):
+    # Only interpolate: keep candidates inside the measured range of time chunks and lon x lat products
+    lonlat = candidates.lon_chunks * candidates.lat_chunks
+    measured_lonlat = measured_df.lon_chunks * measured_df.lat_chunks
+    return (
+        candidates.time_chunks.between(measured_df.time_chunks.min(), measured_df.time_chunks.max()) &
+        lonlat.between(measured_lonlat.min(), measured_lonlat.max())
+    )
+
+def recommend(task_dfs, workload, candidates, archive_df=None, rechunk_df=None,
+              max_archive_gb=None, max_rechunk_hours=None, verbose=True):
+    # Rank (time, lon, lat) chunkings for a workload mix
+    # task_dfs: {task name: metrics df}, workload: {task name: fraction of queries}
+    # candidates: df with time_chunks, lon_chunks, lat_chunks, which need not have been rechunked
+    total_weight = sum(workload.values())
+    ranked = candidates.copy()
+    ranked['pred_wall_times'] = 0.0
+    ranked['pred_peak_memories'] = 0.0
+    in_range = np.ones(len(ranked), dtype=bool)
+    for task_name, weight in workload.items():
+        metrics_df = task_dfs[task_name]
+        in_range &= within_measured_range(ranked, metrics_df)
+        for column in ['wall_times', 'peak_memories']:
+            coefs, r_squared = fit_loglog(metrics_df, column)
+            if verbose:
+                print(f'Task: {task_name} - {column} - R^2: {r_squared:0.3f}')
+            pred = predict_loglog(coefs, ranked.time_chunks, ranked.lon_chunks, ranked.lat_chunks)
+            ranked[f'{task_name}_{column}'] = pred
+            if column == 'wall_times':
+                # Expected latency of a query drawn from the workload
+                ranked['pred_wall_times'] += weight / total_weight * pred
+            else:
+                # Memory has to fit the most demanding query in the mix
+                ranked['pred_peak_memories'] = np.maximum(ranked['pred_peak_memories'], pred)
+
+    # Storage and rechunking constraints, interpolated the same way
+    for constraint_df, column, limit in [(archive_df, 'archive_size', max_archive_gb),
+                                         (rechunk_df, 'runtime_hr', max_rechunk_hours)]:
+        if constraint_df is None:
+            continue
+        coefs, r_squared = fit_loglog(constraint_df, column)
+        if verbose:
+            print(f'{column} - R^2: {r_squared:0.3f}')
+        ranked[f'pred_{column}'] = predict_loglog(coefs, ranked.time_chunks, ranked.lon_chunks, ranked.lat_chunks)
+        if limit is not None:
+            in_range &= ranked[f'pred_{column}'] <= limit
+
+    # Flag the chunkings that were actually benchmarked
+    measured = pd.concat([df[['time_chunks', 'lon_chunks', 'lat_chunks']] for df in task_dfs.values()])
+    measured_keys = set(measured.itertuples(index=False, name=None))
+    ranked['measured'] = [key in measured_keys for key in
+                          ranked[['time_chunks', 'lon_chunks', 'lat_chunks']].itertuples(index=False, name=None)]
+
+    ranked = ranked[in_range].sort_values(by='pred_wall_times').reset_index(drop=True)
+    return ranked
@@ -0,0 +1,111 @@
+import os
+import sys
+import json
+import pickle
+import hashlib
+import inspect
+import numpy as np
+import pandas as pd
+import matplotlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Render manifest: hash of the inputs of every figure written, next to the figures of a dataset
+MANIFEST_NAME = '.render_manifest.json'
+
+def make_job(output, func, **kwargs):
+    # Figure job: func(**kwargs) writes the figure file output
+    return {'output': output, 'func': func, 'kwargs': kwargs}
+
+def _update_hash(digest, value):
+    # Content of a figure input: DataFrames by their values, index and columns; containers
+    # element by element; anything else by its pickle
+    if isinstance(value, pd.DataFrame):
+        try:
+            hashed = pd.util.hash_pandas_object(value, index=True)
+        except TypeError:
+            # Cells that are not hashable, e.g. the lists of raw samples
+            hashed = pd.util.hash_pandas_object(value.astype(str), index=True)
+        digest.update(hashed.values.tobytes())
+        digest.update(repr(list(value.columns)).encode())
+    elif isinstance(value, (pd.Series, pd.Index)):
+        digest.update(pd.util.hash_pandas_object(value).values.tobytes())
+    elif isinstance(value, np.ndarray):
+        digest.update(value.tobytes())
+    elif isinstance(value, dict):
+        for key in sorted(value, key=str):
+            digest.update(repr(key).encode())
+            _update_hash(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        digest.update(str(len(value)).encode())
+        for item in value:
+            _update_hash(digest, item)
+    else:
+        digest.update(pickle.dumps(value))
+
+def source_modules(func):
+    # Module of func and the modules it imports from the same folder (e.g. modules/plot_heatmap.py)
+    module = sys.modules[func.__module__]
+    folder = os.path.dirname(os.path.abspath(module.__file__))
+    imported = [value for value in vars(module).values()
+                if inspect.ismodule(value) and getattr(value, '__file__', None)
+                and os.path.abspath(value.__file__).startswith(folder)]
+    return [module] + sorted(imported, key=lambda m: m.__name__)
+
+def job_hash(job):
+    # Hash of the job's parameters and input data, and of the source of the code that draws it,
+    # so that a change to the plotting code renders its figures again
+    digest = hashlib.sha256()
+    func = job['func']
+    digest.update(f'{func.__module__}.{func.__qualname__}'.encode())
+    for module in source_modules(func):
+        digest.update(inspect.getsource(module).encode())
+    _update_hash(digest, job['kwargs'])
+    return digest.hexdigest()
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(path, manifest):
+    # Written to a temporary file first, so an interrupted run leaves the previous manifest
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def _init_worker():
+    # Non-interactive backend: figures are only saved
+    matplotlib.use('Agg')
+
+def _render(job):
+    import matplotlib.pyplot as plt
+    try:
+        job['func'](**job['kwargs'])
+    finally:
+        plt.close('all')
+    return job['output']
+
+def render_jobs(jobs, manifest_path, max_workers=None, force=False):
+    # Render the jobs whose figure is missing or whose hash differs from the manifest, in a pool
+    # of processes; returns the number of figures rendered and skipped
+    manifest = load_manifest(manifest_path)
+    hashes = {job['output']: job_hash(job) for job in jobs}
+    pending = [job for job in jobs
+               if force or manifest.get(job['output']) != hashes[job['output']] or not os.path.exists(job['output'])]
+    print(f'Rendering {len(pending)} of {len(jobs)} figures ({len(jobs) - len(pending)} unchanged)')
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker) as executor:
+            futures = {executor.submit(_render, job): job['output'] for job in pending}
+            for future in as_completed(futures):
+                output = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f'Failed to render {output}: {e!r}')
+                    continue
+                manifest[output] = hashes[output]
+        save_manifest(manifest_path, manifest)
+    return len(pending), len(jobs) - len(pending)
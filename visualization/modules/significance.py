@@ -0,0 +1,60 @@
+import json
+import math
+import numpy as np
+
+# Raw samples (measure_performance.py) behind each metric; normalized metrics are a constant
+# factor (data points of the query) away from the raw ones, so their samples are the same
+SAMPLE_COLUMNS = {
+    'wall_times': 'wall_time_samples',
+    'norm_wall_times': 'wall_time_samples',
+    'cpu_times': 'cpu_time_samples',
+    'norm_cpu_times': 'cpu_time_samples',
+    'peak_memories': 'peak_memory_samples',
+    'norm_peak_memories': 'peak_memory_samples',
+}
+
+def permutation_pvalue(samples_1, samples_2, resamples=5000, seed=0):
+    # Two-sided permutation test of the difference in medians
+    samples_1 = np.asarray(samples_1, dtype='float64')
+    samples_2 = np.asarray(samples_2, dtype='float64')
+    observed = abs(np.median(samples_1) - np.median(samples_2))
+    pooled = np.concatenate([samples_1, samples_2])
+    rng = np.random.default_rng(seed)
+    permuted = rng.permuted(np.tile(pooled, (resamples, 1)), axis=1)
+    diffs = np.abs(np.median(permuted[:, :len(samples_1)], axis=1) - np.median(permuted[:, len(samples_1):], axis=1))
+    return float((np.sum(diffs >= observed) + 1) / (resamples + 1))
+
+def min_pvalue(n_1, n_2):
+    # Smallest p-value the permutation test can give: the observed split of the pooled samples is one
+    # of comb(n_1 + n_2, n_1), and with equal sizes its mirror image is as extreme
+    return (2 if n_1 == n_2 else 1) / math.comb(n_1 + n_2, n_1)
+
+def parse_samples(samples):
+    # Samples as a list: JSON (CSV), list (results store) or missing (None)
+    if isinstance(samples, str):
+        return json.loads(samples)
+    if isinstance(samples, (list, np.ndarray)) and len(samples) > 0:
+        return list(samples)
+    return None
+
+def compare_to_best(metrics_df, column_name, alpha=0.05):
+    # Adds 'p_vs_best' and 'tied_with_best' (not significantly different from the strategy with
+    # the lowest median) to metrics_df; None if it has no raw samples of column_name
+    # Strategies without samples (e.g. measured before samples were kept), or with too few for the
+    # test to reach alpha (e.g. 3 vs 3), get NaN and False; None if no strategy has enough
+    sample_column = SAMPLE_COLUMNS.get(column_name)
+    if sample_column is None or sample_column not in metrics_df:
+        return None
+    samples = metrics_df[sample_column].apply(parse_samples)
+    medians = samples.apply(lambda sample: np.median(sample) if sample is not None else np.nan)
+    if medians.isna().all():
+        return None
+    best = samples.iloc[int(np.nanargmin(medians.values))]
+    testable = [sample is not None and min_pvalue(len(sample), len(best)) <= alpha for sample in samples]
+    if not any(testable):
+        return None
+    metrics_df = metrics_df.copy()
+    metrics_df['p_vs_best'] = [permutation_pvalue(sample, best) if ok else np.nan
+                               for sample, ok in zip(samples, testable)]
+    metrics_df['tied_with_best'] = metrics_df['p_vs_best'] >= alpha
+    return metrics_df
@@ -0,0 +1,65 @@
+import itertools
+import pandas as pd
+
+import modules.read_process_data as data_reader
+import modules.recommend as recommender
+
+def main():
+    ntrials = 1
+    dataset = 'geos-fp-global_inst'
+
+    convert_all_dict = {
+        'geos-fp-global_inst': {'timeall': 5136, 'lonall': 1152, 'latall': 721}
+    }
+    all_lookup = convert_all_dict[dataset]
+
+    # Fraction of production queries of each benchmarked task
+    workload = {
+        f'time_series_metrics_ntrials{ntrials}':                  0.7,
+        f'time_series_over_region_usa_metrics_ntrials{ntrials}':  0.2,
+        f'map_over_time_30_day_metrics_ntrials{ntrials}':         0.1,
+    }
+
+    # Limits on the production layout
+    max_archive_gb = 12
+    max_rechunk_hours = 6
+
+    # Candidate chunkings, most of which were never rechunked
+    time_chunks = [6, 12, 24, 48, 72, 120, 240, 360, 720, 1440, 2160, 5136]
+    lon_chunks = [10, 20, 25, 50, 75, 100, 150, 200]
+    lat_chunks = [10, 20, 25, 50, 75, 100, 150, 200]
+    candidates = pd.DataFrame(list(itertools.product(time_chunks, lon_chunks, lat_chunks)),
+                              columns=['time_chunks', 'lon_chunks', 'lat_chunks'])
+
+    # Read performance data
+    task_dfs = {}
+    for task_name in workload:
+        filepath = f'../data/{dataset}/performance_data/{task_name}.csv'
+        task_dfs[task_name] = data_reader.read_process_csv(filepath, timeall=all_lookup['timeall'],
+                                lonall=all_lookup['lonall'], latall=all_lookup['latall'],
+                                sort_by='lonlat')
+
+    archive_df = data_reader.read_chunk_table(f'../data/{dataset}/performance_data/archive_sizes.csv',
+                    timeall=all_lookup['timeall'], lonall=all_lookup['lonall'], latall=all_lookup['latall'])
+    archive_df['archive_size'] = archive_df['archive_size'] * 1e-9
+    rechunk_df = data_reader.read_chunk_table(f'../data/{dataset}/performance_data/rechunking_time.csv',
+                    timeall=all_lookup['timeall'], lonall=all_lookup['lonall'], latall=all_lookup['latall'])
+
+    # Rank chunkings
+    ranked = recommender.recommend(
+        task_dfs,
+        workload,
+        candidates,
+        archive_df=archive_df,
+        rechunk_df=rechunk_df,
+        max_archive_gb=max_archive_gb,
+        max_rechunk_hours=max_rechunk_hours
+    )
+    ranked.to_csv(f'../data/{dataset}/performance_data/recommended_chunkings.csv')
+
+    columns = ['time_chunks', 'lon_chunks', 'lat_chunks', 'pred_wall_times', 'pred_peak_memories',
+               'pred_archive_size', 'pred_runtime_hr', 'measured']
+    print(ranked[columns].head(15).to_string())
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,7 @@
 import os
+import sys
 import glob
+import argparse
 import numpy as np
 import pandas as pd
 import seaborn as sns
@@ -12,32 +14,48 @@ mpl.rcParams['font.sans-serif'] = "Arial"
 import modules.read_process_data as data_reader
 import modules.plot_heatmap as heatmap_maker
 import modules.plot_scatterplots as scatterplot_maker
+import modules.significance as significance
+import modules.render as render
+import modules.aggregate as aggregate
 
-def avg_aggregation(dataset, task_name, file_paths, all_lookup):
-    all_metrics = []
-    for filepath in file_paths:
-        basename = os.path.basename(filepath)
-        metrics_df = data_reader.read_process_csv(filepath, timeall=all_lookup['timeall'], 
-                        lonall=all_lookup['lonall'], latall=all_lookup['latall'],
-                        sort_by='lonlat')
-        metrics_df["path_name"] = basename
-        all_metrics.append(metrics_df)
-    all_metrics_df = pd.concat(all_metrics)
-
-    df_list = []
-    for group_key, df_i in all_metrics_df.groupby("time x lon x lat"):
-        avg_df = df_i.mean()
-        df_list.append(avg_df)
-    mean_df = pd.DataFrame(df_list)
-
-    # Put back the string columns to sort
-    # Add product column for latxlon
-    mean_df['lon x lat'] = [f'{int(lon)}x{int(lat)}' for lon, lat in zip(mean_df.lon_chunks, mean_df.lat_chunks)]
-    mean_df['lonlat_product'] = [lon*lat for lon, lat in zip(mean_df.lon_chunks, mean_df.lat_chunks)]
-
-    # Sort
-    mean_df = mean_df.sort_values(by='lonlat_product')
-    mean_df.time_chunks = mean_df.time_chunks.astype(int)
+# Results store shared with the benchmark (measure_performance/modules/results_store.py)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'measure_performance'))
+import modules.results_store as results_store
+import modules.queries as queries
+
+# Stored metrics the figures use; the other columns of the store are not loaded
+PLOT_COLUMNS = ['cpu_times', 'wall_times', 'peak_memories', 'num_chunks', 'chunk_sizes'] + results_store.SHAPE_COLUMNS
+
+def import_csvs(results_path, dataset, ntrials):
+    # Per-task CSVs of earlier sweeps (<task>_metrics_ntrials<n>.csv) are imported once
+    for filepath in sorted(glob.glob(f'../data/{dataset}/performance_data/*_metrics_ntrials{ntrials}.csv')):
+        task = os.path.basename(filepath).split('_metrics_ntrials')[0]
+        if results_store.import_csv(results_path, filepath, task):
+            print(f'Imported {filepath} into {results_path}')
+
+def load_task(results_path, task, all_lookup, columns=PLOT_COLUMNS, with_samples=False):
+    # Latest measurements of the tasks matching task (name or glob) in the default sweep,
+    # with the derived columns; with_samples adds the raw samples of every trial as lists
+    # Chunk sizes stored as 'all' (e.g. imported CSVs) are replaced with all_lookup
+    metrics_df = results_store.load(results_path, columns=columns, task=task, params={})
+    for column, all_value in [('time_chunks', all_lookup['timeall']), ('lon_chunks', all_lookup['lonall']),
+                              ('lat_chunks', all_lookup['latall'])]:
+        metrics_df[column] = metrics_df[column].astype(str).replace('all', str(all_value)).astype(int)
+    if with_samples:
+        trials_df = results_store.load_trials(results_path, task=task, params={})
+        samples_df = trials_df.groupby(results_store.KEY_COLUMNS).agg(
+            wall_time_samples=('wall_time', list), cpu_time_samples=('cpu_time', list),
+            peak_memory_samples=('peak_memory', list)).reset_index()
+        metrics_df = metrics_df.merge(samples_df, on=results_store.KEY_COLUMNS, how='left')
+    return data_reader.add_derived_columns(metrics_df)
+
+def avg_aggregation(dataset, task_name, all_metrics_df, weight_by=None):
+    # all_metrics_df: measurements of every task to average, e.g. load_task(..., 'map_over_time_*', ...)
+    # weight_by: None (tasks weigh the same), queries.query_size (bbox area or hours of the task's
+    # query) or {task: weight}; see modules/aggregate.py
+    weights = aggregate.query_weights(all_metrics_df, weight_by)
+    mean_df = aggregate.aggregate(all_metrics_df, weights=weights)
+    mean_df = data_reader.add_chunk_labels(mean_df).sort_values(by='lonlat_product')
     mean_df.to_csv(f'../data/{dataset}/performance_data/{task_name}.csv')
     return mean_df
 
@@ -58,7 +76,8 @@ def make_heatmap(
         MB_TO_GB=True,
         SHOW_TITLE=False,
         PROCESS_CSV=True,
-        PRODUCT=False
+        PRODUCT=False,
+        SIGNIFICANCE=False
     ):
 
     if PROCESS_CSV:
@@ -79,6 +98,15 @@ def make_heatmap(
         product=PRODUCT
         )
 
+    # Mark strategies not significantly different from the best one, from the raw samples
+    # of a single task (measure_performance.py keeps them)
+    tied = None
+    if SIGNIFICANCE and metrics_df_2 is None:
+        compared = significance.compare_to_best(metrics_df, KEY)
+        if compared is not None:
+            tied = compared.pivot(index='time_chunks', columns='lon x lat', values='tied_with_best')
+            tied = heatmap_maker.sort_pivot_table(compared, tied)
+
     sns.set(font_scale=2) # 1.5
     heatmap_maker.make_heatmap(
         dataset,
@@ -93,26 +121,50 @@ def make_heatmap(
         fontsize=12, # 10
         num_decimals=NUM_DECIMALS,
         convert_mb_to_gb=MB_TO_GB,
-        show_title=SHOW_TITLE
+        show_title=SHOW_TITLE,
+        tied=tied
     )
 
-def organize_df(df):
-    df['time_chunks'] = df['time_chunks'].astype(int)
-    df['lon_chunks'] = df['lon_chunks'].astype(int)
-    df['lat_chunks'] = df['lat_chunks'].astype(int)
+def heatmap_job(dataset, titles_dict, all_lookup, KEY, metrics_df, task_name, **kwargs):
+    # Figure job of make_heatmap(); its input data is metrics_df (and metrics_df_2)
+    return render.make_job(
+        heatmap_maker.get_heatmap_path(dataset, KEY, task_name),
+        make_heatmap,
+        dataset=dataset,
+        titles_dict=titles_dict,
+        filepath='',
+        all_lookup=all_lookup,
+        KEY=KEY,
+        metrics_df=metrics_df,
+        task_name=task_name,
+        PROCESS_CSV=False,
+        **kwargs
+    )
 
-    # Add product column for latxlon
-    df['lon x lat'] = [f'{lon}x{lat}' for lon, lat in zip(df.lon_chunks, df.lat_chunks)]
-    df['lonlat_product'] = [lon*lat for lon, lat in zip(df.lon_chunks, df.lat_chunks)]
+def make_scatterplots(dataset, titles_dict, concatenated, pairs, ylim, filepath, log=True):
+    num_colors = len(concatenated.loc[concatenated['dataset'] == 'set1', 'lonlat_product'].unique())
+    color_palette = sns.color_palette("inferno_r", as_cmap=True, n_colors=num_colors)
+    color_palette = color_palette(np.linspace(0.1, 1, num_colors))
+    color_palette = sns.color_palette(color_palette)
 
-    # Another column of timexlatxlon
-    df['time x lon x lat'] = [f'{time}x{lon}x{lat}' for time, lon, lat in zip(df.time_chunks, df.lon_chunks, df.lat_chunks)]
-    df['total_product'] = [lon*lat*time for time, lon, lat in zip(df.time_chunks, df.lon_chunks, df.lat_chunks)]
-    df = df.sort_values(by='lonlat_product')
-    df.drop_duplicates(subset='time x lon x lat', keep='first', inplace=True)
-    return df
+    sns.set(style='ticks', palette='Set2')
+    fig, axes = plt.subplots(nrows=1, ncols=3, figsize=(9,3), constrained_layout=True, dpi=150)
+    for ax_i, (ax, pair) in enumerate(zip(axes.flatten(), pairs)):
+        scatterplot_maker.plot_pairwise_metrics(ax, concatenated, pair[0], pair[1], 
+                            color_palette, titles_dict,
+                            log=log, legend=False, fontsize=12, 
+                            plot_lines=True, ylim=ylim[ax_i])
+    plt.savefig(filepath, bbox_inches='tight')
+    plt.close(fig)
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--max_workers', type=int, default=None,
+                        help='Processes rendering the figures (default: one per CPU)')
+    parser.add_argument('--force', action='store_true',
+                        help='Render every figure, even those whose input data is unchanged')
+    args = parser.parse_args()
+
     ntrials = 1 
     dataset = 'geos-fp-global_inst' 
 
@@ -133,13 +185,16 @@ def main():
     }
     all_lookup = convert_all_dict[dataset]
 
-    task_dict = {
-        0: f'time_series_metrics_ntrials{ntrials}',
-        1: f'map_one_timestep_metrics_ntrials{ntrials}'
-    }       
-
     keys = ['norm_wall_times', 'norm_peak_memories', 'wall_times', 'peak_memories']
 
+    # Weights of the tasks in the aggregates over regions/time windows: None (every task counts
+    # the same), queries.query_size (larger queries count more) or {task: weight}
+    WEIGHT_BY = None
+
+    # Benchmark results: figures load only the tasks and columns they plot
+    results_path = results_store.get_results_path(dataset, root='../data')
+    import_csvs(results_path, dataset, ntrials)
+
     pairwise_combinations = [
         ('chunk_sizes', 'wall_times'),
         ('chunk_sizes', 'peak_memories'),
@@ -152,185 +207,76 @@ def main():
         ('norm_peak_memories', 'norm_wall_times'),
     ]
 
-    # Plot time series data
-    print('Plotting time series data...')
-    filepath = f'../data/{dataset}/performance_data/{task_dict[0]}.csv'
+    # Figures are collected as jobs, then rendered together (see modules/render.py)
+    jobs = []
+
+    # Time series data
+    print('Loading time series data...')
+    time_metrics_df = data_reader.sort_metrics(load_task(results_path, 'time_series', all_lookup,
+                                                         with_samples=True))
     for k in keys:
-        make_heatmap(
-            dataset,
-            titles_dict, 
-            filepath, 
-            all_lookup, 
-            KEY=k
-        )
+        jobs.append(heatmap_job(dataset, titles_dict, all_lookup, k, time_metrics_df, 'time_series_metrics',
+                                SIGNIFICANCE=True))
 
-    # Plot map data
-    print('Plotting map data...')
-    filepath = f'../data/{dataset}/performance_data/{task_dict[1]}.csv'
+    # Map data
+    print('Loading map data...')
+    map_metrics_df = data_reader.sort_metrics(load_task(results_path, 'map_one_timestep', all_lookup,
+                                                        with_samples=True))
     for k in keys:
-        make_heatmap(
-            dataset,
-            titles_dict, 
-            filepath, 
-            all_lookup, 
-            KEY=k
-        )
+        jobs.append(heatmap_job(dataset, titles_dict, all_lookup, k, map_metrics_df, 'map_one_timestep_metrics',
+                                SIGNIFICANCE=True))
 
-    # Plot product/avg of both operations' data
-    print('Plotting product of both operations...')
-    # Product of time series and map df's
-    time_filepath = f'../data/{dataset}/performance_data/{task_dict[0]}.csv'
-    map_filepath = f'../data/{dataset}/performance_data/{task_dict[1]}.csv'
-    time_metrics_df = data_reader.read_process_csv(time_filepath, timeall=all_lookup['timeall'], 
-                        lonall=all_lookup['lonall'], latall=all_lookup['latall'],
-                        sort_by='lonlat')
-    map_metrics_df = data_reader.read_process_csv(map_filepath, timeall=all_lookup['timeall'], 
-                        lonall=all_lookup['lonall'], latall=all_lookup['latall'],
-                        sort_by='lonlat')
+    # Product/avg of both operations' data
     for k in keys:
-        make_heatmap(
-            dataset,
-            titles_dict, 
-            time_filepath, 
-            all_lookup, 
-            KEY=k, 
-            metrics_df=time_metrics_df,
-            metrics_df_2=map_metrics_df,
-            task_name='average' if 'norm' in k else 'product',
-            PROCESS_CSV=False,
-            PRODUCT=False if 'norm' in k else True
-        )
-        
-    # Plot time series aggregation data
-    print('Plotting time series aggregation data...')
-    file_paths = np.sort(glob.glob(f'../data/{dataset}/performance_data/time_series_over_region_*_ntrials{ntrials}.*'))
+        jobs.append(heatmap_job(dataset, titles_dict, all_lookup, k, time_metrics_df,
+                                'average' if 'norm' in k else 'product',
+                                metrics_df_2=map_metrics_df,
+                                PRODUCT=False if 'norm' in k else True))
+
+    # Time series aggregation data
+    print('Loading time series aggregation data...')
     task_name = 'time_series_average'
-    mean_df = avg_aggregation(dataset, task_name, file_paths, all_lookup)
+    time_mean_df = avg_aggregation(dataset, task_name,
+                                   load_task(results_path, 'time_series_over_region_*', all_lookup),
+                                   weight_by=WEIGHT_BY)
     for k in keys:
-        make_heatmap(
-            dataset,
-            titles_dict, 
-            '', 
-            all_lookup, 
-            KEY=k, 
-            metrics_df=mean_df,
-            task_name=task_name,
-            QUANTILE_Q=0.7,
-            NUM_DECIMALS=3,
-            PROCESS_CSV=False
-        )
+        jobs.append(heatmap_job(dataset, titles_dict, all_lookup, k, time_mean_df, task_name,
+                                QUANTILE_Q=0.7, NUM_DECIMALS=3))
 
-    # Plot map aggregation data
-    print('Plotting map aggregation data...')
-    file_paths = np.sort(glob.glob(f'../data/{dataset}/performance_data/map_over_time_*_ntrials{ntrials}.*'))
+    # Map aggregation data
+    print('Loading map aggregation data...')
     task_name = 'maps_average'
-    mean_df = avg_aggregation(dataset, task_name, file_paths, all_lookup)
+    map_mean_df = avg_aggregation(dataset, task_name, load_task(results_path, 'map_over_time_*', all_lookup),
+                                  weight_by=WEIGHT_BY)
     for k in keys:
-        make_heatmap(
-            dataset,
-            titles_dict, 
-            '', 
-            all_lookup, 
-            KEY=k, 
-            metrics_df=mean_df,
-            task_name=task_name,
-            QUANTILE_Q=0.7,
-            NUM_DECIMALS=3,
-            PROCESS_CSV=False
-        )
+        jobs.append(heatmap_job(dataset, titles_dict, all_lookup, k, map_mean_df, task_name,
+                                QUANTILE_Q=0.7, NUM_DECIMALS=3))
 
-    # Plot product/avg of both operations' data aggregations
-    print('Plotting product of both aggregation operations...')
-    # Product of time series and map df's
-    time_filepath = f'../data/{dataset}/performance_data/time_series_average.csv'
-    map_filepath = f'../data/{dataset}/performance_data/maps_average.csv'
-    time_metrics_df = data_reader.read_process_csv(time_filepath, timeall=all_lookup['timeall'], 
-                        lonall=all_lookup['lonall'], latall=all_lookup['latall'],
-                        sort_by='lonlat')
-    map_metrics_df = data_reader.read_process_csv(map_filepath, timeall=all_lookup['timeall'], 
-                        lonall=all_lookup['lonall'], latall=all_lookup['latall'],
-                        sort_by='lonlat')
+    # Product/avg of both operations' data aggregations
     for k in keys:
-        make_heatmap(
-            dataset,
-            titles_dict, 
-            time_filepath, 
-            all_lookup, 
-            KEY=k, 
-            metrics_df=time_metrics_df,
-            metrics_df_2=map_metrics_df,
-            task_name='average_aggregate' if 'norm' in k else 'product_aggregate',
-            PROCESS_CSV=False,
-            PRODUCT=False if 'norm' in k else True
-        )
+        jobs.append(heatmap_job(dataset, titles_dict, all_lookup, k, time_mean_df,
+                                'average_aggregate' if 'norm' in k else 'product_aggregate',
+                                metrics_df_2=map_mean_df,
+                                PRODUCT=False if 'norm' in k else True))
 
-    # Plot rechunking time
-    print('Plotting rechunking time...')
-    filepath = f'../data/{dataset}/performance_data/rechunking_time.csv'
-    df = pd.read_csv(filepath)
-    df = df.drop_duplicates(['time_chunks', 'lon_chunks', 'lat_chunks'], keep='last')
-    df['time_chunks']= df['time_chunks'].replace(999, 5136)
-    df['lon_chunks'] = df['lon_chunks'].replace(999, 1152)
-    df['lat_chunks'] = df['lat_chunks'].replace(999, 721)
-    df = organize_df(df)
-    task_name = 'rechunking'
-    make_heatmap(
-            dataset,
-            titles_dict, 
-            filepath, 
-            all_lookup, 
-            KEY='runtime_hr',
-            metrics_df=df,
-            task_name=task_name,
-            QUANTILE_Q=0.82,
-            PROCESS_CSV=False
-        )
+    # Rechunking time
+    df = data_reader.read_chunk_table(f'../data/{dataset}/performance_data/rechunking_time.csv', **all_lookup)
+    df = data_reader.sort_metrics(data_reader.add_derived_columns(df))
+    jobs.append(heatmap_job(dataset, titles_dict, all_lookup, 'runtime_hr', df, 'rechunking',
+                            QUANTILE_Q=0.82))
 
-    # Plot archive size
-    print('Plotting archive size...')
-    filepath = f'../data/{dataset}/performance_data/archive_sizes.csv'
-    df = pd.read_csv(filepath)
+    # Archive size
+    df = data_reader.read_chunk_table(f'../data/{dataset}/performance_data/archive_sizes.csv', **all_lookup)
     df['archive_size'] = df['archive_size'] * 1e-9
-    df['time_chunks'].replace('all', 5136, inplace=True)
-    df['lon_chunks'].replace('all', 1152, inplace=True)
-    df['lat_chunks'].replace('all', 721, inplace=True)
-    df = organize_df(df)
-    task_name = 'archive_size'
-    make_heatmap(
-            dataset,
-            titles_dict, 
-            filepath, 
-            all_lookup, 
-            KEY='archive_size',
-            metrics_df=df,
-            task_name=task_name,
-            QUANTILE_Q=None,
-            PROCESS_CSV=False
-       )
-
-    # Plot scatterplots
-    print('Plotting scatterplots...')
+    df = data_reader.sort_metrics(data_reader.add_derived_columns(df))
+    jobs.append(heatmap_job(dataset, titles_dict, all_lookup, 'archive_size', df, 'archive_size',
+                            QUANTILE_Q=None))
+
+    # Scatterplots
     LOG = True
     NORMS = [False, True]
     task_name = 'overlay_tasks'
-    task_dict = {
-        0: f'time_series_metrics_ntrials{ntrials}',
-        1: f'map_one_timestep_metrics_ntrials{ntrials}'
-    }
-    filepath = f'../data/{dataset}/performance_data/{task_dict[0]}.csv'
-    map_filepath = f'../data/{dataset}/performance_data/{task_dict[1]}.csv'
-    metrics_df = data_reader.read_process_csv(filepath, timeall=all_lookup['timeall'], 
-                    lonall=all_lookup['lonall'], latall=all_lookup['latall'],
-                    sort_by='lonlat')
-    map_metrics_df = data_reader.read_process_csv(map_filepath, timeall=all_lookup['timeall'], 
-                      lonall=all_lookup['lonall'], latall=all_lookup['latall'],
-                      sort_by='lonlat')
-    concatenated = pd.concat([metrics_df.assign(dataset='set1'), map_metrics_df.assign(dataset='set2')])
-    num_colors = len(metrics_df['lonlat_product'].unique())
-    color_palette = sns.color_palette("inferno_r", as_cmap=True, n_colors=num_colors)
-    color_palette = color_palette(np.linspace(0.1, 1, num_colors))
-    color_palette = sns.color_palette(color_palette)
-    
+    concatenated = pd.concat([time_metrics_df.assign(dataset='set1'), map_metrics_df.assign(dataset='set2')])
     for NORM in NORMS:
         pairs = norm_pairwise_combinations if NORM else pairwise_combinations
 
@@ -338,18 +284,19 @@ def main():
         lim2 = [(10**1.5, 10**7.8), (10**-4, 10**0.2), (10**1.4, 10**8)]
         YLIM = lim2 if NORM else lim1
 
-        sns.set(style='ticks', palette='Set2')
-        fig, axes = plt.subplots(nrows=1, ncols=3, figsize=(9,3), constrained_layout=True, dpi=150)
-        for ax_i, (ax, pair) in enumerate(zip(axes.flatten(), pairs)):
-            scatterplot_maker.plot_pairwise_metrics(ax, concatenated, pair[0], pair[1], 
-                                color_palette, titles_dict,
-                                log=LOG, legend=False, fontsize=12, 
-                                plot_lines=True, ylim=YLIM[ax_i])
         label = '_norm' if NORM else ''
         if LOG:
-            plt.savefig(f'../data/{dataset}/scatterplots/{task_name}_log{label}.png', bbox_inches='tight')
+            filepath = f'../data/{dataset}/scatterplots/{task_name}_log{label}.png'
         else:
-            plt.savefig(f'../data/{dataset}/scatterplots/{task_name}{label}.png', bbox_inches='tight')
+            filepath = f'../data/{dataset}/scatterplots/{task_name}{label}.png'
+        columns = ['dataset', 'lonlat_product'] + list(pairs[0]) + list(pairs[1]) + list(pairs[2])
+        jobs.append(render.make_job(filepath, make_scatterplots, dataset=dataset, titles_dict=titles_dict,
+                                    concatenated=concatenated[list(dict.fromkeys(columns))],
+                                    pairs=pairs, ylim=YLIM, filepath=filepath, log=LOG))
+
+    print('Plotting...')
+    manifest_path = f'../data/{dataset}/{render.MANIFEST_NAME}'
+    render.render_jobs(jobs, manifest_path, max_workers=args.max_workers, force=args.force)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file